@@ -13,4 +13,25 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """
+    Django's ASGI app, plus lifespan events that start the Telegram bot once
+    per worker process and shut it down cleanly.
+    """
+    if scope["type"] != "lifespan":
+        return await django_application(scope, receive, send)
+
+    from kubot_ai.views import shutdown_bot, startup_bot
+
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await startup_bot()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown_bot()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -32,6 +32,8 @@ ASYNC_MODE = True
 
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; register it with `manage.py set_webhook`
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
 
 ALLOWED_HOSTS = ["*"]
 
@@ -51,6 +53,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'kubot_ai.metrics.MetricsMiddleware',  # First, so it times the whole stack
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -99,6 +102,27 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# The default cache is the database cache (table created by migration 0019) so
+# that every worker shares the same entries: the task catalog version, the
+# Telegram update dedup claims, ... Point CACHE_BACKEND/CACHE_LOCATION at Redis or
+# Memcached when available. Process-local backends (locmem) trigger a warning.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv("CACHE_BACKEND", "django.core.cache.backends.db.DatabaseCache"),
+        'LOCATION': os.getenv("CACHE_LOCATION", "kubot_cache"),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv("CACHE_MAX_ENTRIES", "100000")),
+        },
+    }
+}
+
+# How long a task catalog version and its cached pages live (seconds)
+KUBOT_CATALOG_CACHE_TTL = int(os.getenv("KUBOT_CATALOG_CACHE_TTL", "300"))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -128,6 +152,58 @@ REST_FRAMEWORK = {
     ),
 }
 
+# Default and maximum `limit` for the paginated endpoints (see kubot_ai/pagination.py)
+KUBOT_PAGE_SIZE = int(os.getenv("API_PAGE_SIZE", "50"))
+KUBOT_MAX_PAGE_SIZE = int(os.getenv("API_MAX_PAGE_SIZE", "500"))
+
+# Mining session/reward store used by the Telegram bot (see kubot_ai/mining.py)
+KUBOT_MINING_STORE = os.getenv("KUBOT_MINING_STORE", "kubot_ai.mining.DatabaseMiningStore")
+KUBOT_MINING_SESSION_TTL = int(os.getenv("KUBOT_MINING_SESSION_TTL", "120"))  # seconds
+
+# Mining session length and reward, paid out by the durable scheduler (see kubot_ai/scheduler.py)
+KUBOT_MINING_DURATION = int(os.getenv("KUBOT_MINING_DURATION", "10"))  # seconds
+KUBOT_MINING_REWARD = int(os.getenv("KUBOT_MINING_REWARD", "50"))
+KUBOT_SCHEDULER_POLL_INTERVAL = float(os.getenv("KUBOT_SCHEDULER_POLL_INTERVAL", "1.0"))  # seconds
+KUBOT_SCHEDULER_BATCH_SIZE = int(os.getenv("KUBOT_SCHEDULER_BATCH_SIZE", "100"))
+KUBOT_SCHEDULER_LEASE = int(os.getenv("KUBOT_SCHEDULER_LEASE", "30"))  # seconds a claimed batch is reserved
+KUBOT_MINING_FLUSH_INTERVAL = float(os.getenv("KUBOT_MINING_FLUSH_INTERVAL", "5.0"))  # max seconds before mined tokens reach the wallet
+KUBOT_MINING_SWEEP_INTERVAL = float(os.getenv("KUBOT_MINING_SWEEP_INTERVAL", "300"))  # seconds between full journal sweeps
+
+# Crediting task rewards to wallet balances (see kubot_ai/crediting.py)
+KUBOT_CREDIT_POLL_INTERVAL = float(os.getenv("KUBOT_CREDIT_POLL_INTERVAL", "1.0"))  # seconds
+KUBOT_CREDIT_BATCH_SIZE = int(os.getenv("KUBOT_CREDIT_BATCH_SIZE", "500"))
+
+# Referral bonus per upline level (L1, L2, L3, ...) and how deep the referral tree is indexed
+KUBOT_REFERRAL_TIERS = [int(amount) for amount in os.getenv("KUBOT_REFERRAL_TIERS", "5,2,1").split(",")]
+KUBOT_REFERRAL_MAX_DEPTH = int(os.getenv("KUBOT_REFERRAL_MAX_DEPTH", "10"))
+
+# Leaderboards (see kubot_ai/leaderboard.py)
+KUBOT_LEADERBOARD_REBUILD_INTERVAL = int(os.getenv("KUBOT_LEADERBOARD_REBUILD_INTERVAL", "300"))  # seconds
+KUBOT_LEADERBOARD_TOP_TTL = int(os.getenv("KUBOT_LEADERBOARD_TOP_TTL", "30"))  # seconds
+KUBOT_LEADERBOARD_MAX_LIMIT = int(os.getenv("KUBOT_LEADERBOARD_MAX_LIMIT", "100"))
+
+# Telegram webhook worker pool (see kubot_ai/webhook_queue.py)
+KUBOT_WEBHOOK_WORKERS = int(os.getenv("KUBOT_WEBHOOK_WORKERS", "8"))
+KUBOT_WEBHOOK_QUEUE_SIZE = int(os.getenv("KUBOT_WEBHOOK_QUEUE_SIZE", "1000"))
+
+# Outbound Telegram message limits and retries (see kubot_ai/sender.py)
+KUBOT_SEND_GLOBAL_RATE = float(os.getenv("KUBOT_SEND_GLOBAL_RATE", "30"))  # messages per second
+KUBOT_SEND_CHAT_RATE = float(os.getenv("KUBOT_SEND_CHAT_RATE", "1"))  # messages per second per chat
+KUBOT_SEND_CHAT_BURST = int(os.getenv("KUBOT_SEND_CHAT_BURST", "3"))
+KUBOT_SEND_CHAT_MAX_WAIT = float(os.getenv("KUBOT_SEND_CHAT_MAX_WAIT", "1.0"))  # seconds; longer waits drop the message
+KUBOT_SEND_MAX_RETRIES = int(os.getenv("KUBOT_SEND_MAX_RETRIES", "3"))
+KUBOT_SEND_RETRY_RATE = float(os.getenv("KUBOT_SEND_RETRY_RATE", "5"))  # retries per second, process-wide
+
+# Telegram keeps redelivering an update for up to 24 hours
+KUBOT_UPDATE_DEDUP_WINDOW = int(os.getenv("KUBOT_UPDATE_DEDUP_WINDOW", "86400"))  # seconds
+KUBOT_UPDATE_DEDUP_LOCAL_SIZE = int(os.getenv("KUBOT_UPDATE_DEDUP_LOCAL_SIZE", "10000"))
+
+# Prometheus metrics (see kubot_ai/metrics.py). Workers share snapshots through KUBOT_METRICS_DIR, which must
+# belong to this deployment alone and be cleared on startup; "" reports each worker on its own.
+KUBOT_METRICS_DIR = os.getenv("KUBOT_METRICS_DIR", "")
+KUBOT_METRICS_FLUSH_INTERVAL = float(os.getenv("KUBOT_METRICS_FLUSH_INTERVAL", "5.0"))  # seconds
+KUBOT_METRICS_TOKEN = os.getenv("KUBOT_METRICS_TOKEN", "")  # Bearer token for scrapers; admins can always read /metrics
+
 # CORS SETTINGS (Production)
 CORS_ALLOW_ALL_ORIGINS = True
 
@@ -153,6 +229,13 @@ CORS_ALLOW_HEADERS = [
     'X-Requested-With',
 ]
 
+# Let the mini app read the next-page link and cache validators
+CORS_EXPOSE_HEADERS = [
+    'Link',
+    'ETag',
+    'Last-Modified',
+]
+
 
 
 # Internationalization
@@ -1,8 +1,15 @@
 from django.contrib import admin
-from .models import Task, UserTask, Reward, Referral, Wallet
+from .models import Task, UserTask, Reward, Referral, Wallet, LedgerEntry, MiningSession, MiningReward, MediaCache, MiningPayout, ReferralPath, RewardRollup
 
 admin.site.register(Task)
 admin.site.register(UserTask)
 admin.site.register(Reward)
 admin.site.register(Referral)
 admin.site.register(Wallet)
+admin.site.register(LedgerEntry)
+admin.site.register(MiningSession)
+admin.site.register(MiningReward)
+admin.site.register(MediaCache)
+admin.site.register(MiningPayout)
+admin.site.register(ReferralPath)
+admin.site.register(RewardRollup)
@@ -1,19 +1,36 @@
+import math
+
 from rest_framework import generics, status
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.views import APIView
+from django.conf import settings
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from cloudinary.exceptions import Error
-from .models import Task, UserTask, Reward, Referral, Wallet
-from .serializers import WalletCreateSerializer, TaskSerializer, UserTaskSerializer, RewardSerializer, ReferralSerializer, WalletSerializer
+from . import catalog, completion, export, leaderboard, ledger, projections, referrals, rollups
+from .models import Task, UserTask, Reward, Referral, Wallet, LedgerEntry
+from .pagination import KeysetPagination
+from .streaming import stream_json, streaming_response, wants_stream
+from .serializers import (
+    WalletCreateSerializer, TaskSerializer, UserTaskSerializer, WalletSerializer,
+    BatchCompleteTaskSerializer,
+)
 
 # ✅ List and Create Tasks
 class TaskListCreateView(generics.ListCreateAPIView):
     """
     API endpoint to list all tasks and create new tasks.
 
-    GET: Retrieve a list of all available tasks.
+    GET: Retrieve a page of available tasks, ordered by id.
     POST: Create a new task.
 
+    Pagination:
+    - The body is a bare array of tasks, as before pagination existed.
+    - `limit` sets the page size; the following page is linked from the
+      `Link: <url>; rel="next"` response header (absent on the last page).
+
     Permissions:
     - Allows any user.
     """
@@ -21,6 +38,39 @@ class TaskListCreateView(generics.ListCreateAPIView):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
     permission_classes = [AllowAny]
+    pagination_class = KeysetPagination
+
+    def list(self, request, *args, **kwargs):
+        """
+        Serve catalog pages from the versioned cache.
+
+        Responses carry an ETag and Last-Modified for the current catalog
+        version, so clients revalidating an unchanged catalog get a 304.
+        """
+
+        paginator = self.paginator
+        version = catalog.get_version()
+        page_key = catalog.page_key(
+            request.query_params.get(paginator.cursor_query_param), paginator.get_page_size(request)
+        )
+        etag = catalog.etag_for(version, page_key)
+        # HTTP dates have one-second resolution; a fractional timestamp never compares equal.
+        last_modified = int(version["updated_at"].timestamp())
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            def build():
+                page = paginator.paginate_queryset(self.get_queryset(), request, view=self)
+                return {"data": self.get_serializer(page, many=True).data, "next": paginator.next_position}
+
+            page = catalog.get_or_build_page(version, page_key, build)
+            paginator.request = request
+            paginator.next_position = page["next"]
+            response = paginator.get_paginated_response(page["data"])
+
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        return response
     
 
 # ✅ Complete a Task
@@ -30,7 +80,7 @@ class GetCompleteTaskView(APIView):
     """
     API endpoint for getting completed tasks for user.
 
-    GET: Retrieve completed tasks based on `user_id` (query parameter).
+    GET: Retrieve a page of completed tasks based on `user_id`, oldest first.
 
     Permissions:
     - Allows any user.
@@ -43,12 +93,15 @@ class GetCompleteTaskView(APIView):
         """Retrieve completed tasks based on user_id from query parameters."""
         
         try:
-            data = UserTask.objects.filter(user_id=user_id)
-            serializer = UserTaskSerializer(data, many=True)
+            paginator = KeysetPagination(ordering=("completed_at", "id"))
+            data = paginator.paginate_queryset(
+                projections.user_tasks.values(UserTask.objects.filter(user_id=user_id)), request
+            )
             if user_id:
                 return Response({
                         "message": "User completed task fetched successfully",
-                        "data": serializer.data,
+                        "data": projections.user_tasks.project(data),
+                        "next": paginator.get_next_link(),
                     })
         except Error as e:    
             return Response({
@@ -136,22 +189,13 @@ class CompleteTaskView(APIView):
         task_id = kwargs.get("task_id")  # Retrieve task_id from kwargs
 
         try:
-            task = Task.objects.get(id=task_id)
-        except Task.DoesNotExist:
+            user_task, reward = completion.complete_task(user_id, task_id)
+        except completion.TaskNotFound:
             return Response({"error": "Task not found."}, status=status.HTTP_404_NOT_FOUND)
-
-        if UserTask.objects.filter(user_id=user_id, task=task).exists():
+        except completion.TaskAlreadyCompleted:
             return Response({"error": "User has already completed this task."}, status=status.HTTP_400_BAD_REQUEST)
-
-        try:
-            user_task = UserTask.objects.create(user_id=user_id, task=task, reward_claimed=True)
-            reward = Reward.objects.create(user_id=user_id, task=task, amount=task.reward_amount)
-
-            return Response({
-                "message": f"Task '{task.title}' completed! You earned {task.reward_amount} tokens.",
-                "task": UserTaskSerializer(user_task).data,
-                "reward": reward.amount
-            }, status=status.HTTP_201_CREATED)
+        except completion.WalletNotFound:
+            return Response({"error": "Wallet not found."}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({
                 "message": f"Error: {str(e)}",
@@ -159,14 +203,77 @@ class CompleteTaskView(APIView):
                 "reward": None
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        return Response({
+            "message": f"Task '{user_task.task.title}' completed! You earned {reward.amount} tokens.",
+            "task": UserTaskSerializer(user_task).data,
+            "reward": reward.amount
+        }, status=status.HTTP_201_CREATED)
+
         
         
+# ✅ Complete several Tasks at once
+class BatchCompleteTaskView(APIView):
+    """
+    API endpoint for users to complete several tasks in one request.
+
+    POST: Complete every task in `task_ids` (request body) for `user_id` (URL).
+
+    Validations:
+    - Same rules as CompleteTaskView, applied per task.
+    - At most 100 task ids per request.
+
+    Response:
+    - `results`: one entry per task id with `status` set to `completed`,
+      `already_completed` or `not_found`; completed entries also carry the
+      `task` (UserTaskSerializer) and its `reward`.
+    - `total_reward`: sum of the rewards granted by this request.
+
+    Permissions:
+    - Allows any user.
+    """
+    serializer_class = BatchCompleteTaskSerializer
+    permission_classes = [AllowAny]
+
+    def post(self, request, user_id):
+        """Completes the given task ids for user_id in a single transaction."""
+
+        serializer = BatchCompleteTaskSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({
+                "message": "Invalid data provided.",
+                "errors": serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            completed = completion.complete_tasks(user_id, serializer.validated_data["task_ids"])
+        except completion.WalletNotFound:
+            return Response({"error": "Wallet not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        results = []
+        total_reward = 0
+        for task_id, task_status, user_task, reward in completed:
+            result = {"task_id": task_id, "status": task_status}
+            if task_status == completion.COMPLETED:
+                result["task"] = UserTaskSerializer(user_task).data
+                result["reward"] = reward.amount
+                total_reward += reward.amount
+            results.append(result)
+
+        completed_count = sum(1 for result in results if result["status"] == completion.COMPLETED)
+        return Response({
+            "message": f"{completed_count} task(s) completed! You earned {total_reward} tokens.",
+            "results": results,
+            "total_reward": total_reward
+        }, status=status.HTTP_201_CREATED if completed_count else status.HTTP_200_OK)
+
+
 # ✅ View Rewards
 class RewardListView(APIView):
     """
     API endpoint to retrieve a user's reward list.
 
-    GET: Fetch all rewards associated with the provided `username`.
+    GET: Fetch a page of rewards for the provided `username`, oldest first.
+    With ``?stream=1``, stream all of them instead of a page.
 
     Permissions:
     - Allows any user.
@@ -177,13 +284,45 @@ class RewardListView(APIView):
     def get(self, request, username):
         """Retrieve rewards based on the username."""
         
-        reward = Reward.objects.filter(user__user=username)
-        serializer = RewardSerializer(reward, many=True)
+        rewards = Reward.objects.filter(user__user=username)
+        if wants_stream(request):
+            return stream_json(
+                request, {"data": None, "next": None}, rewards.order_by("created_at", "id"), projections.rewards
+            )
+
+        paginator = KeysetPagination(ordering=("created_at", "id"))
+        reward = paginator.paginate_queryset(projections.rewards.values(rewards), request)
         return Response(
             {
-                "data": serializer.data
+                "data": projections.rewards.project(reward),
+                "next": paginator.get_next_link(),
             }
         )
+
+
+# ✅ Reward summary
+class RewardSummaryView(APIView):
+    """
+    API endpoint to retrieve a user's reward totals.
+
+    GET: Return the total and number of rewards of `username`, the total per
+    task type and the time of the last reward, from the user's reward rollups.
+
+    Permissions:
+    - Allows any user.
+    """
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, username):
+        """Retrieve the reward summary for a username."""
+
+        summary = rollups.get_summary(username)
+        if summary is None:
+            return Response({"error": "Wallet not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"message": "Reward summary fetched", "data": summary})
+
+
 #    {
 # "user":"brendan2",
 # "eth_address":"0x2d122fEF1613e82C0C90f443b59E54468e16525C",
@@ -197,7 +336,8 @@ class ReferralRegisterView(APIView):
     """
     API endpoint to manage user referrals.
 
-    GET: Retrieve all referrals associated with a `referral_id`.
+    GET: Retrieve a page of referrals associated with a `referral_id`
+    (``?stream=1`` streams all of them).
     POST: Register a new referral using `referral_id`.
 
     Validations:
@@ -214,13 +354,22 @@ class ReferralRegisterView(APIView):
     def get(self, request, referral_id):
         """Retrieve all referrals for a given referral_id."""
         
-        referrals = Referral.objects.filter(referral_id=referral_id)
-        serializer = ReferralSerializer(referrals, many=True)
+        referrals_for_id = Referral.objects.filter(referral_id=referral_id)
+        if wants_stream(request):
+            return stream_json(
+                request, {"success": False, "message": "User Referrals fetched", "data": None, "next": None},
+                referrals_for_id.order_by("created_at", "id"), projections.referrals,
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        paginator = KeysetPagination(ordering=("created_at", "id"))
+        referral_page = paginator.paginate_queryset(projections.referrals.values(referrals_for_id), request)
         
         return Response({
                 "success": False,
                 "message": "User Referrals fetched",
-                "data": serializer.data
+                "data": projections.referrals.project(referral_page),
+                "next": paginator.get_next_link(),
             }, status=status.HTTP_400_BAD_REQUEST)
         
     def post(self, request, referral_id):
@@ -256,15 +405,12 @@ class ReferralRegisterView(APIView):
 
         # Create the referral
         try:
-            # Save serializer data
-            new_wallet=serializer.save()
-            new_referral = Referral.objects.create(referrer=referred_user, referred_user=new_wallet)
-            new_referral.referral_id=referral_id
-            new_referral.save()
+            with transaction.atomic():
+                # Save serializer data
+                new_wallet=serializer.save()
 
-            # Update balance
-            referred_user.balance += 5
-            referred_user.save()
+                # Referral, referral tree and upline bonuses
+                referrals.register_referral(referred_user, new_wallet, referral_id)
 
             return Response({
                 "success": True,
@@ -278,6 +424,121 @@ class ReferralRegisterView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
 
+# ✅ Referral team size
+class ReferralTeamView(APIView):
+    """
+    API endpoint to retrieve the size of a user's referral team.
+
+    GET: Return how many wallets `username` referred directly (level 1), how
+    many those referred (level 2), and so on, plus the total.
+
+    Permissions:
+    - Allows any user.
+    """
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, username):
+        """Retrieve the team size per level for a username."""
+
+        try:
+            wallet_id = Wallet.objects.values_list("id", flat=True).get(user=username)
+        except Wallet.DoesNotExist:
+            return Response({"error": "Wallet not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        levels = referrals.get_team_size(wallet_id)
+        return Response({
+            "message": "Referral team fetched",
+            "data": {
+                "total": sum(levels.values()),
+                "levels": {str(depth): count for depth, count in levels.items()},
+            }
+        })
+
+
+# ✅ Leaderboards
+class LeaderboardView(APIView):
+    """
+    API endpoint for the balance and referral leaderboards.
+
+    GET: Return the top wallets of `board` (``balance`` or ``referrals``).
+    Query parameters:
+    - `limit`: number of entries, 10 by default and capped at
+      ``KUBOT_LEADERBOARD_MAX_LIMIT``.
+    - `username`: also return that user's own rank and score as `me`.
+
+    Permissions:
+    - Allows any user.
+    """
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, board):
+        """Retrieve the top of a leaderboard and, optionally, a user's rank."""
+
+        if board not in leaderboard.boards:
+            return Response({"error": "Leaderboard not found."}, status=status.HTTP_404_NOT_FOUND)
+        ranking = leaderboard.boards[board]
+
+        try:
+            limit = int(request.query_params.get("limit", 10))
+        except ValueError:
+            return Response({"error": "Invalid limit."}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, settings.KUBOT_LEADERBOARD_MAX_LIMIT))
+
+        me = None
+        username = request.query_params.get("username")
+        if username is not None:
+            try:
+                wallet_id = Wallet.objects.values_list("id", flat=True).get(user=username)
+            except Wallet.DoesNotExist:
+                return Response({"error": "Wallet not found."}, status=status.HTTP_404_NOT_FOUND)
+            rank, score = ranking.rank(wallet_id)
+            me = {"rank": rank, "user": username, "score": score}
+
+        return Response({
+            "message": "Leaderboard fetched",
+            "data": {"board": board, "top": ranking.top(limit), "me": me},
+        })
+
+
+# ✅ Bulk export
+class ExportView(APIView):
+    """
+    API endpoint streaming a full export of wallets, rewards, user_tasks or
+    referrals.
+
+    GET: Stream every row of `name` in id order, as CSV (default) or JSONL.
+    Query parameters:
+    - `output`: ``csv`` or ``jsonl``.
+    - `since` / `until`: ISO date or datetime range on the rows' timestamp
+      (not for wallets).
+
+    Permissions:
+    - Admin users only.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, name):
+        """Stream an export."""
+
+        if name not in export.EXPORTS:
+            return Response({"error": "Export not found."}, status=status.HTTP_404_NOT_FOUND)
+        output = request.query_params.get("output", "csv")
+        try:
+            since = export.parse_time(request.query_params.get("since"))
+            until = export.parse_time(request.query_params.get("until"))
+            chunks = export.iter_export(name, output, since, until)
+        except export.ExportError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return streaming_response(
+            request, chunks, export.CONTENT_TYPES[output],
+            headers={"Content-Disposition": f'attachment; filename="{name}.{output}"'},
+        )
+
+
 # ✅ Create new user
 class RegisterView(APIView):
     """
@@ -285,7 +546,8 @@ class RegisterView(APIView):
 
     Methods:
         get(request):
-            Retrieve all wallet records from the database.
+            Retrieve a page of wallet records, ordered by id, or all of
+            them streamed with ``?stream=1``.
 
         post(request):
             Create a new wallet for a user.
@@ -295,16 +557,24 @@ class RegisterView(APIView):
 
     def get(self, request):
         """
-        Retrieve a list of all wallet records.
+        Retrieve a page of wallet records.
         """
         
-        new_wallet = Wallet.objects.all()
-        serializer = WalletCreateSerializer(new_wallet, many=True)
+        if wants_stream(request):
+            return stream_json(
+                request, {"success": False, "message": "User Referrals fetched", "data": None, "next": None},
+                Wallet.objects.order_by("id"), projections.new_wallets, status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        paginator = KeysetPagination(ordering=("id",))
+        # "id" is not in the output, but the cursor needs it.
+        new_wallet = paginator.paginate_queryset(Wallet.objects.values("id", *projections.new_wallets.paths), request)
         
         return Response({
                 "success": False,
                 "message": "User Referrals fetched",
-                "data": serializer.data
+                "data": projections.new_wallets.project(new_wallet),
+                "next": paginator.get_next_link(),
             }, status=status.HTTP_400_BAD_REQUEST)
         
     def post(self, request):
@@ -355,11 +625,10 @@ class WalletDetailView(APIView):
         """Retrieve the wallet balance for a user."""
         
         try:
-            user = Wallet.objects.get(user=username)
-            serializer = WalletSerializer(user)
+            user = projections.wallets.values(Wallet.objects.filter(user=username)).get()
             return Response ({
                 "message": "success",
-                "data": serializer.data
+                "data": projections.wallets.project_one(user)
                 })
         except Error as e:
             return Response({
@@ -387,16 +656,18 @@ class WithdrawTokensView(APIView):
     def post(self, request, username):
         """Withdraw a specified amount of tokens from a wallet."""
         
-        wallet = Wallet.objects.get(user=username)
-        amount = float(request.data.get("amount"))
+        amount = _parse_amount(request.data.get("amount"))
+        if amount is None:
+            return Response({"error": "Invalid amount."}, status=status.HTTP_400_BAD_REQUEST)
 
-        if amount > wallet.balance:
+        try:
+            wallet_id = Wallet.objects.values_list("id", flat=True).get(user=username)
+            ledger.debit(wallet_id, amount, LedgerEntry.WITHDRAW)
+        except Wallet.DoesNotExist:
+            return Response({"error": "Wallet not found."}, status=status.HTTP_404_NOT_FOUND)
+        except ledger.InsufficientBalance:
             return Response({"error": "Insufficient balance."}, status=status.HTTP_400_BAD_REQUEST)
 
-        wallet.balance -= amount
-        wallet.save()
-        
-
         return Response({"message": f"{amount} tokens withdrawn to your account."})
     
     
@@ -416,15 +687,23 @@ class FundTokensView(APIView):
     def post(self, request, username):
         """Fund a wallet with a specified amount of tokens."""
         
-        wallet = Wallet.objects.get(user=username)
-        amount = float(request.data.get("amount"))
-            
+        amount = _parse_amount(request.data.get("amount"))
+        if amount is None:
+            return Response({"error": "Invalid amount."}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
-            wallet.balance += amount
-            wallet.save()
-        except Error as e:
-            return Response({"error": f"{e}"}, status=status.HTTP_400_BAD_REQUEST)
-            
-        
+            wallet_id = Wallet.objects.values_list("id", flat=True).get(user=username)
+            ledger.credit(wallet_id, amount, LedgerEntry.FUND)
+        except Wallet.DoesNotExist:
+            return Response({"error": "Wallet not found."}, status=status.HTTP_404_NOT_FOUND)
 
         return Response({"message": f"{amount} tokens funded to your account."})
+
+
+def _parse_amount(value):
+    """Return `value` as a positive, finite float, or None if it is not one."""
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        return None
+    return amount if math.isfinite(amount) and amount > 0 else None
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class KubotAiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'kubot_ai'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
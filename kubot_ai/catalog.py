@@ -0,0 +1,100 @@
+"""
+Versioned cache for the task catalog served by ``TaskListCreateView``.
+
+Pages of the serialized catalog are cached under the current catalog version.
+The version is replaced whenever a Task is saved or deleted (see
+``kubot_ai/signals.py``), which makes every cached page unreachable at once,
+so no explicit invalidation is needed. Changes made with ``QuerySet.update()``
+bypass the model signals and must call :func:`bump_version` themselves.
+
+Pages expire after ``KUBOT_CATALOG_CACHE_TTL`` seconds. The version does not
+expire: its token and ``updated_at`` become the ETag and Last-Modified of every
+page, so they must only change when a Task does, or conditional GETs would stop
+returning 304. The catalog therefore needs a cache shared by every worker (see
+``kubot_ai/checks.py``); with a process-local one, a worker keeps serving its
+own version until it restarts.
+"""
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+VERSION_KEY = "kubot:tasks:version"
+
+# How long a rebuild may hold the lock, and how long other requests wait on it.
+REBUILD_LOCK_TIMEOUT = 10
+REBUILD_WAIT = 2.0
+REBUILD_POLL_INTERVAL = 0.05
+
+
+def bump_version():
+    """Start a new catalog version and return it."""
+    version = {"token": uuid.uuid4().hex, "updated_at": timezone.now()}
+    cache.set(VERSION_KEY, version, timeout=None)
+    return version
+
+
+def get_version():
+    """
+    Return the current version as ``{"token", "updated_at"}``.
+
+    If there is none yet (or the cache evicted it), a new one is created with
+    ``cache.add`` so that concurrent workers agree on a single token.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = {"token": uuid.uuid4().hex, "updated_at": timezone.now()}
+        if not cache.add(VERSION_KEY, version, timeout=None):
+            version = cache.get(VERSION_KEY) or version
+    return version
+
+
+def page_key(cursor, limit):
+    """
+    Identify one page by the only parameters that select its rows.
+
+    Anything else in the query string (cache busters, tracking parameters)
+    must not fragment the cache.
+    """
+    return f"{cursor or ''}:{limit}"
+
+
+def etag_for(version, page):
+    """Return a strong ETag for one page of one catalog version."""
+    digest = hashlib.md5(f"{version['token']}:{page}".encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def get_or_build_page(version, page, build):
+    """
+    Return the cached `page` (see :func:`page_key`), calling `build()` on a miss.
+
+    Concurrent misses for the same page are coalesced: the first request takes
+    a lock and rebuilds, the others wait for its result and only rebuild
+    themselves if it does not show up within ``REBUILD_WAIT`` seconds.
+    """
+    key = f"kubot:tasks:{version['token']}:{hashlib.md5(page.encode()).hexdigest()}"
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    lock_key = f"{key}:lock"
+    owns_lock = cache.add(lock_key, 1, timeout=REBUILD_LOCK_TIMEOUT)
+    if not owns_lock:
+        deadline = time.monotonic() + REBUILD_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(REBUILD_POLL_INTERVAL)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+    try:
+        cached = build()
+        cache.set(key, cached, timeout=settings.KUBOT_CATALOG_CACHE_TTL)
+    finally:
+        if owns_lock:
+            cache.delete(lock_key)
+    return cached
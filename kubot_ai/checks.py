@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+PROCESS_LOCAL_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+# ✅ Catalog versions and update dedup claims must be shared by every worker
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get("default", {}).get("BACKEND")
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [
+        Warning(
+            f"The default cache ({backend}) is local to each process.",
+            hint=(
+                "With more than one worker, task catalog pages go stale and redelivered "
+                "Telegram updates are processed twice. Use the database cache, Redis or Memcached."
+            ),
+            id="kubot_ai.W001",
+        )
+    ]
+
+
+# ✅ Without a secret anyone can post updates (and pre-claim update ids)
+@register()
+def check_webhook_secret(app_configs, **kwargs):
+    if not settings.TELEGRAM_BOT_TOKEN or settings.TELEGRAM_WEBHOOK_SECRET:
+        return []
+    return [
+        Warning(
+            "TELEGRAM_WEBHOOK_SECRET is not set, so the Telegram webhook accepts updates from anyone.",
+            hint="Set it and register it with `python manage.py set_webhook <url>`. Until then, forged "
+                 "calls can also claim update ids before Telegram delivers them, and those updates are dropped.",
+            id="kubot_ai.W002",
+        )
+    ]
@@ -0,0 +1,159 @@
+"""
+Task completion for Kubot wallets.
+
+A completion is one ``UserTask`` row plus one ``Reward`` row, written in a
+single transaction. The unique constraint on ``(user, task)`` is what stops a
+task from being completed twice: the ``UserTask`` insert is done first with
+``ON CONFLICT DO NOTHING``, so a duplicate tap costs one index probe and never
+reaches the reward insert, even when two taps race. The user's reward rollup
+(``kubot_ai.rollups``) is updated in the same transaction.
+"""
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from . import rollups
+from .models import Reward, Task, UserTask
+
+
+COMPLETED = "completed"
+ALREADY_COMPLETED = "already_completed"
+NOT_FOUND = "not_found"
+
+
+class TaskNotFound(Exception):
+    """Raised when the task being completed does not exist."""
+
+
+class TaskAlreadyCompleted(Exception):
+    """Raised when the user has already completed the task."""
+
+
+class WalletNotFound(Exception):
+    """Raised when the completing user has no wallet."""
+
+
+def complete_task(user_id, task_id):
+    """
+    Complete `task_id` for `user_id` and grant its reward.
+
+    Returns the ``(user_task, reward)`` pair. Raises TaskNotFound,
+    TaskAlreadyCompleted or WalletNotFound.
+    """
+
+    completed_at = timezone.now()
+    try:
+        with transaction.atomic():
+            user_task_id = _insert_user_tasks(user_id, [task_id], completed_at).get(task_id)
+            if user_task_id is None:
+                raise TaskAlreadyCompleted(f"User {user_id} has already completed task {task_id}.")
+
+            try:
+                task = Task.objects.get(pk=task_id)
+            except Task.DoesNotExist:
+                raise TaskNotFound(f"Task {task_id} does not exist.")
+
+            reward = Reward.objects.create(user_id=user_id, task=task, amount=task.reward_amount)
+            rollups.record_rewards(user_id, [reward])
+    except IntegrityError:
+        # Foreign keys are checked at commit (or at insert on MySQL), so this is a missing wallet or task.
+        if not Task.objects.filter(pk=task_id).exists():
+            raise TaskNotFound(f"Task {task_id} does not exist.")
+        raise WalletNotFound(f"Wallet {user_id} does not exist.")
+
+    user_task = UserTask(id=user_task_id, user_id=user_id, task=task, completed_at=completed_at, reward_claimed=True)
+    return user_task, reward
+
+
+def complete_tasks(user_id, task_ids):
+    """
+    Complete several tasks for `user_id` in one transaction.
+
+    Returns a list of ``(task_id, status, user_task, reward)`` tuples in the
+    order the ids were given (duplicates dropped), where status is one of
+    COMPLETED, ALREADY_COMPLETED or NOT_FOUND and user_task/reward are only
+    set for COMPLETED. Raises WalletNotFound.
+    """
+
+    task_ids = list(dict.fromkeys(task_ids))
+    completed_at = timezone.now()
+    try:
+        with transaction.atomic():
+            tasks = Task.objects.in_bulk(task_ids)
+            inserted = _insert_user_tasks(user_id, [task_id for task_id in task_ids if task_id in tasks], completed_at)
+            rewards = Reward.objects.bulk_create(
+                Reward(user_id=user_id, task=tasks[task_id], amount=tasks[task_id].reward_amount)
+                for task_id in task_ids if task_id in inserted
+            )
+            rollups.record_rewards(user_id, rewards)
+    except IntegrityError:
+        raise WalletNotFound(f"Wallet {user_id} does not exist.")
+
+    rewards_by_task = {reward.task_id: reward for reward in rewards}
+    results = []
+    for task_id in task_ids:
+        if task_id not in tasks:
+            results.append((task_id, NOT_FOUND, None, None))
+        elif task_id not in inserted:
+            results.append((task_id, ALREADY_COMPLETED, None, None))
+        else:
+            user_task = UserTask(
+                id=inserted[task_id], user_id=user_id, task=tasks[task_id],
+                completed_at=completed_at, reward_claimed=True,
+            )
+            results.append((task_id, COMPLETED, user_task, rewards_by_task[task_id]))
+    return results
+
+
+def _insert_user_tasks(user_id, task_ids, completed_at):
+    """
+    Insert UserTask rows for `task_ids` unless they exist.
+
+    Returns ``{task_id: user_task_id}`` for the rows actually inserted.
+    """
+
+    if not task_ids:
+        return {}
+
+    if not connection.features.can_return_columns_from_insert:
+        return _insert_user_tasks_one_by_one(user_id, task_ids, completed_at)
+
+    qn = connection.ops.quote_name
+    completed_at_param = UserTask._meta.get_field("completed_at").get_db_prep_value(completed_at, connection)
+    sql = (
+        f"INSERT INTO {qn(UserTask._meta.db_table)} "
+        f"({qn('user_id')}, {qn('task_id')}, {qn('completed_at')}, {qn('reward_claimed')}) "
+        f"VALUES {', '.join(['(%s, %s, %s, %s)'] * len(task_ids))} "
+        f"ON CONFLICT ({qn('user_id')}, {qn('task_id')}) DO NOTHING "
+        f"RETURNING {qn('task_id')}, {qn('id')}"
+    )
+    params = []
+    for task_id in task_ids:
+        params += [user_id, task_id, completed_at_param, True]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return dict(cursor.fetchall())
+
+
+def _insert_user_tasks_one_by_one(user_id, task_ids, completed_at):
+    """
+    Fallback for backends without INSERT ... RETURNING (MySQL).
+
+    Each row is inserted in its own savepoint so that a conflict only rolls
+    back that row. The unique constraint decides who wins a race; there is no
+    read-then-write window.
+    """
+
+    inserted = {}
+    for task_id in task_ids:
+        try:
+            with transaction.atomic():
+                user_task = UserTask.objects.create(
+                    user_id=user_id, task_id=task_id, completed_at=completed_at, reward_claimed=True
+                )
+        except IntegrityError:
+            # Backends with immediate foreign key checks fail here for a missing wallet or task too.
+            if not UserTask.objects.filter(user_id=user_id, task_id=task_id).exists():
+                raise
+            continue
+        inserted[task_id] = user_task.pk
+    return inserted
@@ -0,0 +1,137 @@
+"""
+Crediting task rewards to wallet balances.
+
+Completing a task only inserts a ``Reward`` row; ``credited_at`` stays NULL,
+which makes the row an outbox entry. :class:`RewardCreditor` picks up pending
+rewards in id order, in batches, and for each batch in one transaction
+
+- marks the rows credited (guarded on ``credited_at IS NULL``, so a row
+  claimed by another consumer rolls the whole batch back), and
+- credits each wallet in the batch once through ``kubot_ai.ledger``, with the
+  sum of its rewards.
+
+A reward is therefore credited exactly once: marking it and crediting it
+commit or roll back together, and the mark is the checkpoint. A task tap
+never touches the wallet row, and a busy wallet gets one UPDATE per batch
+instead of one per reward.
+
+Every worker runs a creditor on its event loop; ``manage.py credit_rewards``
+runs one on its own.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import ledger
+from .models import LedgerEntry, Reward
+
+logger = logging.getLogger(__name__)
+
+
+class BatchClaimedElsewhere(Exception):
+    """Raised inside the batch transaction when another consumer credited some of its rows."""
+
+
+class RewardCreditor:
+    """Credits pending rewards to wallets in batches."""
+
+    def __init__(self, poll_interval=None, batch_size=None):
+        self.poll_interval = poll_interval if poll_interval is not None else settings.KUBOT_CREDIT_POLL_INTERVAL
+        self.batch_size = batch_size if batch_size is not None else settings.KUBOT_CREDIT_BATCH_SIZE
+        self._task = None
+
+        self.credited = 0
+        self.batches = 0
+        self.conflicts = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+
+    def credit_batch(self):
+        """Credit one batch of pending rewards. Returns how many were credited."""
+        started = time.monotonic()
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                pending = Reward.objects.filter(credited_at__isnull=True).order_by("id")
+                if connection.features.has_select_for_update_skip_locked:
+                    pending = pending.select_for_update(skip_locked=True)
+                rows = list(pending.values_list("id", "user_id", "amount", "created_at")[: self.batch_size])
+                if not rows:
+                    return 0
+
+                ids = [reward_id for reward_id, _, _, _ in rows]
+                marked = Reward.objects.filter(id__in=ids, credited_at__isnull=True).update(credited_at=now)
+                if marked != len(rows):
+                    raise BatchClaimedElsewhere()
+
+                totals = defaultdict(int)
+                for _, user_id, amount, _ in rows:
+                    totals[user_id] += amount
+                for user_id, total in sorted(totals.items()):
+                    if total > 0:
+                        ledger.credit(user_id, total, LedgerEntry.TASK_REWARD, reference=f"rewards:{ids[0]}-{ids[-1]}")
+        except BatchClaimedElsewhere:
+            self.conflicts += 1
+            return 0
+
+        self.batches += 1
+        self.credited += len(rows)
+        self.busy_time += time.monotonic() - started
+        self.lag_last = (now - min(created_at for _, _, _, created_at in rows)).total_seconds()
+        self.lag_max = max(self.lag_max, self.lag_last)
+        return len(rows)
+
+    def credit_pending(self):
+        """Credit batches until nothing is pending. Returns how many rewards were credited."""
+        total = 0
+        while credited := self.credit_batch():
+            total += credited
+        return total
+
+    async def run(self):
+        """Credit pending rewards until cancelled."""
+        logger.info("💰 Reward creditor started")
+        while True:
+            try:
+                credited = await sync_to_async(self.credit_batch, thread_sensitive=True)()
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Crediting rewards failed: {e}")
+                credited = 0
+            # A full batch means more are waiting.
+            if credited < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        """Start crediting on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        """Stop crediting. Pending rewards stay pending for the next start."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self):
+        """Return a snapshot of the creditor's counters."""
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "credited": self.credited,
+            "batches": self.batches,
+            "conflicts": self.conflicts,
+            "failed": self.failed,
+            "throughput": self.credited / self.busy_time if self.busy_time else 0.0,
+            "lag_last": self.lag_last,
+            "lag_max": self.lag_max,
+        }
@@ -0,0 +1,79 @@
+"""
+Deduplication of Telegram updates by ``update_id``.
+
+Telegram redelivers an update until the webhook answers 200, so the same
+update can reach us several times, possibly on different workers. Each worker
+keeps a small time-windowed LRU of recently seen ids, which answers most
+repeats without any I/O, and falls back to ``cache.add`` on the shared cache,
+which is atomic across workers when the cache backend is shared (the default
+database cache is; locmem is flagged by the kubot_ai.W001 check).
+
+An id only enters the local LRU once this worker owns its shared claim, so
+a worker that lost the claim still lets the redelivery through if the owner
+releases it with :meth:`UpdateDeduplicator.forget`.
+
+``TelegramWebhookView`` checks the webhook secret, when one is configured,
+before claiming ids. Without a secret anyone who can reach the webhook can
+claim ids ahead of Telegram (see the kubot_ai.W002 check).
+"""
+import re
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+# Telegram serializes update_id first, so most ids can be read without parsing the body.
+_UPDATE_ID_PREFIX = re.compile(rb'^\s*\{\s*"update_id"\s*:\s*(\d+)')
+
+
+def peek_update_id(body):
+    """Return the update_id at the start of a raw webhook body, or None."""
+    match = _UPDATE_ID_PREFIX.match(body)
+    return int(match.group(1)) if match else None
+
+
+class UpdateDeduplicator:
+    """Remembers update ids seen in the last `window` seconds."""
+
+    def __init__(self, window, max_local):
+        self.window = window
+        self.max_local = max_local
+        self._seen = OrderedDict()  # update_id -> expiry (monotonic seconds)
+        self.duplicates = 0
+
+    async def seen(self, update_id):
+        """Record `update_id` and return True if it was already seen."""
+
+        now = time.monotonic()
+        self._evict(now)
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+
+        if not await cache.aadd(self._key(update_id), 1, timeout=self.window):
+            self.duplicates += 1
+            return True
+
+        self._seen[update_id] = now + self.window
+        if len(self._seen) > self.max_local:
+            self._seen.popitem(last=False)
+        return False
+
+    def stats(self):
+        """Return a snapshot of the deduplication counters."""
+        return {"duplicates": self.duplicates, "local_size": len(self._seen), "window": self.window}
+
+    async def forget(self, update_id):
+        """Allow `update_id` to be processed again, e.g. after it was dropped."""
+        self._seen.pop(update_id, None)
+        await cache.adelete(self._key(update_id))
+
+    def _evict(self, now):
+        while self._seen:
+            update_id, expires_at = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            del self._seen[update_id]
+
+    def _key(self, update_id):
+        return f"kubot:tg-update:{update_id}"
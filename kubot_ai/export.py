@@ -0,0 +1,110 @@
+"""
+Bulk export of wallets, rewards, completed tasks and referrals.
+
+Rows are read with ``.values_list().iterator(chunk_size)``, which uses a
+server-side cursor on PostgreSQL, and written out one chunk at a time, so
+memory stays flat however big the table is. Used by the ``export_data``
+command and the admin-only ``ExportView``.
+
+On PostgreSQL the command writes CSV with ``COPY ... TO STDOUT`` instead, so
+the rows never pass through Python at all. Values are then in PostgreSQL's
+text format (``t``/``f`` booleans, ``+00`` offsets) rather than Python's.
+"""
+import csv
+import datetime
+import io
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Referral, Reward, UserTask, Wallet
+
+# name -> (model, exported fields, field the time range applies to)
+EXPORTS = {
+    "wallets": (Wallet, ("id", "user", "eth_address", "balance", "referral_id"), None),
+    "rewards": (Reward, ("id", "user_id", "task_id", "amount", "created_at", "credited_at"), "created_at"),
+    "user_tasks": (UserTask, ("id", "user_id", "task_id", "completed_at", "reward_claimed"), "completed_at"),
+    "referrals": (
+        Referral, ("id", "referrer_id", "referred_user_id", "referral_id", "reward_amount", "created_at"), "created_at",
+    ),
+}
+
+CONTENT_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+class ExportError(ValueError):
+    """Raised for an unknown export, format or time range."""
+
+
+def parse_time(value):
+    """Parse an ISO 8601 date or datetime; naive values are in the current time zone."""
+    if value is None:
+        return None
+    try:
+        parsed = parse_datetime(value) or parse_date(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ExportError(f"Invalid date or time: {value!r}.")
+    if not isinstance(parsed, datetime.datetime):
+        parsed = datetime.datetime.combine(parsed, datetime.time())
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+
+def get_rows(name, since=None, until=None):
+    """Return ``(queryset of value tuples, field names)`` for export `name`, in primary key order."""
+    if name not in EXPORTS:
+        raise ExportError(f"Unknown export {name!r}; choose from {', '.join(EXPORTS)}.")
+    model, fields, time_field = EXPORTS[name]
+
+    rows = model.objects.order_by("pk")
+    if since is not None or until is not None:
+        if time_field is None:
+            raise ExportError(f"{name} cannot be filtered by time.")
+        if since is not None:
+            rows = rows.filter(**{f"{time_field}__gte": since})
+        if until is not None:
+            rows = rows.filter(**{f"{time_field}__lt": until})
+    return rows.values_list(*fields), fields
+
+
+def iter_export(name, output="csv", since=None, until=None, chunk_size=2000):
+    """Yield export `name` as `output` ("csv" or "jsonl") text, one chunk of rows at a time."""
+    if output not in CONTENT_TYPES:
+        raise ExportError(f"Unknown format {output!r}; choose from {', '.join(CONTENT_TYPES)}.")
+    rows, fields = get_rows(name, since, until)
+    return _chunks(rows.iterator(chunk_size=chunk_size), fields, output, chunk_size)
+
+
+def copy_csv(name, out, since=None, until=None):
+    """Write export `name` as CSV to the file `out` with PostgreSQL's COPY."""
+    rows, _ = get_rows(name, since, until)
+    sql, params = rows.query.sql_with_params()
+    with connection.cursor() as cursor:
+        query = cursor.mogrify(sql, params).decode()
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+
+
+def _chunks(rows, fields, output, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n") if output == "csv" else None
+    if writer:
+        writer.writerow(fields)
+
+    count = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder))
+            buffer.write("\n")
+        count += 1
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
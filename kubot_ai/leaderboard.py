@@ -0,0 +1,314 @@
+"""
+Leaderboards for wallet balances and referral counts.
+
+Each worker keeps a :class:`RankIndex` per board: every wallet's score in a
+sorted structure that answers "how many wallets score higher than x" in
+O(log n). Boards are
+
+- updated incrementally after commit by the code that changes scores
+  (``kubot_ai.ledger`` for balances, ``kubot_ai.referrals`` for referrals);
+- rebuilt from ``Wallet.balance`` / the ``Referral`` table every
+  ``KUBOT_LEADERBOARD_REBUILD_INTERVAL`` seconds, which also picks up the
+  changes made by other workers and anything written around the ledger.
+  Rebuilds run on a background thread, started by the first request that
+  finds the index stale; requests keep using the previous index meanwhile,
+  and before the first rebuild finishes they are answered by the database.
+  Changes that commit during a rebuild are replayed onto the new index.
+
+Top-N pages are cached in the shared cache for ``KUBOT_LEADERBOARD_TOP_TTL``
+seconds. A user's own rank uses their current score from the database and the
+index for everyone else, so it is never behind on their own changes.
+"""
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+
+from .models import Referral, Wallet
+
+logger = logging.getLogger(__name__)
+
+
+class RankIndex:
+    """
+    Sorted multiset of keys with O(log n) position lookups.
+
+    Keys live in sorted blocks of about `load` items; a Fenwick tree over the
+    block sizes gives the number of keys before any block in O(log n).
+    """
+
+    load = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self._blocks = [keys[i:i + self.load] for i in range(0, len(keys), self.load)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._len = len(keys)
+        self._build_tree()
+
+    def __len__(self):
+        return self._len
+
+    def add(self, key):
+        self._len += 1
+        if not self._blocks:
+            self._blocks, self._maxes = [[key]], [key]
+            self._build_tree()
+            return
+        i = min(bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[i]
+        insort(block, key)
+        self._maxes[i] = block[-1]
+        if len(block) > 2 * self.load:
+            self._blocks[i:i + 1] = [block[:self.load], block[self.load:]]
+            self._maxes[i:i + 1] = [block[self.load - 1], block[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(i, 1)
+
+    def remove(self, key):
+        i = bisect_left(self._maxes, key)
+        block = self._blocks[i] if i < len(self._blocks) else []
+        j = bisect_left(block, key)
+        if j == len(block) or block[j] != key:
+            raise KeyError(key)
+        del block[j]
+        self._len -= 1
+        if block:
+            self._maxes[i] = block[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._blocks[i], self._maxes[i]
+            self._build_tree()
+
+    def index(self, key):
+        """Return the number of keys smaller than `key`."""
+        i = bisect_left(self._maxes, key)
+        if i == len(self._blocks):
+            return self._len
+        return self._prefix(i) + bisect_left(self._blocks[i], key)
+
+    def head(self, n):
+        """Return the `n` smallest keys."""
+        keys = []
+        for block in self._blocks:
+            keys.extend(block[:n - len(keys)])
+            if len(keys) >= n:
+                break
+        return keys
+
+    def _build_tree(self):
+        self._tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks):
+            self._tree_add(i, len(block))
+
+    def _tree_add(self, i, delta):
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i):
+        """Sum of the sizes of blocks [0, i)."""
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+class Leaderboard:
+    """One ranking of wallets by score, highest first."""
+
+    def __init__(self, name, load_scores, load_score, load_top, count_above):
+        self.name = name
+        self._load_scores = load_scores  # () -> iterable of (wallet_id, score)
+        self._load_score = load_score  # (wallet_id) -> current score
+        self._load_top = load_top  # (n) -> best n (wallet_id, score), until the first rebuild
+        self._count_above = count_above  # (score) -> wallets scoring higher, until the first rebuild
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._scores = {}
+        self._index = RankIndex()
+        self._built_at = None
+        self._pending = None  # (wallet_id, delta) committed while a rebuild loads scores
+
+        self.rebuilds = 0
+        self.updates = 0
+
+    def rebuild(self):
+        """
+        Reload every score from the database.
+
+        Changes passed to :meth:`adjust` while the scores load are replayed onto
+        the new index. One that commits just as the load query starts can be
+        counted twice until the next rebuild.
+        """
+        started = time.monotonic()
+        with self._lock:
+            self._pending = []
+        try:
+            scores = {wallet_id: score for wallet_id, score in self._load_scores() if score}
+            index = RankIndex((-score, wallet_id) for wallet_id, score in scores.items())
+            with self._lock:
+                self._scores, self._index, self._built_at = scores, index, time.monotonic()
+                for wallet_id, delta in self._pending:
+                    self._set(wallet_id, self._scores.get(wallet_id, 0) + delta)
+        finally:
+            with self._lock:
+                self._pending = None
+        self.rebuilds += 1
+        logger.info(f"🏆 Rebuilt {self.name} leaderboard: {len(scores)} wallets in {time.monotonic() - started:.2f}s")
+
+    def adjust(self, wallet_id, delta):
+        """Apply a committed score change of `delta` for `wallet_id`."""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((wallet_id, delta))
+            if self._built_at is None:
+                return  # The first rebuild reads it from the database.
+            self._set(wallet_id, self._scores.get(wallet_id, 0) + delta)
+            self.updates += 1
+
+    def rank(self, wallet_id):
+        """Return ``(rank, score)`` for `wallet_id`; wallets with equal scores share a rank."""
+        built = self._ensure_fresh()
+        score = self._load_score(wallet_id)
+        if not built:
+            return self._count_above(score) + 1, score
+        with self._lock:
+            # Our own score is read fresh; keep the index in step with it.
+            if score != self._scores.get(wallet_id, 0):
+                self._set(wallet_id, score)
+            return self._index.index((-score, -math.inf)) + 1, score
+
+    def top(self, n):
+        """
+        Return the best `n` as ``[{"rank", "user", "score"}]``.
+
+        Pages are cached in the shared cache, so workers share them and a page
+        costs one query per ``KUBOT_LEADERBOARD_TOP_TTL``.
+        """
+        key = f"kubot:leaderboard:{self.name}:top:{n}"
+        page = cache.get(key)
+        if page is None:
+            if self._ensure_fresh():
+                with self._lock:
+                    head = self._index.head(n)
+            else:
+                head = [(-score, wallet_id) for wallet_id, score in self._load_top(n)]
+            users = dict(Wallet.objects.filter(id__in=[wallet_id for _, wallet_id in head]).values_list("id", "user"))
+            page = []
+            for position, (negative_score, wallet_id) in enumerate(head):
+                if wallet_id not in users:
+                    continue  # Deleted since the last rebuild.
+                # Competition ranking: 1, 2, 2, 4
+                if page and page[-1]["score"] == -negative_score:
+                    rank = page[-1]["rank"]
+                else:
+                    rank = position + 1
+                page.append({"rank": rank, "user": users[wallet_id], "score": -negative_score})
+            cache.set(key, page, timeout=settings.KUBOT_LEADERBOARD_TOP_TTL)
+        return page
+
+    def stats(self):
+        return {
+            "wallets": len(self._scores),
+            "rebuilds": self.rebuilds,
+            "updates": self.updates,
+            "age": time.monotonic() - self._built_at if self._built_at is not None else None,
+        }
+
+    def _set(self, wallet_id, score):
+        old = self._scores.pop(wallet_id, 0)
+        if old:
+            self._index.remove((-old, wallet_id))
+        if score:
+            self._scores[wallet_id] = score
+            self._index.add((-score, wallet_id))
+
+    def _ensure_fresh(self):
+        """Start a rebuild if the index is missing or stale, and return whether there is one to use."""
+        built_at = self._built_at
+        if built_at is not None and time.monotonic() - built_at < settings.KUBOT_LEADERBOARD_REBUILD_INTERVAL:
+            return True
+        # One rebuild at a time; requests never wait for it.
+        if self._rebuild_lock.acquire(blocking=False):
+            self._start_rebuild()
+        return built_at is not None
+
+    def _start_rebuild(self):
+        threading.Thread(target=self._rebuild_and_release, name=f"leaderboard-{self.name}", daemon=True).start()
+
+    def _rebuild_and_release(self):
+        try:
+            self.rebuild()
+        except Exception as e:
+            logger.error(f"❌ Rebuilding the {self.name} leaderboard failed: {e}")
+        finally:
+            self._rebuild_lock.release()
+            connection.close()  # This thread's own connection
+
+
+def _balances():
+    return Wallet.objects.filter(balance__gt=0).values_list("id", "balance").iterator(chunk_size=10000)
+
+
+def _balance(wallet_id):
+    return Wallet.objects.filter(pk=wallet_id).values_list("balance", flat=True).first() or 0
+
+
+def _top_balances(n):
+    return Wallet.objects.filter(balance__gt=0).order_by("-balance", "id").values_list("id", "balance")[:n]
+
+
+def _count_balances_above(score):
+    return Wallet.objects.filter(balance__gt=score).count()
+
+
+def _referral_counts():
+    return (
+        Referral.objects.values_list("referrer_id").annotate(count=Count("id")).order_by()
+        .values_list("referrer_id", "count").iterator(chunk_size=10000)
+    )
+
+
+def _referral_count(wallet_id):
+    return Referral.objects.filter(referrer_id=wallet_id).count()
+
+
+def _referrers():
+    return Referral.objects.values("referrer_id").annotate(count=Count("id")).order_by()
+
+
+def _top_referrals(n):
+    return _referrers().order_by("-count", "referrer_id").values_list("referrer_id", "count")[:n]
+
+
+def _count_referrals_above(score):
+    return _referrers().filter(count__gt=score).count()
+
+
+BALANCE = "balance"
+REFERRALS = "referrals"
+
+boards = {
+    BALANCE: Leaderboard(BALANCE, _balances, _balance, _top_balances, _count_balances_above),
+    REFERRALS: Leaderboard(REFERRALS, _referral_counts, _referral_count, _top_referrals, _count_referrals_above),
+}
+
+
+def balance_changed(wallet_id, delta):
+    """Called by the ledger after a balance change commits."""
+    boards[BALANCE].adjust(wallet_id, delta)
+
+
+def referral_added(referrer_id):
+    """Called after a referral commits."""
+    boards[REFERRALS].adjust(referrer_id, 1)
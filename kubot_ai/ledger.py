@@ -0,0 +1,85 @@
+"""
+Balance ledger for Kubot wallets.
+
+Every change to ``Wallet.balance`` goes through :func:`credit`, :func:`debit`
+or, for many wallets at once, :func:`credit_many`.
+Each call applies the change as a single conditional UPDATE and appends an
+immutable ``LedgerEntry`` in the same transaction, so concurrent requests on
+the same wallet never lose updates and the ledger always sums to the balance.
+Committed changes are passed on to the balance leaderboard.
+"""
+import math
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Value, When
+
+from . import leaderboard
+from .models import LedgerEntry, Wallet
+
+
+class InsufficientBalance(Exception):
+    """Raised when a debit would take a wallet below zero."""
+
+
+def credit(wallet_id, amount, kind, reference=""):
+    """Add `amount` tokens to a wallet and record the ledger entry."""
+
+    if not math.isfinite(amount) or amount <= 0:
+        raise ValueError("Credit amount must be positive and finite.")
+
+    with transaction.atomic():
+        updated = Wallet.objects.filter(pk=wallet_id).update(balance=F("balance") + amount)
+        if not updated:
+            raise Wallet.DoesNotExist(f"Wallet {wallet_id} does not exist.")
+        transaction.on_commit(partial(leaderboard.balance_changed, wallet_id, amount))
+        return LedgerEntry.objects.create(wallet_id=wallet_id, amount=amount, kind=kind, reference=reference)
+
+
+def credit_many(amounts, kind, reference=""):
+    """
+    Credit ``{wallet_id: amount}`` with one UPDATE and one bulk INSERT.
+
+    All wallets must exist; otherwise nothing is credited and
+    Wallet.DoesNotExist is raised.
+    """
+
+    for amount in amounts.values():
+        if not math.isfinite(amount) or amount <= 0:
+            raise ValueError("Credit amount must be positive and finite.")
+    if not amounts:
+        return []
+
+    with transaction.atomic():
+        delta = Case(*[When(pk=wallet_id, then=Value(amount)) for wallet_id, amount in amounts.items()],
+                     output_field=FloatField())
+        updated = Wallet.objects.filter(pk__in=amounts).update(balance=F("balance") + delta)
+        if updated != len(amounts):
+            raise Wallet.DoesNotExist(f"{len(amounts) - updated} of the wallets to credit do not exist.")
+        for wallet_id, amount in amounts.items():
+            transaction.on_commit(partial(leaderboard.balance_changed, wallet_id, amount))
+        return LedgerEntry.objects.bulk_create(
+            LedgerEntry(wallet_id=wallet_id, amount=amount, kind=kind, reference=reference)
+            for wallet_id, amount in amounts.items()
+        )
+
+
+def debit(wallet_id, amount, kind, reference=""):
+    """
+    Remove `amount` tokens from a wallet and record the ledger entry.
+
+    The UPDATE only matches while the balance covers the amount, so the
+    balance can never go negative no matter how many debits race.
+    """
+
+    if not math.isfinite(amount) or amount <= 0:
+        raise ValueError("Debit amount must be positive and finite.")
+
+    with transaction.atomic():
+        updated = Wallet.objects.filter(pk=wallet_id, balance__gte=amount).update(balance=F("balance") - amount)
+        if not updated:
+            if not Wallet.objects.filter(pk=wallet_id).exists():
+                raise Wallet.DoesNotExist(f"Wallet {wallet_id} does not exist.")
+            raise InsufficientBalance(f"Wallet {wallet_id} cannot cover {amount} tokens.")
+        transaction.on_commit(partial(leaderboard.balance_changed, wallet_id, -amount))
+        return LedgerEntry.objects.create(wallet_id=wallet_id, amount=-amount, kind=kind, reference=reference)
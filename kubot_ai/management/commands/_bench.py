@@ -0,0 +1,133 @@
+"""Shared helpers for the ``bench_*`` and ``replay_*`` management commands."""
+import asyncio
+import contextvars
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+
+# Stats of the unit of work being measured; sync_to_async carries it into the thread that runs the query.
+_query_stats = contextvars.ContextVar("bench_query_stats", default=None)
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    """
+    Run the block against a throwaway test database.
+
+    SQLite test databases default to a shared in-memory database, which uses
+    table-level locks instead of the busy timeout, so concurrent benchmarks are
+    pointed at a temporary file instead.
+    """
+
+    tmpdir = None
+    if connection.vendor == "sqlite":
+        tmpdir = tempfile.mkdtemp(prefix="kubot-bench-")
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tmpdir, "bench.sqlite3")
+
+    old_name = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity)
+        if tmpdir:
+            os.rmdir(tmpdir)
+
+
+class QueryStats:
+    """Number and total duration of the queries run while it is being tracked."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+@contextmanager
+def query_tracking():
+    """Let :func:`track_queries` see the queries of every connection opened in the block."""
+    for conn in connections.all(initialized_only=True):
+        _install_tracker(conn)
+    connection_created.connect(_on_connection_created)
+    try:
+        yield
+    finally:
+        connection_created.disconnect(_on_connection_created)
+
+
+@contextmanager
+def track_queries():
+    """Add the queries run in this context, including tasks and threads started from it, to a QueryStats."""
+    stats = QueryStats()
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    _install_tracker(connection)
+
+
+def _install_tracker(conn):
+    if _track_query not in conn.execute_wrappers:
+        conn.execute_wrappers.append(_track_query)
+
+
+def _track_query(execute, sql, params, many, context):
+    stats = _query_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.count += 1
+        stats.seconds += time.perf_counter() - started
+
+
+async def call_asgi(application, method, path, body=None, headers=()):
+    """Send one HTTP request to `application` and return the response status once the body is complete."""
+    payload = body if isinstance(body, bytes) else json.dumps(body).encode() if body is not None else b""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"localhost"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(payload)).encode()),
+            *((name.lower().encode(), value.encode()) for name, value in headers),
+        ],
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+    request = [{"type": "http.request", "body": payload, "more_body": False}]
+    finished = asyncio.Event()
+    status = None
+
+    async def receive():
+        if request:
+            return request.pop()
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body" and not message.get("more_body", False):
+            finished.set()
+
+    await application(scope, receive, send)
+    return status
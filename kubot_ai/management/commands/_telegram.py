@@ -0,0 +1,118 @@
+"""A fake Telegram Bot API and realistic webhook updates for the ``replay_webhook`` command."""
+import asyncio
+import contextvars
+import json
+import random
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+# Update type of the update being processed; outbound calls made outside one are counted under None.
+current_kind = contextvars.ContextVar("replay_update_kind", default=None)
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Kubot", "username": "kubot_replay_bot"}
+
+
+class FakeBotApi(BaseRequest):
+    """
+    Answers every Bot API call locally, after `latency` seconds, and counts the calls.
+
+    ``sendMessage`` and ``sendPhoto`` return a plausible Message, ``getMe`` the
+    bot user and every other method ``True``.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()  # (update type, method) -> calls
+        self._message_ids = iter(range(1, 1 << 62))
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[current_kind.get(), api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data is not None else {}
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, parameters)}).encode()
+
+    def _result(self, api_method, parameters):
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method in ("sendMessage", "sendPhoto"):
+            message = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(parameters.get("chat_id", 0)), "type": "private"},
+                "from": BOT_USER,
+            }
+            if api_method == "sendPhoto":
+                message["photo"] = [{"file_id": "replay-photo", "file_unique_id": "replay", "width": 1, "height": 1}]
+            else:
+                message["text"] = parameters.get("text", "")
+            return message
+        return True
+
+
+# Share of generated updates per type, for a returning user; a user's first update is always a /start.
+MIX = {"start": 0.15, "mine": 0.30, "balance": 0.20, "text": 0.35}
+TEXTS = ("hi", "how do I earn tokens?", "gm ☀️", "what is kubot?", "when airdrop", "thanks!")
+
+
+def generate_updates(count, users, referral_codes=(), referral_share=0.5, mine_burst=3, first_user_id=10**9, seed=0):
+    """
+    Yield `count` (update type, Update payload) pairs from up to `users` simulated Telegram users.
+
+    New users send ``/start``, `referral_share` of them with a code from
+    `referral_codes` (update type "start_referral"); returning users send
+    /start again, bursts of `mine_burst` /mine commands, /balance or free
+    text, following :data:`MIX`.
+    """
+    rng = random.Random(seed)
+    kinds, weights = zip(*MIX.items())
+    seen = []
+    update_id = 0
+    while update_id < count:
+        if len(seen) < users and (not seen or rng.random() < 0.2):
+            user_id = first_user_id + len(seen)
+            seen.append(user_id)
+            if referral_codes and rng.random() < referral_share:
+                batch = [("start_referral", f"/start {rng.choice(referral_codes)}")]
+            else:
+                batch = [("start", "/start")]
+        else:
+            user_id = rng.choice(seen)
+            kind = rng.choices(kinds, weights)[0]
+            if kind == "mine":
+                batch = [("mine", "/mine")] * mine_burst
+            elif kind == "text":
+                batch = [("text", rng.choice(TEXTS))]
+            else:
+                batch = [(kind, f"/{kind}")]
+        for kind, text in batch[:count - update_id]:
+            update_id += 1
+            yield kind, _update(update_id, user_id, text)
+
+
+def _update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id % 10000}", "username": f"replay{user_id}"}
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": user["first_name"], "username": user["username"]},
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
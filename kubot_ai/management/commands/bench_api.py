@@ -0,0 +1,275 @@
+"""Load benchmark of the REST API through the ASGI app, with JSON baselines for regression checks."""
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import time
+from itertools import count
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from asgiref.sync import sync_to_async
+
+from kubot_ai import rollups
+from kubot_ai.models import Referral, ReferralPath, Reward, Task, UserTask, Wallet
+
+from ._bench import benchmark_database, call_asgi, query_tracking, track_queries
+
+
+class Dataset:
+    """Sizes and ids of the seeded data, and the requests each endpoint makes."""
+
+    def __init__(self, wallets, tasks, rewards):
+        self.wallets = wallets
+        self.tasks = tasks
+        self.rewards = rewards
+        self.task_ids = []
+
+    def wallet(self, i):
+        wallet_id = i % self.wallets + 1
+        return wallet_id, f"bench{wallet_id}", f"K{wallet_id:05d}"
+
+    def open_task(self, i):
+        """A (wallet, task) pair that is not completed yet; the second half of the tasks is left open."""
+        open_tasks = self.task_ids[len(self.task_ids) // 2:]
+        return i % self.wallets + 1, open_tasks[i // self.wallets % len(open_tasks)]
+
+    def request(self, endpoint, i):
+        """Return (method, path, JSON body or None) of request `i` to `endpoint`."""
+        wallet_id, username, code = self.wallet(i)
+        if endpoint == "tasks":
+            return "GET", "/api/tasks/", None
+        if endpoint == "completed_tasks":
+            return "GET", f"/api/tasks/completed/{wallet_id}/", None
+        if endpoint == "complete_task":
+            wallet_id, task_id = self.open_task(i)
+            return "POST", f"/api/tasks/complete/{wallet_id}/{task_id}/", None
+        if endpoint == "complete_tasks":
+            return "POST", f"/api/tasks/complete/{wallet_id}/", {"task_ids": self.task_ids[:10]}
+        if endpoint == "rewards":
+            return "GET", f"/api/rewards/{username}/", None
+        if endpoint == "reward_summary":
+            return "GET", f"/api/rewards/{username}/summary/", None
+        if endpoint == "referrals":
+            return "GET", f"/api/referral/{code}/", None
+        if endpoint == "referral_team":
+            return "GET", f"/api/referral/team/{username}/", None
+        if endpoint == "leaderboard":
+            return "GET", "/api/leaderboard/balance/", None
+        if endpoint == "wallets":
+            return "GET", "/api/wallet/create/", None
+        if endpoint == "wallet":
+            return "GET", f"/api/wallet/{username}/", None
+        if endpoint == "fund":
+            return "POST", f"/api/wallet/fund/{username}/", {"amount": 1}
+        if endpoint == "withdraw":
+            return "POST", f"/api/wallet/withdraw/{username}/", {"amount": 1}
+        raise KeyError(endpoint)
+
+
+ENDPOINTS = (
+    "tasks", "completed_tasks", "complete_task", "complete_tasks", "rewards", "reward_summary", "referrals",
+    "referral_team", "leaderboard", "wallets", "wallet", "fund", "withdraw",
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway database and drive the REST API concurrently through the ASGI app in core.asgi. "
+        "Reports throughput, p50/p95/p99 latency and queries per request for each endpoint, and can save "
+        "the results as JSON and compare them with a saved baseline. Every request runs on its own thread, "
+        "as under a real ASGI server, so on SQLite concurrent writes can fail with 'database is locked'; "
+        "they are counted as server errors."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--wallets", type=int, default=1000)
+        parser.add_argument("--tasks", type=int, default=40)
+        parser.add_argument("--rewards", type=int, default=20, help="Rewards per wallet.")
+        parser.add_argument("--requests", type=int, default=500, help="Timed requests per endpoint.")
+        parser.add_argument("--warmup", type=int, default=20, help="Untimed requests per endpoint first.")
+        parser.add_argument("--concurrency", type=int, default=20, help="Requests in flight per endpoint.")
+        parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--baseline", help="Compare with the results in this JSON file; fail on a regression.")
+        parser.add_argument(
+            "--tolerance", type=float, default=0.2,
+            help="Allowed relative slowdown of p95 latency or throughput against the baseline.",
+        )
+
+    def handle(self, *args, **options):
+        dataset = Dataset(options["wallets"], options["tasks"], options["rewards"])
+        timed = options["warmup"] + options["requests"]
+        if "complete_task" in options["endpoints"] and timed > dataset.wallets * (dataset.tasks - dataset.tasks // 2):
+            raise CommandError("Not enough open tasks for complete_task; raise --wallets or --tasks.")
+
+        baseline = self._load(options["baseline"]) if options["baseline"] else None
+
+        # Like the test runner: DEBUG would log every query and slow every request down.
+        with benchmark_database(), override_settings(DEBUG=False):
+            self._seed(dataset)
+            with query_tracking():
+                results = asyncio.run(self._run_all(dataset, options))
+
+        report = {
+            "meta": {
+                "created_at": timezone.now().isoformat(),
+                "vendor": connection.vendor,
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                **{key: options[key] for key in ("wallets", "tasks", "rewards", "requests", "concurrency")},
+            },
+            "endpoints": results,
+        }
+        self._print(results)
+        if options["output"]:
+            with open(options["output"], "w") as out:
+                json.dump(report, out, indent=2)
+            self.stdout.write(f"results written to {options['output']}")
+        if baseline is not None:
+            regressions = compare(baseline, report, options["tolerance"])
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError(f"{len(regressions)} regressions against {options['baseline']}.")
+            self.stdout.write(self.style.SUCCESS(f"no regressions against {options['baseline']}"))
+
+    def _load(self, path):
+        try:
+            with open(path) as baseline:
+                return json.load(baseline)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Cannot read baseline {path}: {e}")
+
+    def _seed(self, dataset):
+        started = time.perf_counter()
+        Wallet.objects.bulk_create(
+            Wallet(id=i, user=f"bench{i}", eth_address=f"0xbench{i}", balance=1000.0, referral_id=f"K{i:05d}")
+            for i in range(1, dataset.wallets + 1)
+        )
+        Task.objects.bulk_create(
+            Task(title=f"Task {i}", description="Benchmark task", url=f"https://example.com/{i}",
+                 task_type=("social", "daily", "partner")[i % 3], reward_amount=5)
+            for i in range(dataset.tasks)
+        )
+        dataset.task_ids = list(Task.objects.order_by("id").values_list("id", flat=True))
+        done = dataset.task_ids[: len(dataset.task_ids) // 2]
+        for first in range(1, dataset.wallets + 1, 500):
+            wallet_ids = range(first, min(first + 500, dataset.wallets + 1))
+            Reward.objects.bulk_create(
+                Reward(user_id=wallet_id, task_id=done[n % len(done)] if done else None, amount=5)
+                for wallet_id in wallet_ids for n in range(dataset.rewards)
+            )
+            UserTask.objects.bulk_create(
+                UserTask(user_id=wallet_id, task_id=task_id, reward_claimed=True)
+                for wallet_id in wallet_ids for task_id in done
+            )
+        rollups.rebuild()
+
+        # A binary referral tree: wallet i was referred by wallet i // 2.
+        Referral.objects.bulk_create(
+            Referral(referrer_id=i // 2, referred_user_id=i, referral_id=f"K{i // 2:05d}")
+            for i in range(2, dataset.wallets + 1)
+        )
+        paths = []
+        for i in range(2, dataset.wallets + 1):
+            ancestor, depth = i // 2, 1
+            while ancestor and depth <= settings.KUBOT_REFERRAL_MAX_DEPTH:
+                paths.append(ReferralPath(ancestor_id=ancestor, descendant_id=i, depth=depth))
+                ancestor, depth = ancestor // 2, depth + 1
+        ReferralPath.objects.bulk_create(paths, batch_size=5000)
+        self.stdout.write(f"seeded {dataset.wallets} wallets in {time.perf_counter() - started:.1f}s")
+
+    async def _run_all(self, dataset, options):
+        from core.asgi import application
+
+        results = {}
+        # Error statuses are counted in the results; the per-request log lines would drown the report.
+        request_logger = logging.getLogger("django.request")
+        level, request_logger.level = request_logger.level, logging.CRITICAL
+        try:
+            for endpoint in options["endpoints"]:
+                numbers = count()  # shared by the warmup and the timed run, so no request repeats
+                await self._run(application, dataset, endpoint, numbers, options["warmup"], options["concurrency"])
+                results[endpoint] = await self._run(
+                    application, dataset, endpoint, numbers, options["requests"], options["concurrency"]
+                )
+        finally:
+            # Connections opened outside a request must go before the test database is dropped.
+            await sync_to_async(connections.close_all, thread_sensitive=True)()
+            request_logger.setLevel(level)
+        return results
+
+    async def _run(self, application, dataset, endpoint, numbers, requests, concurrency):
+        """Send `requests` requests to `endpoint`, `concurrency` at a time, and summarize them."""
+        samples = []
+        statuses = {}
+        remaining = iter(range(requests))
+
+        async def worker():
+            for _ in remaining:
+                method, path, body = dataset.request(endpoint, next(numbers))
+                with track_queries() as queries:
+                    started = time.perf_counter()
+                    status = await call_asgi(application, method, path, body)
+                samples.append((time.perf_counter() - started, queries.count))
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        elapsed = time.perf_counter() - started
+        return summarize(samples, statuses, elapsed)
+
+    def _print(self, results):
+        self.stdout.write(
+            f"{'endpoint':<16}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}  statuses"
+        )
+        for endpoint, result in results.items():
+            statuses = " ".join(f"{code}x{n}" for code, n in sorted(result["statuses"].items()))
+            self.stdout.write(
+                f"{endpoint:<16}{result['throughput']:>9.1f}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}"
+                f"{result['p99_ms']:>9.2f}{result['queries_mean']:>9.2f}  {statuses}"
+            )
+
+
+def summarize(samples, statuses, elapsed):
+    """Return throughput, latency percentiles and queries per request of (seconds, queries) samples."""
+    latencies = sorted(seconds * 1000 for seconds, _ in samples)
+    queries = [n for _, n in samples]
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(samples),
+        "errors": sum(n for code, n in statuses.items() if code is None or code >= 500),
+        "statuses": {str(code): n for code, n in statuses.items()},
+        "throughput": len(samples) / elapsed if elapsed else 0.0,
+        "p50_ms": cuts[49],
+        "p95_ms": cuts[94],
+        "p99_ms": cuts[98],
+        "queries_mean": statistics.fmean(queries),
+        "queries_max": max(queries),
+    }
+
+
+def compare(baseline, current, tolerance):
+    """Return a description of every regression of `current` against `baseline`."""
+    regressions = []
+    for endpoint, result in current["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(endpoint)
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{endpoint}: p95 {before['p95_ms']:.2f}ms -> {result['p95_ms']:.2f}ms")
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{endpoint}: throughput {before['throughput']:.1f} -> {result['throughput']:.1f} req/s")
+        # Query counts do not depend on the machine, so any increase counts.
+        if result["queries_max"] > before["queries_max"]:
+            regressions.append(f"{endpoint}: queries per request {before['queries_max']} -> {result['queries_max']}")
+        if result["errors"] > before["errors"]:
+            regressions.append(f"{endpoint}: {result['errors']} server errors, {before['errors']} before")
+    return regressions
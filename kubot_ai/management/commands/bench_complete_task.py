@@ -0,0 +1,73 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from kubot_ai import completion
+from kubot_ai.models import Reward, Task, UserTask, Wallet
+
+from ._bench import benchmark_database
+
+
+class Command(BaseCommand):
+    help = "Compare task completion throughput of the old check-then-insert path and complete_task()."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--tasks", type=int, default=10)
+        parser.add_argument("--duplicates", type=int, default=2, help="Repeat taps per completion.")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            self._run("legacy", self._legacy_complete, options)
+            self._run("complete_task", self._complete, options)
+
+    def _run(self, label, complete, options):
+        Wallet.objects.all().delete()
+        Task.objects.all().delete()
+        wallets = Wallet.objects.bulk_create(
+            Wallet(id=i, user=f"user{i}", eth_address=f"0x{i}", referral_id=f"B{i:05d}")
+            for i in range(1, options["users"] + 1)
+        )
+        tasks = Task.objects.bulk_create(
+            Task(title=f"Task {i}", description="Bench", task_type="social", reward_amount=10)
+            for i in range(options["tasks"])
+        )
+        pairs = [(wallet.pk, task.pk) for wallet in wallets for task in tasks]
+
+        first = self._measure(complete, pairs)
+        repeat = self._measure(complete, pairs * options["duplicates"])
+
+        self.stdout.write(
+            f"{label}: first taps {first[0]:.0f}/s ({first[1]:.1f} statements each), "
+            f"duplicate taps {repeat[0]:.0f}/s ({repeat[1]:.1f} statements each), "
+            f"{UserTask.objects.count()} completions, {Reward.objects.count()} rewards"
+        )
+
+    def _measure(self, complete, pairs):
+        statements = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal statements
+            statements += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            started = time.perf_counter()
+            for user_id, task_id in pairs:
+                complete(user_id, task_id)
+            elapsed = time.perf_counter() - started
+        return len(pairs) / elapsed, statements / len(pairs)
+
+    def _complete(self, user_id, task_id):
+        try:
+            completion.complete_task(user_id, task_id)
+        except completion.TaskAlreadyCompleted:
+            pass
+
+    def _legacy_complete(self, user_id, task_id):
+        task = Task.objects.get(id=task_id)
+        if UserTask.objects.filter(user_id=user_id, task=task).exists():
+            return
+        UserTask.objects.create(user_id=user_id, task=task, reward_claimed=True)
+        Reward.objects.create(user_id=user_id, task=task, amount=task.reward_amount)
@@ -0,0 +1,80 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.db.models import Sum
+
+from kubot_ai import ledger
+from kubot_ai.models import LedgerEntry, Wallet
+
+from ._bench import benchmark_database
+
+
+class Command(BaseCommand):
+    help = "Hammer a single wallet with parallel credits/debits and check that no update is lost."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500, help="Total number of balance changes.")
+        parser.add_argument("--workers", type=int, default=200, help="Number of parallel workers.")
+        parser.add_argument(
+            "--legacy", action="store_true",
+            help="Also run the old get/mutate/save path for comparison.",
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            if options["legacy"]:
+                self._run("legacy get/save", self._legacy_credit, options)
+            self._run("ledger", self._ledger_change, options)
+
+    def _run(self, label, change, options):
+        Wallet.objects.all().delete()
+        wallet = Wallet.objects.create(id=1, user="bench", eth_address="0xbench", referral_id="BENCH1")
+
+        # Every third request is a debit of 1 token; the rest credit 2 tokens.
+        plan = [-1 if i % 3 == 2 else 2 for i in range(options["requests"])]
+
+        def run(amount):
+            try:
+                return change(wallet.pk, amount)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            applied = sum(pool.map(run, plan))
+        elapsed = time.perf_counter() - started
+
+        balance = Wallet.objects.get(pk=wallet.pk).balance
+        ledger_total = LedgerEntry.objects.filter(wallet_id=wallet.pk).aggregate(total=Sum("amount"))["total"] or 0.0
+        lost = applied - balance
+
+        self.stdout.write(
+            f"{label}: {len(plan)} requests in {elapsed:.2f}s ({len(plan) / elapsed:.0f} req/s), "
+            f"expected balance {applied}, actual {balance}, ledger {ledger_total}, lost {lost}"
+        )
+        style = self.style.SUCCESS if lost == 0 else self.style.ERROR
+        self.stdout.write(style("no lost updates" if lost == 0 else f"{lost} tokens lost"))
+
+    def _ledger_change(self, wallet_id, amount):
+        if amount > 0:
+            ledger.credit(wallet_id, amount, LedgerEntry.FUND)
+            return amount
+        try:
+            ledger.debit(wallet_id, -amount, LedgerEntry.WITHDRAW)
+        except ledger.InsufficientBalance:
+            return 0
+        return amount
+
+    def _legacy_credit(self, wallet_id, amount):
+        try:
+            wallet = Wallet.objects.get(pk=wallet_id)
+            if wallet.balance + amount < 0:
+                return 0
+            wallet.balance += amount
+            wallet.save()
+        except OperationalError:
+            # SQLite gives up on its file lock under this much contention.
+            return 0
+        return amount
@@ -0,0 +1,111 @@
+import random
+import string
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, connection, transaction
+
+from kubot_ai.models import Wallet
+from kubot_ai.referral_ids import ReferralIdAllocator
+
+from ._bench import benchmark_database
+
+# Legacy codes are three base-36 characters followed by three digits.
+LEGACY_SPACE = 36 ** 3 * 1000
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare signup throughput of the old random referral IDs (retrying on IntegrityError) and the "
+        "block allocator, on top of a table of existing wallets. Use --wallets 10000000 for the 10M scenario."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--wallets", type=int, default=100000, help="Existing wallets with legacy codes.")
+        parser.add_argument("--signups", type=int, default=2000)
+        parser.add_argument("--workers", type=int, default=4, help="Concurrent signup threads.")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            self._seed(options["wallets"])
+            self._run("legacy", self._legacy_signup, options)
+            allocator = ReferralIdAllocator()
+            self._run("allocator", lambda wallet_id: self._signup(wallet_id, allocator), options)
+            self.stdout.write(f"allocator reserved {allocator.blocks} blocks")
+
+    def _seed(self, count):
+        started = time.perf_counter()
+        batch = 50000
+        for first in range(0, count, batch):
+            Wallet.objects.bulk_create(
+                Wallet(id=i, user=f"seed{i}", eth_address=f"0xseed{i}", referral_id=_legacy_code(i))
+                for i in range(first, min(first + batch, count))
+            )
+        self.stdout.write(f"seeded {count} wallets in {time.perf_counter() - started:.1f}s")
+
+    def _run(self, label, signup, options):
+        first_id = Wallet.objects.order_by("-id").values_list("id", flat=True).first() + 1
+        ids = iter(range(first_id, first_id + options["signups"]))
+        lock = threading.Lock()
+        retries = 0
+
+        def work():
+            nonlocal retries
+            try:
+                while True:
+                    with lock:
+                        wallet_id = next(ids, None)
+                    if wallet_id is None:
+                        return
+                    attempts = signup(wallet_id)
+                    with lock:
+                        retries += attempts - 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work) for _ in range(options["workers"])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{label}: {options['signups'] / elapsed:.0f} signups/s with {options['workers']} workers, "
+            f"{retries} IntegrityError retries"
+        )
+
+    def _legacy_signup(self, wallet_id):
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                with transaction.atomic():
+                    self._create(wallet_id, _random_code())
+                return attempts
+            except IntegrityError:
+                continue
+
+    def _signup(self, wallet_id, allocator):
+        self._create(wallet_id, allocator.allocate())
+        return 1
+
+    def _create(self, wallet_id, referral_id):
+        Wallet.objects.create(
+            id=wallet_id, user=f"user{wallet_id}", eth_address=f"0xuser{wallet_id}", referral_id=referral_id
+        )
+
+
+def _random_code():
+    """What ``Wallet`` used to generate."""
+    chars = string.ascii_uppercase + string.digits
+    return "".join(random.choices(chars, k=3)) + "".join(random.choices(string.digits, k=3))
+
+
+def _legacy_code(i):
+    # Spread the seeded codes over the legacy space, like random draws would.
+    value = (i * 7_777_777) % LEGACY_SPACE
+    head, tail = divmod(value, 1000)
+    chars = string.digits + string.ascii_uppercase
+    return "".join(chars[head // 36 ** k % 36] for k in (2, 1, 0)) + f"{tail:03d}"
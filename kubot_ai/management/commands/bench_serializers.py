@@ -0,0 +1,92 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from kubot_ai import projections
+from kubot_ai.models import Reward, Task, UserTask, Wallet
+
+from ._bench import benchmark_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare ModelSerializer and projection serialization of wallets, rewards and completed tasks, "
+        "from query to rendered JSON, and check that both produce the same bytes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="+", default=[10, 1000, 50000], help="Result sizes to time.")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest is reported.")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            self._seed(max(options["rows"]))
+            cases = [
+                ("wallets", projections.wallets, Wallet.objects.order_by("id")),
+                ("rewards", projections.rewards, Reward.objects.select_related("task").order_by("id")),
+                ("user_tasks", projections.user_tasks, UserTask.objects.select_related("task").order_by("id")),
+            ]
+            mismatches = 0
+            for name, projection, queryset in cases:
+                for rows in options["rows"]:
+                    mismatches += self._compare(name, projection, queryset[:rows], rows, options["repeat"])
+
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f"{mismatches} cases rendered different bytes"))
+        else:
+            self.stdout.write(self.style.SUCCESS("projections rendered the same bytes as the serializers"))
+
+    def _seed(self, count):
+        started = time.perf_counter()
+        now = timezone.now()
+        Wallet.objects.bulk_create(
+            Wallet(id=i, user=f"bench{i}", eth_address=f"0xbench{i}", balance=i / 4, referral_id=f"B{i:05d}")
+            for i in range(1, count + 1)
+        )
+        Task.objects.bulk_create(
+            Task(title=f"Task {i}", description="Benchmark task", url=f"https://example.com/{i}" if i % 2 else None,
+                 task_type="social", reward_amount=i % 50)
+            for i in range(count)
+        )
+        tasks = list(Task.objects.order_by("id").values_list("id", flat=True))
+        Reward.objects.bulk_create(
+            Reward(user_id=1, task_id=task_id if i % 10 else None, amount=i % 50, credited_at=now if i % 3 else None)
+            for i, task_id in enumerate(tasks)
+        )
+        UserTask.objects.bulk_create(
+            UserTask(user_id=1, task_id=task_id, reward_claimed=bool(i % 2)) for i, task_id in enumerate(tasks)
+        )
+        self.stdout.write(f"seeded {count} rows per table in {time.perf_counter() - started:.1f}s")
+
+    def _compare(self, name, projection, queryset, rows, repeat):
+        renderer = JSONRenderer()
+
+        def serializer():
+            return renderer.render(projection.serializer_class(queryset, many=True).data)
+
+        def projected():
+            return renderer.render(projection.project(projection.values(queryset)))
+
+        serializer_time, expected = _best(serializer, repeat)
+        projection_time, actual = _best(projected, repeat)
+        self.stdout.write(
+            f"{name} x{rows}: serializer {serializer_time * 1000:.1f}ms, projection {projection_time * 1000:.1f}ms "
+            f"({serializer_time / projection_time:.1f}x)"
+        )
+        if actual != expected:
+            self.stdout.write(self.style.ERROR(f"{name} x{rows}: output differs"))
+            return 1
+        return 0
+
+
+def _best(run, repeat):
+    """Return (fastest time, result) of `repeat` calls of `run`."""
+    best = None
+    for _ in range(max(1, repeat)):
+        started = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
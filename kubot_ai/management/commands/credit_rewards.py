@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from kubot_ai.crediting import RewardCreditor
+
+
+class Command(BaseCommand):
+    help = "Credit pending task rewards to wallet balances."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None)
+        parser.add_argument("--watch", action="store_true", help="Keep polling for new rewards.")
+
+    def handle(self, *args, **options):
+        creditor = RewardCreditor(batch_size=options["batch_size"])
+        while True:
+            credited = creditor.credit_pending()
+            if credited:
+                self.stdout.write(f"Credited {credited} rewards (lag {creditor.lag_last:.1f}s)")
+            if not options["watch"]:
+                break
+            time.sleep(creditor.poll_interval)
+        stats = creditor.stats()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Credited {stats['credited']} rewards in {stats['batches']} batches "
+                f"({stats['throughput']:.0f}/s, max lag {stats['lag_max']:.1f}s)"
+            )
+        )
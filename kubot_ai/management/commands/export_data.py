@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from kubot_ai import export
+
+
+class Command(BaseCommand):
+    help = "Export wallets, rewards, user_tasks or referrals as CSV or JSONL, streaming in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(export.EXPORTS))
+        parser.add_argument("--format", dest="output", choices=sorted(export.CONTENT_TYPES), default="csv")
+        parser.add_argument("--since", help="Only rows from this ISO date/time on.")
+        parser.add_argument("--until", help="Only rows before this ISO date/time.")
+        parser.add_argument("--output", dest="path", help="File to write (default: stdout).")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            since, until = export.parse_time(options["since"]), export.parse_time(options["until"])
+            out = open(options["path"], "w", newline="") if options["path"] else sys.stdout
+            try:
+                if options["output"] == "csv" and connection.vendor == "postgresql":
+                    export.copy_csv(options["name"], out, since, until)
+                else:
+                    for chunk in export.iter_export(options["name"], options["output"], since, until, options["chunk_size"]):
+                        out.write(chunk)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+        except export.ExportError as e:
+            raise CommandError(e)
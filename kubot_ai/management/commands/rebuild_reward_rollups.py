@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kubot_ai import rollups
+from kubot_ai.models import Wallet
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-user reward rollups from the Reward rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("usernames", nargs="*", help="Only rebuild these users (default: everyone).")
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options["usernames"]:
+            found = dict(Wallet.objects.filter(user__in=options["usernames"]).values_list("user", "id"))
+            missing = sorted(set(options["usernames"]) - set(found))
+            if missing:
+                raise CommandError(f"No wallet for: {', '.join(missing)}")
+            user_ids = list(found.values())
+
+        created = rollups.rebuild(user_ids)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} reward rollups"))
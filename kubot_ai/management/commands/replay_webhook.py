@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import os
+import statistics
+import time
+from collections import Counter, defaultdict
+from contextlib import redirect_stdout
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import override_settings
+from telegram.ext import Application
+
+from kubot_ai import views
+from kubot_ai.models import Wallet
+from kubot_ai.webhook_queue import UpdateQueue
+
+from ._bench import benchmark_database, call_asgi, query_tracking, track_queries
+from ._telegram import FakeBotApi, current_kind, generate_updates
+
+SECRET = "replay-secret"
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay generated Telegram updates (new users with and without referral codes, /mine bursts, /balance, "
+        "free text) against the webhook at a target rate, through the ASGI app in core.asgi, with the bot "
+        "talking to an in-process fake Bot API. Reports webhook ack latency, end-to-end latency, handler time, "
+        "DB time, handler errors and outbound Bot API calls per update type."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--updates", type=int, default=2000)
+        parser.add_argument("--users", type=int, default=300, help="Simulated Telegram users.")
+        parser.add_argument("--rate", type=float, default=50.0, help="Target updates per second.")
+        parser.add_argument("--referrers", type=int, default=100, help="Seeded wallets whose codes new users use.")
+        parser.add_argument("--api-latency", type=float, default=30.0, help="Fake Bot API latency in milliseconds.")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the update generator.")
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+
+    def handle(self, *args, **options):
+        # DEBUG logs every query; the handlers print() and log every update.
+        app_logger = logging.getLogger("kubot_ai")
+        level, app_logger.level = app_logger.level, logging.WARNING
+        try:
+            with benchmark_database(), override_settings(DEBUG=False, TELEGRAM_WEBHOOK_SECRET=SECRET):
+                codes = self._seed(options["referrers"])
+                with query_tracking(), open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    report = asyncio.run(self._replay(codes, options))
+        finally:
+            app_logger.setLevel(level)
+
+        self._print(report)
+        if options["output"]:
+            with open(options["output"], "w") as out:
+                json.dump(report, out, indent=2)
+            self.stdout.write(f"results written to {options['output']}")
+
+    def _seed(self, count):
+        codes = [f"R{i:05d}" for i in range(1, count + 1)]
+        Wallet.objects.bulk_create(
+            Wallet(id=i, user=f"referrer{i}", eth_address=f"0xreferrer{i}", referral_id=code)
+            for i, code in enumerate(codes, start=1)
+        )
+        return codes
+
+    async def _replay(self, codes, options):
+        from core.asgi import application as asgi
+
+        fake_api = FakeBotApi(latency=options["api_latency"] / 1000)
+        bot = views.build_application(Application.builder().token("1:replay").request(fake_api).updater(None))
+        posted = {}  # update_id -> (update type, time the webhook call started)
+        samples = defaultdict(list)  # update type -> [(end-to-end, handler, queries, query seconds)]
+        errors = defaultdict(Counter)  # update type -> "Error: message" -> count
+
+        async def on_error(update, context):
+            # Runs inside process_update, so the update type is still set.
+            errors[current_kind.get() or "other"][f"{type(context.error).__name__}: {context.error}"] += 1
+
+        bot.add_error_handler(on_error)
+
+        async def process(update):
+            kind, posted_at = posted.pop(update.update_id)
+            token = current_kind.set(kind)
+            try:
+                with track_queries() as queries:
+                    started = time.perf_counter()
+                    await views._process_update(update)
+                finished = time.perf_counter()
+            finally:
+                current_kind.reset(token)
+            samples[kind].append((finished - posted_at, finished - started, queries.count, queries.seconds))
+
+        queue = UpdateQueue(process, workers=settings.KUBOT_WEBHOOK_WORKERS, maxsize=settings.KUBOT_WEBHOOK_QUEUE_SIZE)
+        saved = views._application, views.update_queue
+        views._application, views.update_queue = bot, queue
+        acks = defaultdict(list)  # update type -> webhook response times
+        statuses = defaultdict(lambda: defaultdict(int))  # update type -> status -> count
+
+        async def post(kind, payload):
+            body = json.dumps(payload).encode()
+            started = time.perf_counter()
+            posted[payload["update_id"]] = (kind, started)
+            status = await call_asgi(
+                asgi, "POST", "/telegram-webhook/", body, headers=[("X-Telegram-Bot-Api-Secret-Token", SECRET)]
+            )
+            acks[kind].append(time.perf_counter() - started)
+            statuses[kind][status] += 1
+            if status != 200:
+                posted.pop(payload["update_id"], None)
+
+        try:
+            await views.startup_bot()
+            updates = generate_updates(options["updates"], options["users"], codes, seed=options["seed"])
+            started = time.perf_counter()
+            calls = []
+            for i, (kind, payload) in enumerate(updates):
+                delay = started + i / options["rate"] - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                calls.append(asyncio.create_task(post(kind, payload)))
+            sent = time.perf_counter() - started
+            await asyncio.gather(*calls)
+            await queue.drain(timeout=300)
+            elapsed = time.perf_counter() - started
+            sender = views.message_sender.stats()
+        finally:
+            await views.shutdown_bot()
+            views._application, views.update_queue = saved
+            # Connections opened outside a request must go before the test database is dropped.
+            await sync_to_async(connections.close_all, thread_sensitive=True)()
+
+        outbound = defaultdict(dict)
+        for (kind, api_method), count in fake_api.calls.items():
+            outbound[kind or "other"][api_method] = count
+        processed = sum(len(rows) for rows in samples.values())
+        return {
+            "meta": {key: options[key] for key in ("updates", "users", "rate", "referrers", "api_latency", "seed")},
+            "rate_achieved": len(calls) / sent if sent else 0.0,
+            "throughput": processed / elapsed if elapsed else 0.0,
+            "sender": sender,
+            "types": {
+                kind: _summarize(samples[kind], acks[kind], statuses[kind], outbound.get(kind, {}), errors[kind])
+                for kind in sorted(acks)
+            },
+            "outbound_other": outbound.get("other", {}),
+        }
+
+    def _print(self, report):
+        self.stdout.write(
+            f"sent {report['rate_achieved']:.1f} updates/s, processed {report['throughput']:.1f} updates/s"
+        )
+        self.stdout.write(
+            f"{'type':<16}{'updates':>8}{'ack p95':>9}{'e2e p50':>9}{'e2e p95':>9}{'e2e p99':>9}"
+            f"{'handler':>9}{'db ms':>8}{'queries':>8}{'calls':>7}{'errors':>8}"
+        )
+        for kind, row in report["types"].items():
+            self.stdout.write(
+                f"{kind:<16}{row['updates']:>8}{row['ack_p95_ms']:>9.1f}{row['e2e_p50_ms']:>9.1f}"
+                f"{row['e2e_p95_ms']:>9.1f}{row['e2e_p99_ms']:>9.1f}{row['handler_p50_ms']:>9.1f}"
+                f"{row['db_ms']:>8.1f}{row['queries']:>8.1f}{row['calls']:>7.2f}{sum(row['errors'].values()):>8}"
+            )
+        self.stdout.write("times in ms; handler is the p50; db, queries and calls are per processed update")
+        for kind, row in report["types"].items():
+            for error, count in Counter(row["errors"]).most_common(3):
+                self.stdout.write(self.style.WARNING(f"{kind}: {count}x {error[:200]}"))
+        if report["outbound_other"]:
+            self.stdout.write(f"outbound calls outside updates (startup, payouts): {report['outbound_other']}")
+
+
+def _summarize(samples, acks, statuses, outbound, errors):
+    """Summarize one update type: latencies in milliseconds, DB and Bot API use per processed update."""
+    processed = len(samples)
+    e2e = _percentiles([row[0] for row in samples])
+    handler = _percentiles([row[1] for row in samples])
+    return {
+        "updates": len(acks),
+        "processed": processed,
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "ack_p50_ms": _percentiles(acks)[0],
+        "ack_p95_ms": _percentiles(acks)[1],
+        "e2e_p50_ms": e2e[0],
+        "e2e_p95_ms": e2e[1],
+        "e2e_p99_ms": e2e[2],
+        "handler_p50_ms": handler[0],
+        "handler_p95_ms": handler[1],
+        "db_ms": sum(row[3] for row in samples) * 1000 / processed if processed else 0.0,
+        "queries": sum(row[2] for row in samples) / processed if processed else 0.0,
+        "calls": sum(outbound.values()) / processed if processed else 0.0,
+        "outbound": outbound,
+        "errors": dict(errors),
+    }
+
+
+def _percentiles(seconds):
+    """Return the p50, p95 and p99 of `seconds`, in milliseconds."""
+    if not seconds:
+        return 0.0, 0.0, 0.0
+    values = sorted(value * 1000 for value in seconds)
+    if len(values) == 1:
+        return values[0], values[0], values[0]
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
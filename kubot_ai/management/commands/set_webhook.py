@@ -0,0 +1,35 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from telegram import Bot
+
+
+class Command(BaseCommand):
+    help = "Point the Telegram bot's webhook at this deployment, with TELEGRAM_WEBHOOK_SECRET as secret token."
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="Public URL of the webhook, e.g. https://example.com/telegram-webhook/")
+        parser.add_argument(
+            "--drop-pending-updates", action="store_true",
+            help="Discard the updates Telegram has queued for the old webhook.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.TELEGRAM_BOT_TOKEN:
+            raise CommandError("TELEGRAM_BOT_TOKEN is not set.")
+        if not settings.TELEGRAM_WEBHOOK_SECRET:
+            self.stderr.write(self.style.WARNING(
+                "TELEGRAM_WEBHOOK_SECRET is not set; the webhook will accept updates from anyone."
+            ))
+
+        asyncio.run(self._set_webhook(options["url"], options["drop_pending_updates"]))
+        self.stdout.write(self.style.SUCCESS(f"Webhook set to {options['url']}"))
+
+    async def _set_webhook(self, url, drop_pending_updates):
+        async with Bot(settings.TELEGRAM_BOT_TOKEN) as bot:
+            await bot.set_webhook(
+                url,
+                secret_token=settings.TELEGRAM_WEBHOOK_SECRET or None,
+                drop_pending_updates=drop_pending_updates,
+            )
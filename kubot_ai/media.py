@@ -0,0 +1,99 @@
+"""
+Telegram ``file_id`` cache for the bot's static images.
+
+Telegram returns a ``file_id`` for every uploaded file, and sending that id
+instead of the bytes reuses the stored copy: no upload, no bandwidth. The id is
+stored in ``MediaCache`` under the asset's path *and* the sha256 of its
+contents, so replacing the image on disk changes the key and the next send
+uploads the new version. Ids of older versions are then removed.
+
+The hash itself is memoized per (path, mtime, size), so a send costs one
+``stat()`` and, after the first lookup in each process, no query.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from telegram.error import BadRequest
+
+from .models import MediaCache
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_hashes = {}  # path -> ((mtime_ns, size), sha256)
+_file_ids = {}  # (path, sha256) -> file_id
+
+
+def content_hash(path):
+    """Return the sha256 of `path`, re-reading the file only when it changed."""
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        cached = _hashes.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    with _lock:
+        _hashes[path] = (signature, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def get_file_id(path, sha256):
+    """Return the cached file_id of this version of `path`, or None."""
+    with _lock:
+        file_id = _file_ids.get((path, sha256))
+    if file_id is None:
+        file_id = MediaCache.objects.filter(path=path, content_hash=sha256).values_list("file_id", flat=True).first()
+        if file_id is not None:
+            with _lock:
+                _file_ids[(path, sha256)] = file_id
+    return file_id
+
+
+def remember_file_id(path, sha256, file_id):
+    """Store `file_id` for this version of `path` and drop older versions."""
+    with transaction.atomic():
+        MediaCache.objects.filter(path=path).exclude(content_hash=sha256).delete()
+        # A concurrent upload from another worker may win; either id works.
+        MediaCache.objects.update_or_create(path=path, content_hash=sha256, defaults={"file_id": file_id})
+    with _lock:
+        _file_ids[(path, sha256)] = file_id
+
+
+def forget_file_id(path, sha256):
+    """Drop a file_id Telegram no longer accepts (e.g. after a bot token change)."""
+    MediaCache.objects.filter(path=path, content_hash=sha256).delete()
+    with _lock:
+        _file_ids.pop((path, sha256), None)
+
+
+async def reply_photo(message, path, **kwargs):
+    """
+    Reply to `message` with the image at `path`, uploading it only if needed.
+
+    Extra keyword arguments go to ``Message.reply_photo``. Returns the sent
+    message.
+    """
+    sha256 = await sync_to_async(content_hash)(path)
+    file_id = await sync_to_async(get_file_id, thread_sensitive=True)(path, sha256)
+    if file_id is not None:
+        try:
+            return await message.reply_photo(photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"⚠️ Cached file_id for {path} rejected ({e}), uploading again")
+            await sync_to_async(forget_file_id, thread_sensitive=True)(path, sha256)
+
+    with open(path, "rb") as photo:
+        sent = await message.reply_photo(photo=photo, **kwargs)
+    if sent and sent.photo:
+        # The last size is the original resolution.
+        await sync_to_async(remember_file_id, thread_sensitive=True)(path, sha256, sent.photo[-1].file_id)
+    return sent
@@ -0,0 +1,364 @@
+"""
+Prometheus metrics for the API and the bot.
+
+:class:`MetricsMiddleware` times every request and labels it with its URL
+name (``reward-list``, ``telegram-webhook``, ...), method and status code.
+A database execute wrapper, installed on every connection by
+``kubot_ai.signals``, counts the queries of the current request and the time
+they take; queries run outside a request (the scheduler, the creditor, ...)
+are counted separately. Recording is a few dict updates under one lock per
+request.
+
+Each worker process keeps its metrics in memory. By default (an empty
+``KUBOT_METRICS_DIR``) ``/metrics`` reports only the worker that answers it.
+With several workers, point ``KUBOT_METRICS_DIR`` at a directory that belongs
+to this deployment alone: each worker then writes a snapshot to
+``<pid>-<instance>.json`` there every ``KUBOT_METRICS_FLUSH_INTERVAL`` seconds,
+from a background thread, and ``/metrics`` sums the counters and histograms
+of every snapshot, so a scrape that lands on any worker sees all of them,
+including workers that have exited since. Gauges (requests in flight) and the
+background component stats (queue, dedup, scheduler, sender, crediting,
+mined_tokens) are only reported for live workers, with a ``pid`` label.
+Clear the directory when the service starts, as with prometheus_client's
+multiprocess mode; every snapshot found there is added in.
+"""
+import contextvars
+import glob
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from rest_framework.permissions import BasePermission
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+DB_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+HISTOGRAMS = {
+    "kubot_http_request_duration_seconds": ("Time to produce a response, by URL name.", LATENCY_BUCKETS),
+    "kubot_http_request_queries": ("Database queries per request, by URL name.", QUERY_BUCKETS),
+    "kubot_http_request_db_seconds": ("Time per request spent in database queries, by URL name.", DB_TIME_BUCKETS),
+}
+COUNTERS = {
+    "kubot_http_requests_total": "Requests by URL name, method and status code.",
+    "kubot_db_queries_total": "Database queries, by whether a request ran them.",
+    "kubot_db_query_seconds_total": "Time spent in database queries, by whether a request ran them.",
+}
+GAUGES = {
+    "kubot_http_requests_in_flight": "Requests being handled.",
+}
+
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+# [queries, seconds] of the request being handled; sync_to_async carries it into the view's thread.
+_request_queries = contextvars.ContextVar("kubot_request_queries", default=None)
+
+
+class Registry:
+    """This process's metrics, plus the snapshots other workers wrote."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> per-bucket counts, then the +Inf count and the sum
+        self._gauges = defaultdict(float)  # (name, labels) -> value
+        self._stats = []  # callables returning {component: {key: number}}
+        self._flusher = None
+        self._instance = None  # (pid, snapshot file name); a forked worker gets its own
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[name, labels] += value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._observe(name, labels, value)
+
+    def add_gauge(self, name, labels=(), delta=1):
+        with self._lock:
+            self._gauges[name, labels] += delta
+
+    def register_stats(self, collect):
+        """Export the numbers of `collect()`, a {component: {key: value}} dict, as ``kubot_<component>_<key>``."""
+        self._stats.append(collect)
+
+    def record_request(self, view, method, status, seconds, queries, db_seconds):
+        """Record one handled request."""
+        if settings.KUBOT_METRICS_DIR and (self._flusher is None or not self._flusher.is_alive()):
+            self.start_flusher()
+        with self._lock:
+            self._counters["kubot_http_requests_total", (("view", view), ("method", method), ("status", status))] += 1
+            self._counters["kubot_db_queries_total", (("source", "request"),)] += queries
+            self._counters["kubot_db_query_seconds_total", (("source", "request"),)] += db_seconds
+            labels = (("view", view),)
+            self._observe("kubot_http_request_duration_seconds", labels, seconds)
+            self._observe("kubot_http_request_queries", labels, queries)
+            self._observe("kubot_http_request_db_seconds", labels, db_seconds)
+
+    def snapshot(self):
+        """Return this process's metrics as a JSON-serializable dict."""
+        stats = {}
+        for collect in self._stats:
+            try:
+                stats.update(collect())
+            except Exception as e:
+                logger.error(f"❌ Collecting stats for metrics failed: {e}")
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "instance": self.instance,
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, labels, list(values)] for (name, labels), values in self._histograms.items()],
+                "gauges": [[name, labels, value] for (name, labels), value in self._gauges.items()],
+                "stats": stats,
+            }
+
+    @property
+    def instance(self):
+        """Name of this process's snapshot file; unique even when a pid is reused."""
+        pid = os.getpid()
+        if self._instance is None or self._instance[0] != pid:
+            self._instance = (pid, f"{pid}-{uuid.uuid4().hex[:12]}")
+        return self._instance[1]
+
+    def start_flusher(self):
+        """Write snapshots every ``KUBOT_METRICS_FLUSH_INTERVAL`` seconds from a daemon thread."""
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_forever, name="kubot-metrics", daemon=True)
+            self._flusher.start()
+
+    def flush(self):
+        """Write this process's snapshot to ``KUBOT_METRICS_DIR``, if one is configured."""
+        directory = settings.KUBOT_METRICS_DIR
+        if directory:
+            self._write(directory, self.snapshot())
+
+    def collect(self):
+        """Return the snapshots of every worker, this one's fresh."""
+        own = self.snapshot()
+        snapshots = [own]
+        directory = settings.KUBOT_METRICS_DIR
+        if not directory:
+            return snapshots
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            try:
+                with open(path) as snapshot:
+                    data = json.load(snapshot)
+            except (OSError, ValueError):
+                continue  # being replaced, or not ours
+            if isinstance(data, dict) and data.get("instance") != own["instance"]:
+                snapshots.append(data)
+        return snapshots
+
+    def render(self):
+        """Return the metrics of every worker in the Prometheus text format."""
+        return render(self.collect())
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(settings.KUBOT_METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ Writing the metrics snapshot failed: {e}")
+
+    def _write(self, directory, snapshot):
+        path = os.path.join(directory, f"{snapshot['instance']}.json")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(f"{path}.tmp", "w") as out:
+                json.dump(snapshot, out)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not write metrics snapshot {path}: {e}")
+
+    def _observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        values = self._histograms.get((name, labels))
+        if values is None:
+            values = self._histograms[name, labels] = [0] * (len(buckets) + 1) + [0.0]
+        values[bisect_left(buckets, value)] += 1
+        values[-1] += value
+
+
+def render(snapshots):
+    """Merge worker snapshots and format them in the Prometheus text format."""
+    counters = defaultdict(float)
+    histograms = {}
+    gauges = defaultdict(float)
+    stats = defaultdict(dict)  # metric name -> {pid: value}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            counters[name, _labels(labels)] += value
+        for name, labels, values in snapshot["histograms"]:
+            merged = histograms.setdefault((name, _labels(labels)), [0] * len(values))
+            for i, value in enumerate(values):
+                merged[i] += value
+        if not _is_alive(snapshot["pid"]):
+            continue
+        for name, labels, value in snapshot["gauges"]:
+            gauges[name, _labels(labels)] += value
+        for component, values in snapshot["stats"].items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    stats[f"kubot_{component}_{key}"][snapshot["pid"]] = value
+
+    lines = []
+    for name, help_text in COUNTERS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", *_samples(name, counters)]
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for (n, labels), values in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip((*buckets, "+Inf"), values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format(labels + (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_format(labels)} {_number(values[-1])}")
+            lines.append(f"{name}_count{_format(labels)} {cumulative}")
+    for name, help_text in GAUGES.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", *_samples(name, gauges)]
+    for name, values in sorted(stats.items()):
+        lines.append(f"# TYPE {name} untyped")
+        lines += [f"{name}{_format((('pid', str(pid)),))} {_number(value)}" for pid, value in sorted(values.items())]
+    return "\n".join(lines) + "\n"
+
+
+def _samples(name, series):
+    """Format the (name, labels) -> value entries of `series` that belong to `name`."""
+    return [f"{name}{_format(labels)} {_number(value)}" for (n, labels), value in sorted(series.items()) if n == name]
+
+
+def _labels(labels):
+    return tuple(tuple(pair) for pair in labels)
+
+
+def _format(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _is_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # exists, but belongs to another user
+    return True
+
+
+# ✅ This process's metrics
+registry = Registry()
+
+
+def instrument(connection):
+    """Count the queries of `connection` (called for every new connection)."""
+    if _instrument_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_instrument_query)
+
+
+def _instrument_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        current = _request_queries.get()
+        if current is not None:
+            current[0] += 1
+            current[1] += elapsed
+        else:
+            registry.inc("kubot_db_queries_total", (("source", "background"),))
+            registry.inc("kubot_db_query_seconds_total", (("source", "background"),), elapsed)
+
+
+class MetricsMiddleware:
+    """Records the latency, status and database use of every request in :data:`registry`."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self._acall(request)
+        started, queries, token = self._start()
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            self._finish(request, response, started, queries, token)
+
+    async def _acall(self, request):
+        started, queries, token = self._start()
+        response = None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            self._finish(request, response, started, queries, token)
+
+    def _start(self):
+        registry.add_gauge("kubot_http_requests_in_flight")
+        queries = [0, 0.0]
+        return time.perf_counter(), queries, _request_queries.set(queries)
+
+    def _finish(self, request, response, started, queries, token):
+        elapsed = time.perf_counter() - started
+        _request_queries.reset(token)
+        registry.add_gauge("kubot_http_requests_in_flight", delta=-1)
+        method = request.method if request.method in METHODS else "other"
+        status = str(response.status_code) if response is not None else "500"
+        registry.record_request(_view_name(request), method, status, elapsed, queries[0], queries[1])
+
+
+def _view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    return match.view_name or match.route
+
+
+class HasMetricsToken(BasePermission):
+    """Allows requests with ``Authorization: Bearer <KUBOT_METRICS_TOKEN>``, when a token is configured."""
+
+    def has_permission(self, request, view):
+        token = settings.KUBOT_METRICS_TOKEN
+        received = request.META.get("HTTP_AUTHORIZATION", "")
+        return bool(token) and hmac.compare_digest(received.encode(), f"Bearer {token}".encode())
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0014_alter_wallet_referral_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.FloatField()),
+                ('kind', models.CharField(choices=[('fund', 'Fund'), ('withdraw', 'Withdraw'), ('referral_bonus', 'Referral bonus')], max_length=32)),
+                ('reference', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='kubot_ai.wallet')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['wallet', 'created_at'], name='kubot_ai_le_wallet__14b4d9_idx')],
+            },
+        ),
+    ]
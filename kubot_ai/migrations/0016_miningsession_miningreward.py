@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0015_ledgerentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MiningReward',
+            fields=[
+                ('user_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('total', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MiningSession',
+            fields=[
+                ('user_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('started_at', models.DateTimeField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0016_miningsession_miningreward'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['referral_id', 'created_at', 'id'], name='kubot_ai_re_referra_130049_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reward',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='kubot_ai_re_user_id_8c4ca0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usertask',
+            index=models.Index(fields=['user', 'completed_at', 'id'], name='kubot_ai_us_user_id_385fc0_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:18
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_completions(apps, schema_editor):
+    """
+    Keep the earliest completion of each (user, task) pair.
+
+    The Reward rows of the deleted duplicates are kept on purpose: they were
+    granted and may already have been paid out, so removing them now would
+    rewrite users' reward history.
+    """
+    UserTask = apps.get_model('kubot_ai', 'UserTask')
+    duplicates = (
+        UserTask.objects.values('user_id', 'task_id')
+        .annotate(first_id=Min('id'), completions=Count('id'))
+        .filter(completions__gt=1)
+        .order_by()
+    )
+    for pair in list(duplicates):
+        UserTask.objects.filter(user_id=pair['user_id'], task_id=pair['task_id']).exclude(id=pair['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0017_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_completions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='usertask',
+            constraint=models.UniqueConstraint(fields=('user', 'task'), name='unique_user_task'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:02
+
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_table(apps, schema_editor):
+    """Create the table used by the default DatabaseCache (no-op for other backends)."""
+    call_command('createcachetable', database=schema_editor.connection.alias, verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0018_unique_user_task'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_table, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0019_create_cache_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('file_id', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='mediacache',
+            constraint=models.UniqueConstraint(fields=('path', 'content_hash'), name='unique_media_version'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0020_mediacache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MiningPayout',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField()),
+                ('chat_id', models.BigIntegerField()),
+                ('first_name', models.CharField(blank=True, default='', max_length=255)),
+                ('amount', models.IntegerField()),
+                ('due_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
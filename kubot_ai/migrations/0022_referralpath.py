@@ -0,0 +1,50 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_referral_paths(apps, schema_editor):
+    """Build the closure rows for the referrals that already exist."""
+    Referral = apps.get_model('kubot_ai', 'Referral')
+    ReferralPath = apps.get_model('kubot_ai', 'ReferralPath')
+    parent = dict(Referral.objects.values_list('referred_user_id', 'referrer_id'))
+
+    batch = []
+    for descendant in parent:
+        ancestor, depth = parent[descendant], 1
+        while ancestor is not None and depth <= settings.KUBOT_REFERRAL_MAX_DEPTH and ancestor != descendant:
+            batch.append(ReferralPath(ancestor_id=ancestor, descendant_id=descendant, depth=depth))
+            ancestor, depth = parent.get(ancestor), depth + 1
+        if len(batch) >= 5000:
+            ReferralPath.objects.bulk_create(batch)
+            batch = []
+    ReferralPath.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0021_miningpayout'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralPath',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='downline_paths', to='kubot_ai.wallet')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upline_paths', to='kubot_ai.wallet')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ancestor', 'depth'], name='kubot_ai_re_ancesto_933de4_idx'), models.Index(fields=['descendant', 'depth'], name='kubot_ai_re_descend_5d17dd_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='referralpath',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_referral_path'),
+        ),
+        migrations.RunPython(backfill_referral_paths, migrations.RunPython.noop),
+    ]
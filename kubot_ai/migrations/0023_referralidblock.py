@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:47
+
+import kubot_ai.referral_ids
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0022_referralpath'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralIdBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reserved_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='wallet',
+            name='referral_id',
+            field=models.CharField(default=kubot_ai.referral_ids.next_referral_id, editable=False, max_length=6, unique=True),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_reward_rollups(apps, schema_editor):
+    """Roll up the rewards that already exist."""
+    Reward = apps.get_model('kubot_ai', 'Reward')
+    RewardRollup = apps.get_model('kubot_ai', 'RewardRollup')
+    rows = (
+        Reward.objects.values('user_id', type=Coalesce('task__task_type', Value('')))
+        .annotate(total=Sum('amount'), count=Count('id'), last_reward_at=Max('created_at'))
+        .order_by()
+    )
+    RewardRollup.objects.bulk_create(
+        (
+            RewardRollup(
+                user_id=row['user_id'], task_type=row['type'], total=row['total'],
+                count=row['count'], last_reward_at=row['last_reward_at'],
+            )
+            for row in rows
+        ),
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0023_referralidblock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RewardRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_type', models.CharField(max_length=50)),
+                ('total', models.BigIntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('last_reward_at', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reward_rollups', to='kubot_ai.wallet')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rewardrollup',
+            constraint=models.UniqueConstraint(fields=('user', 'task_type'), name='unique_reward_rollup'),
+        ),
+        migrations.RunPython(backfill_reward_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0024_rewardrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reward',
+            name='credited_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='kind',
+            field=models.CharField(choices=[('fund', 'Fund'), ('withdraw', 'Withdraw'), ('referral_bonus', 'Referral bonus'), ('task_reward', 'Task reward')], max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='reward',
+            index=models.Index(condition=models.Q(('credited_at__isnull', True)), fields=['id'], name='reward_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kubot_ai', '0025_reward_credited_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='miningreward',
+            name='flushed',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='kind',
+            field=models.CharField(choices=[('fund', 'Fund'), ('withdraw', 'Withdraw'), ('referral_bonus', 'Referral bonus'), ('task_reward', 'Task reward'), ('mining', 'Mining')], max_length=32),
+        ),
+    ]
@@ -0,0 +1,246 @@
+"""
+Mining session and reward stores for the Telegram bot.
+
+The bot handlers only talk to the store returned by :func:`get_mining_store`,
+so sessions and rewards can be shared by every worker process. The backend is
+chosen with the ``KUBOT_MINING_STORE`` setting:
+
+- ``kubot_ai.mining.DatabaseMiningStore`` (default) keeps everything in the
+  database and survives restarts.
+- ``kubot_ai.mining.InMemoryMiningStore`` keeps everything in the current
+  process and is meant for tests and local development.
+
+Sessions expire after ``KUBOT_MINING_SESSION_TTL`` seconds, so a session left
+behind by a crashed worker never blocks a user for long.
+
+Mined totals double as the journal of ``kubot_ai.writebehind``: the part of a
+user's total that is not yet in ``Wallet.balance`` is "unflushed" until
+:meth:`MiningStore.mark_flushed` records it as credited.
+"""
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import MiningReward, MiningSession, Wallet
+
+
+class MiningStore:
+    """Interface shared by all mining store backends."""
+
+    def __init__(self, ttl=None):
+        self.ttl = timedelta(seconds=ttl if ttl is not None else settings.KUBOT_MINING_SESSION_TTL)
+
+    def start_session(self, user_id):
+        """Start a session for `user_id`. Returns False if one is already running."""
+        raise NotImplementedError
+
+    def end_session(self, user_id):
+        """End the session for `user_id`, if any."""
+        raise NotImplementedError
+
+    def has_session(self, user_id):
+        """Return True if `user_id` has a session that has not expired."""
+        raise NotImplementedError
+
+    def add_reward(self, user_id, amount):
+        """Add `amount` mined tokens for `user_id` and return the new total."""
+        raise NotImplementedError
+
+    def get_reward(self, user_id):
+        """Return the mined total for `user_id`, or None if they never mined."""
+        raise NotImplementedError
+
+    def get_unflushed(self, user_ids=None, lock=False):
+        """
+        Return ``{user_id: tokens}`` mined but not yet credited to the wallet.
+
+        Covers `user_ids`, or every user when None. With `lock`, the rows stay
+        locked until the end of the transaction.
+        """
+        raise NotImplementedError
+
+    def unflushed_user_ids(self, after=None, limit=None):
+        """
+        Return, in ascending order, up to `limit` ids above `after` of users
+        who have a wallet and unflushed tokens.
+        """
+        raise NotImplementedError
+
+    def mark_flushed(self, amounts):
+        """Record ``{user_id: tokens}`` as credited to the wallets."""
+        raise NotImplementedError
+
+    def get_balance(self, user_id):
+        """Return the wallet balance of `user_id` plus their unflushed tokens."""
+        balance = Wallet.objects.filter(pk=user_id).values_list("balance", flat=True).first() or 0
+        return balance + self.get_unflushed([user_id]).get(user_id, 0)
+
+
+class InMemoryMiningStore(MiningStore):
+    """Process-local store. Sessions and rewards are lost on restart."""
+
+    def __init__(self, ttl=None):
+        super().__init__(ttl)
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._rewards = {}
+        self._flushed = {}
+
+    def start_session(self, user_id):
+        now = timezone.now()
+        with self._lock:
+            self._purge_expired(now)
+            if user_id in self._sessions:
+                return False
+            self._sessions[user_id] = now + self.ttl
+            return True
+
+    def end_session(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def has_session(self, user_id):
+        with self._lock:
+            expires_at = self._sessions.get(user_id)
+            return expires_at is not None and expires_at > timezone.now()
+
+    def add_reward(self, user_id, amount):
+        with self._lock:
+            total = self._rewards.get(user_id, 0) + amount
+            self._rewards[user_id] = total
+            return total
+
+    def get_reward(self, user_id):
+        with self._lock:
+            return self._rewards.get(user_id)
+
+    def get_unflushed(self, user_ids=None, lock=False):
+        with self._lock:
+            user_ids = self._rewards if user_ids is None else user_ids
+            pending = {user_id: self._rewards.get(user_id, 0) - self._flushed.get(user_id, 0) for user_id in user_ids}
+        return {user_id: tokens for user_id, tokens in pending.items() if tokens > 0}
+
+    def unflushed_user_ids(self, after=None, limit=None):
+        with self._lock:
+            user_ids = sorted(
+                user_id for user_id, total in self._rewards.items()
+                if total > self._flushed.get(user_id, 0) and (after is None or user_id > after)
+            )
+        wallets = set(Wallet.objects.filter(id__in=user_ids).values_list("id", flat=True))
+        return [user_id for user_id in user_ids if user_id in wallets][:limit]
+
+    def mark_flushed(self, amounts):
+        with self._lock:
+            for user_id, tokens in amounts.items():
+                self._flushed[user_id] = self._flushed.get(user_id, 0) + tokens
+
+    def _purge_expired(self, now):
+        for user_id in [user_id for user_id, expires_at in self._sessions.items() if expires_at <= now]:
+            del self._sessions[user_id]
+
+
+class DatabaseMiningStore(MiningStore):
+    """Database-backed store shared by every worker process."""
+
+    # Expired sessions are swept at most this often (seconds) per process.
+    purge_interval = 60
+
+    def __init__(self, ttl=None):
+        super().__init__(ttl)
+        self._last_purge = 0.0
+
+    def start_session(self, user_id):
+        self._maybe_purge()
+        now = timezone.now()
+        with transaction.atomic():
+            MiningSession.objects.filter(user_id=user_id, expires_at__lte=now).delete()
+            try:
+                # The primary key on user_id makes the claim atomic across workers.
+                with transaction.atomic():
+                    MiningSession.objects.create(user_id=user_id, started_at=now, expires_at=now + self.ttl)
+            except IntegrityError:
+                return False
+        return True
+
+    def end_session(self, user_id):
+        MiningSession.objects.filter(user_id=user_id).delete()
+
+    def has_session(self, user_id):
+        return MiningSession.objects.filter(user_id=user_id, expires_at__gt=timezone.now()).exists()
+
+    def add_reward(self, user_id, amount):
+        with transaction.atomic():
+            updated = MiningReward.objects.filter(user_id=user_id).update(total=F("total") + amount)
+            if not updated:
+                try:
+                    with transaction.atomic():
+                        MiningReward.objects.create(user_id=user_id, total=amount)
+                except IntegrityError:
+                    # Another worker created the row first.
+                    MiningReward.objects.filter(user_id=user_id).update(total=F("total") + amount)
+            return MiningReward.objects.values_list("total", flat=True).get(user_id=user_id)
+
+    def get_reward(self, user_id):
+        return MiningReward.objects.filter(user_id=user_id).values_list("total", flat=True).first()
+
+    def get_unflushed(self, user_ids=None, lock=False):
+        rows = MiningReward.objects.filter(total__gt=F("flushed"))
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        if lock:
+            rows = rows.select_for_update()
+        return {user_id: total - flushed for user_id, total, flushed in rows.values_list("user_id", "total", "flushed")}
+
+    def unflushed_user_ids(self, after=None, limit=None):
+        rows = MiningReward.objects.filter(total__gt=F("flushed"), user_id__in=Wallet.objects.values("id"))
+        if after is not None:
+            rows = rows.filter(user_id__gt=after)
+        return list(rows.order_by("user_id").values_list("user_id", flat=True)[:limit])
+
+    def get_balance(self, user_id):
+        # One statement, so a flush committing in between cannot be counted twice or missed.
+        unflushed = MiningReward.objects.filter(user_id=OuterRef("pk"), total__gt=F("flushed"))
+        row = (
+            Wallet.objects.filter(pk=user_id)
+            .annotate(unflushed=Subquery(unflushed.values(tokens=F("total") - F("flushed"))))
+            .values_list("balance", "unflushed")
+            .first()
+        )
+        if row is None:
+            return self.get_unflushed([user_id]).get(user_id, 0)  # Waiting for a wallet
+        balance, tokens = row
+        return balance + (tokens or 0)
+
+    def mark_flushed(self, amounts):
+        for user_id, tokens in amounts.items():
+            MiningReward.objects.filter(user_id=user_id).update(flushed=F("flushed") + tokens)
+
+    def purge_expired(self):
+        """Delete every expired session."""
+        MiningSession.objects.filter(expires_at__lte=timezone.now()).delete()
+
+    def _maybe_purge(self):
+        if time.monotonic() - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = time.monotonic()
+        self.purge_expired()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_mining_store():
+    """Return the process-wide store configured by ``KUBOT_MINING_STORE``."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = import_string(settings.KUBOT_MINING_STORE)()
+    return _store
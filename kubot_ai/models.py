@@ -1,8 +1,7 @@
 from django.db import models
 from django.contrib.auth import get_user_model
-import uuid
-import random
-import string
+
+from .referral_ids import next_referral_id
 
 # ✅ Task model
 class Task(models.Model):
@@ -25,6 +24,10 @@ class UserTask(models.Model):
     completed_at = models.DateTimeField(auto_now_add=True)
     reward_claimed = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [models.Index(fields=["user", "completed_at", "id"])]
+        constraints = [models.UniqueConstraint(fields=["user", "task"], name="unique_user_task")]
+
     def __str__(self):
         return f"{self.user.user} - {self.task}"
 
@@ -34,35 +37,168 @@ class Reward(models.Model):
     task = models.ForeignKey(Task, on_delete=models.SET_NULL, null=True, blank=True)
     amount = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
+    credited_at = models.DateTimeField(null=True, blank=True)  # Set by kubot_ai.crediting once in Wallet.balance
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_at", "id"]),
+            models.Index(fields=["id"], condition=models.Q(credited_at__isnull=True), name="reward_pending_idx"),
+        ]
 
     def __str__(self):
         return f"{self.user.user} - {self.amount} tokens"
 
 
+# ✅ RewardRollup model: running reward totals per user and task type
+class RewardRollup(models.Model):
+    """
+    Maintained by kubot_ai.rollups as rewards are written; rebuilt from the
+    Reward rows by the rebuild_reward_rollups command.
+    """
+    user = models.ForeignKey("Wallet", on_delete=models.CASCADE, related_name="reward_rollups")
+    task_type = models.CharField(max_length=50)  # "" for rewards whose task was deleted
+    total = models.BigIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+    last_reward_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["user", "task_type"], name="unique_reward_rollup")]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.task_type}: {self.total} tokens"
+
+
 # ✅ Referral model
 class Referral(models.Model):
     referrer = models.ForeignKey("Wallet", on_delete=models.CASCADE, related_name="referrals")
     referred_user = models.OneToOneField("Wallet", on_delete=models.CASCADE, related_name="referred_by")
     referral_id = models.CharField(max_length=6, null=True, blank=True)
-    reward_amount = models.IntegerField(default=5)  # 5 tokens for first-level referral
+    reward_amount = models.IntegerField(default=5)  # 5 tokens for first-level referral (see KUBOT_REFERRAL_TIERS)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["referral_id", "created_at", "id"])]
+
+
+# ✅ ReferralPath model: closure table of the referral tree
+class ReferralPath(models.Model):
+    """
+    One row per (ancestor, descendant) pair in the referral tree, up to
+    KUBOT_REFERRAL_MAX_DEPTH levels apart. Depth 1 is the direct referrer.
+    """
+
+    ancestor = models.ForeignKey("Wallet", on_delete=models.CASCADE, related_name="downline_paths")
+    descendant = models.ForeignKey("Wallet", on_delete=models.CASCADE, related_name="upline_paths")
+    depth = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["ancestor", "descendant"], name="unique_referral_path")]
+        indexes = [
+            models.Index(fields=["ancestor", "depth"]),  # downline counts per level
+            models.Index(fields=["descendant", "depth"]),  # upline for tiered bonuses
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} (L{self.depth})"
+
 
 # ✅ Wallet model
 class Wallet(models.Model):
-    
-    def generate_referral_id():
-        chars = string.ascii_uppercase + string.digits
-        unique_part = str(uuid.uuid4().int)[:6]
-        random_part = ''.join(random.choices(chars, k=6))
-        return f"{random_part[:3]}{unique_part[:3]}"
-
 
     id = models.BigIntegerField(primary_key=True)
     user = models.CharField(max_length=255, unique=True)
     eth_address = models.CharField(max_length=255, unique=True)
     balance = models.FloatField(default=0.0)
-    referral_id = models.CharField(max_length=6, unique=True, editable=False, default=generate_referral_id())
+    referral_id = models.CharField(max_length=6, unique=True, editable=False, default=next_referral_id)
 
     def __str__(self):
         return f"{self.user} - {self.balance} ETH"
+
+
+# ✅ ReferralIdBlock model: one row per block of referral ID sequence numbers
+class ReferralIdBlock(models.Model):
+    """Reserved by kubot_ai.referral_ids; the id is all that matters."""
+
+    reserved_at = models.DateTimeField(auto_now_add=True)
+
+
+# ✅ LedgerEntry model: append-only record of every balance change
+class LedgerEntry(models.Model):
+    FUND = "fund"
+    WITHDRAW = "withdraw"
+    REFERRAL_BONUS = "referral_bonus"
+    TASK_REWARD = "task_reward"
+    MINING = "mining"
+    KIND_CHOICES = [
+        (FUND, "Fund"),
+        (WITHDRAW, "Withdraw"),
+        (REFERRAL_BONUS, "Referral bonus"),
+        (TASK_REWARD, "Task reward"),
+        (MINING, "Mining"),
+    ]
+
+    wallet = models.ForeignKey("Wallet", on_delete=models.CASCADE, related_name="ledger_entries")
+    amount = models.FloatField()  # Signed: credits are positive, debits negative
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    reference = models.CharField(max_length=255, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["wallet", "created_at"])]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Ledger entries are immutable.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger entries are immutable.")
+
+    def __str__(self):
+        return f"{self.wallet_id} {self.kind} {self.amount}"
+
+
+# ✅ MiningSession model: one active mining session per Telegram user
+class MiningSession(models.Model):
+    user_id = models.BigIntegerField(primary_key=True)  # Telegram user id
+    started_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.user_id} mining until {self.expires_at}"
+
+
+# ✅ MiningReward model: running total of mined tokens per Telegram user
+class MiningReward(models.Model):
+    user_id = models.BigIntegerField(primary_key=True)  # Telegram user id
+    total = models.IntegerField(default=0)
+    flushed = models.IntegerField(default=0)  # Part of total already credited to Wallet.balance
+
+    def __str__(self):
+        return f"{self.user_id} - {self.total} tokens"
+
+
+# ✅ MediaCache model: Telegram file_id of an uploaded static asset
+class MediaCache(models.Model):
+    path = models.CharField(max_length=255)
+    content_hash = models.CharField(max_length=64)  # sha256 of the file contents
+    file_id = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["path", "content_hash"], name="unique_media_version")]
+
+    def __str__(self):
+        return f"{self.path} ({self.content_hash[:8]})"
+
+
+# ✅ MiningPayout model: reward of a running mining session, paid out when due
+class MiningPayout(models.Model):
+    user_id = models.BigIntegerField()  # Telegram user id
+    chat_id = models.BigIntegerField()  # Where the "session ended" message goes
+    first_name = models.CharField(max_length=255, blank=True, default="")
+    amount = models.IntegerField()
+    due_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.user_id} - {self.amount} tokens at {self.due_at}"
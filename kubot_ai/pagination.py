@@ -0,0 +1,138 @@
+"""
+Keyset (cursor) pagination for the Kubot API.
+
+Pages are selected with ``WHERE (a, b) > (last_a, last_b) ORDER BY a, b LIMIT n``
+instead of an OFFSET, so every page costs the same indexed range scan no
+matter how deep the client has scrolled. The cursor is an opaque token that
+encodes the ordering values of the last row on the previous page.
+
+Pagination is opt-in per view; it is not installed as DRF's
+``DEFAULT_PAGINATION_CLASS``, so no endpoint changes shape by accident.
+"""
+import datetime
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginate a queryset on a stable, unique ordering.
+
+    `ordering` must end with a unique field (usually ``id``) so that rows
+    sharing the leading values still have a strict order. Prefix a field with
+    ``-`` to walk it in descending order.
+
+    Query parameters:
+    - `cursor`: token from the previous page's `next` link.
+    - `limit`: page size, ``KUBOT_PAGE_SIZE`` by default and capped at
+      ``KUBOT_MAX_PAGE_SIZE``.
+
+    Views that already answer with an envelope add ``get_next_link()`` to it
+    as `next`. `get_paginated_response` is for endpoints that return a bare
+    array: the body stays a list and the next page is advertised in a
+    ``Link: <url>; rel="next"`` header.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+    ordering = ("id",)
+    invalid_cursor_message = "Invalid cursor."
+
+    def __init__(self, ordering=None):
+        if ordering is not None:
+            self.ordering = tuple(ordering)
+        self.request = None
+        self.next_position = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            queryset = queryset.filter(self._after(position))
+
+        rows = list(queryset[: self.page_size + 1])
+        has_next = len(rows) > self.page_size
+        rows = rows[: self.page_size]
+        self.next_position = [_value(rows[-1], name) for name, _ in self._fields()] if has_next else None
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.KUBOT_PAGE_SIZE
+        return max(1, min(page_size, settings.KUBOT_MAX_PAGE_SIZE))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        response = Response(data)
+        next_link = self.get_next_link()
+        if next_link is not None:
+            response["Link"] = f'<{next_link}>; rel="next"'
+        return response
+
+    def get_paginated_response_schema(self, schema):
+        return schema
+
+    def encode_cursor(self, position):
+        payload = json.dumps(position, cls=_CursorEncoder, separators=(",", ":"))
+        return urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+    def decode_cursor(self, request, model):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            padded = token + "=" * (-len(token) % 4)
+            values = json.loads(urlsafe_b64decode(padded.encode()))
+            fields = self._fields()
+            if not isinstance(values, list) or len(values) != len(fields):
+                raise ValueError
+            return [model._meta.get_field(name).to_python(value) for (name, _), value in zip(fields, values)]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def _fields(self):
+        """Return (field name, descending) pairs for the ordering."""
+        return [(field.lstrip("-"), field.startswith("-")) for field in self.ordering]
+
+    def _after(self, position):
+        """Build the row-value comparison `(a, b, ...) > (x, y, ...)` as a Q object."""
+        condition = Q()
+        equal = Q()
+        for (name, descending), value in zip(self._fields(), position):
+            lookup = f"{name}__lt" if descending else f"{name}__gt"
+            condition |= equal & Q(**{lookup: value})
+            equal &= Q(**{name: value})
+        return condition
+
+
+class _CursorEncoder(DjangoJSONEncoder):
+    """Keep full microsecond precision; DjangoJSONEncoder rounds to milliseconds."""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+def _value(row, name):
+    if isinstance(row, dict):
+        return row[name]
+    return getattr(row, name)
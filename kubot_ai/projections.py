@@ -0,0 +1,145 @@
+"""
+Read-only projections of the API serializers.
+
+Serializing a page of model instances with a ``ModelSerializer`` spends most
+of its time in DRF's per-object, per-field machinery (``get_attribute``,
+``PKOnlyObject`` wrappers, nested serializer calls), on top of building the
+model instances themselves. A :class:`Projection` reads the same columns with
+``.values()`` and turns each row dict into the serializer's output with a list
+of converters compiled once from the serializer's fields, in the same field
+order and with the same conversions, so the rendered JSON is byte-identical.
+Converters are compiled per active time zone, so datetimes are converted
+without looking the zone up for every value.
+
+Only the field types the API serializers use are supported; compiling a
+serializer with any other field raises ``TypeError``, so a serializer change
+that a projection cannot follow fails loudly (and in the conformance tests)
+instead of drifting.
+"""
+from functools import cached_property
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+from .serializers import (
+    ReferralSerializer, RewardSerializer, UserTaskSerializer, WalletCreateSerializer, WalletSerializer,
+)
+
+
+class Projection:
+    """Serialize ``.values()`` rows the way `serializer_class` serializes instances."""
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self._row_converters = {}  # active time zone -> compiled row converter
+
+    @cached_property
+    def paths(self):
+        """The ``.values()`` lookups the projection reads."""
+        paths = []
+        _compile(self.serializer_class(), "", paths, None)
+        return paths
+
+    def values(self, queryset):
+        """Return `queryset` as the row dicts :meth:`project` expects."""
+        return queryset.values(*self.paths)
+
+    def project(self, rows):
+        """Return the serializer's representation of each row, as a list."""
+        convert_row = self._row_converter()
+        return [convert_row(row) for row in rows]
+
+    def project_one(self, row):
+        """Return the serializer's representation of one row."""
+        return self._row_converter()(row)
+
+    def _row_converter(self):
+        # DRF's DateTimeField converts to the time zone active when it serializes.
+        zone = timezone.get_current_timezone() if settings.USE_TZ else None
+        convert_row = self._row_converters.get(zone)
+        if convert_row is None:
+            convert_row = self._row_converters[zone] = _compile(self.serializer_class(), "", [], zone)
+        return convert_row
+
+
+def _compile(serializer, prefix, paths, zone):
+    """Return a function mapping a row dict to `serializer`'s representation, adding its lookups to `paths`."""
+    entries = []  # (output name, row key, converter or None, nested row converter or None)
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if len(field.source_attrs) != 1:
+            raise TypeError(f"Cannot project {type(serializer).__name__}.{name}: source {field.source!r}.")
+        key = prefix + field.source
+
+        if isinstance(field, serializers.ModelSerializer):
+            # A missing related object has a NULL primary key after the LEFT JOIN.
+            pk_key = f"{key}__{field.Meta.model._meta.pk.name}"
+            if pk_key not in paths:
+                paths.append(pk_key)
+            entries.append((name, pk_key, None, _compile(field, f"{key}__", paths, zone)))
+            continue
+
+        if key not in paths:
+            paths.append(key)
+        entries.append((name, key, _converter(serializer, name, field, zone), None))
+
+    def convert_row(row):
+        data = {}
+        for name, key, convert, nested in entries:
+            value = row[key]
+            if value is None:
+                data[name] = None
+            elif nested is not None:
+                data[name] = nested(row)
+            else:
+                data[name] = convert(value) if convert is not None else value
+        return data
+
+    return convert_row
+
+
+def _converter(serializer, name, field, zone):
+    """Return the fast equivalent of ``field.to_representation`` for a non-None value."""
+    if isinstance(field, serializers.PrimaryKeyRelatedField) and field.pk_field is None:
+        return None  # .values() already gives the primary key
+    if isinstance(field, serializers.BooleanField):
+        return bool
+    if isinstance(field, serializers.IntegerField):
+        return int
+    if isinstance(field, serializers.FloatField):
+        return float
+    if isinstance(field, serializers.CharField):
+        return str
+    if isinstance(field, serializers.DateTimeField):
+        output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+        if output_format is not None and output_format.lower() == ISO_8601:
+            return _iso_datetime(field, zone)
+    raise TypeError(f"Cannot project {type(serializer).__name__}.{name}: {type(field).__name__}.")
+
+
+def _iso_datetime(field, zone):
+    # Fields with their own time zone, naive values and overflows take DRF's own path.
+    fast = zone is not None and not hasattr(field, "timezone")
+
+    def convert(value):
+        if fast and value.utcoffset() is not None:
+            try:
+                value = value.astimezone(zone)
+            except OverflowError:
+                value = field.enforce_timezone(value)
+        else:
+            value = field.enforce_timezone(value)
+        value = value.isoformat()
+        return value[:-6] + "Z" if value.endswith("+00:00") else value
+    return convert
+
+
+# ✅ Projections used by the read endpoints
+wallets = Projection(WalletSerializer)
+new_wallets = Projection(WalletCreateSerializer)
+rewards = Projection(RewardSerializer)
+user_tasks = Projection(UserTaskSerializer)
+referrals = Projection(ReferralSerializer)
@@ -0,0 +1,92 @@
+"""
+Referral ID allocation.
+
+Referral IDs are six base-36 characters. Instead of drawing random codes and
+hoping the unique index agrees, each worker reserves a block of
+``ReferralIdAllocator.block_size`` sequence numbers with one INSERT into
+``ReferralIdBlock`` and hands them out from memory. Block ``n`` covers the
+numbers ``[n * block_size, (n + 1) * block_size)``, so workers never share a
+number, and a signup costs no extra query except once per block.
+
+Numbers are turned into codes by a fixed bijection on the 36^6 code space (an
+affine permutation followed by base-36 encoding), so consecutive signups do
+not get consecutive-looking codes. Codes whose last three characters are all
+digits are skipped: that is the format the old random generator produced
+(three random characters, three digits), so new codes can never collide with
+a legacy one. That leaves about 2.1 billion codes.
+
+Numbers left in a worker's block when it exits are never used. PostgreSQL
+never hands out a sequence value twice, even if the INSERT that reserved a
+block is rolled back.
+"""
+import string
+import threading
+
+ALPHABET = string.digits + string.ascii_uppercase
+LENGTH = 6
+SPACE = len(ALPHABET) ** LENGTH
+
+# x -> (x * MULTIPLIER + OFFSET) % SPACE is a bijection because MULTIPLIER is coprime to 36.
+MULTIPLIER = 1_442_968_193
+OFFSET = 738_469_217
+
+
+def encode(number):
+    """Return the referral ID for sequence `number`."""
+    value = (number * MULTIPLIER + OFFSET) % SPACE
+    chars = []
+    for _ in range(LENGTH):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return "".join(reversed(chars))
+
+
+def is_legacy(code):
+    """Whether `code` has the format of the old random generator."""
+    return code[3:].isdigit()
+
+
+class ReferralIdAllocator:
+    """Hands out unique referral IDs from blocks reserved in the database."""
+
+    # Changing this would make new blocks overlap old ones.
+    block_size = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+
+        self.blocks = 0
+        self.allocated = 0
+
+    def allocate(self):
+        """Return a referral ID that no other wallet has or will get."""
+        with self._lock:
+            while True:
+                if self._next >= self._end:
+                    self._reserve_block()
+                code = encode(self._next)
+                self._next += 1
+                if not is_legacy(code):
+                    self.allocated += 1
+                    return code
+
+    def stats(self):
+        return {"blocks": self.blocks, "allocated": self.allocated, "remaining": self._end - self._next}
+
+    def _reserve_block(self):
+        from .models import ReferralIdBlock
+
+        block = ReferralIdBlock.objects.create()
+        self._next, self._end = block.pk * self.block_size, (block.pk + 1) * self.block_size
+        if self._end > SPACE:
+            raise RuntimeError("Referral ID space exhausted.")
+        self.blocks += 1
+
+
+allocator = ReferralIdAllocator()
+
+
+def next_referral_id():
+    """Default for ``Wallet.referral_id``."""
+    return allocator.allocate()
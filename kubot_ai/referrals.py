@@ -0,0 +1,78 @@
+"""
+Multi-level referral tree.
+
+Besides the ``Referral`` row (direct referrer only), every signup writes its
+ancestry to the ``ReferralPath`` closure table: one row per ancestor up to
+``KUBOT_REFERRAL_MAX_DEPTH`` levels up. That makes both directions one
+indexed query:
+
+- the upline of a wallet, for tiered bonuses: ``descendant = w AND depth <= n``;
+- the team of a wallet per level: ``ancestor = w GROUP BY depth``.
+
+:func:`register_referral` is the only place referrals are created, for the
+bot's ``/start`` and for ``ReferralRegisterView``.
+"""
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from . import leaderboard, ledger
+from .models import LedgerEntry, Referral, ReferralPath
+
+
+def register_referral(referrer, new_wallet, referral_id):
+    """
+    Record that `referrer` referred `new_wallet` and pay the tiered bonuses.
+
+    The level-1 bonus is the referral's ``reward_amount``; levels 2 and up get
+    ``KUBOT_REFERRAL_TIERS``. Everything happens in one transaction. Returns the
+    new Referral.
+    """
+    with transaction.atomic():
+        referral = Referral.objects.create(referrer=referrer, referred_user=new_wallet, referral_id=referral_id)
+        transaction.on_commit(partial(leaderboard.referral_added, referrer.pk))
+
+        upline = list(
+            ReferralPath.objects.filter(descendant=referrer, depth__lt=settings.KUBOT_REFERRAL_MAX_DEPTH)
+            .values_list("ancestor_id", "depth")
+        )
+        ReferralPath.objects.bulk_create(
+            [ReferralPath(ancestor_id=referrer.pk, descendant_id=new_wallet.pk, depth=1)]
+            + [ReferralPath(ancestor_id=ancestor, descendant_id=new_wallet.pk, depth=depth + 1)
+               for ancestor, depth in upline]
+        )
+
+        # ✅ Credit the upline through the ledger
+        tiers = settings.KUBOT_REFERRAL_TIERS
+        bonuses = [(referrer.pk, referral.reward_amount, 1)] + [
+            (ancestor, tiers[depth], depth + 1) for ancestor, depth in upline if depth < len(tiers)
+        ]
+        for wallet_id, amount, level in bonuses:
+            if amount > 0:
+                ledger.credit(
+                    wallet_id, amount, LedgerEntry.REFERRAL_BONUS, reference=f"referral:{referral.pk}:L{level}"
+                )
+    return referral
+
+
+def get_upline(wallet_id, levels=None):
+    """Return ``[(ancestor_id, depth)]`` nearest first, up to `levels` levels up."""
+    levels = levels if levels is not None else len(settings.KUBOT_REFERRAL_TIERS)
+    return list(
+        ReferralPath.objects.filter(descendant_id=wallet_id, depth__lte=levels)
+        .order_by("depth")
+        .values_list("ancestor_id", "depth")
+    )
+
+
+def get_team_size(wallet_id):
+    """Return ``{depth: count}`` of the wallets below `wallet_id`, per level."""
+    return dict(
+        ReferralPath.objects.filter(ancestor_id=wallet_id)
+        .values_list("depth")
+        .annotate(count=Count("id"))
+        .order_by("depth")
+        .values_list("depth", "count")
+    )
@@ -0,0 +1,97 @@
+"""
+Per-user reward rollups.
+
+``RewardRollup`` keeps, per wallet and task type, the total and number of
+rewards and the time of the last one. :func:`record_rewards` is called by
+``kubot_ai.completion`` in the transaction that writes the ``Reward`` rows,
+so the rollups always agree with them, and :func:`get_summary` reads a user's
+few rollup rows however long their reward history is.
+
+:func:`rebuild` recomputes rollups from the ``Reward`` rows (the
+``rebuild_reward_rollups`` command). It files rewards under the current type
+of their task, and under ``""`` once the task has been deleted.
+"""
+from collections import defaultdict
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Reward, RewardRollup, Wallet
+
+
+def record_rewards(user_id, rewards):
+    """
+    Add `rewards` (Reward instances with their task) to the rollups of `user_id`.
+
+    Call it inside the transaction that creates them.
+    """
+    groups = defaultdict(lambda: [0, 0, None])
+    for reward in rewards:
+        group = groups[reward.task.task_type if reward.task else ""]
+        group[0] += reward.amount
+        group[1] += 1
+        group[2] = reward.created_at if group[2] is None else max(group[2], reward.created_at)
+
+    for task_type, (total, count, last_reward_at) in groups.items():
+        rollup = RewardRollup.objects.filter(user_id=user_id, task_type=task_type)
+        changes = {
+            "total": F("total") + total,
+            "count": F("count") + count,
+            "last_reward_at": Greatest("last_reward_at", Value(last_reward_at)),
+        }
+        if rollup.update(**changes):
+            continue
+        try:
+            with transaction.atomic():
+                RewardRollup.objects.create(
+                    user_id=user_id, task_type=task_type, total=total, count=count, last_reward_at=last_reward_at
+                )
+        except IntegrityError:
+            # Another worker created the row first.
+            rollup.update(**changes)
+
+
+def get_summary(username):
+    """Return the reward summary of `username`, or None if they have no wallet."""
+    rows = list(
+        RewardRollup.objects.filter(user__user=username).values_list("task_type", "total", "count", "last_reward_at")
+    )
+    if not rows and not Wallet.objects.filter(user=username).exists():
+        return None
+    return {
+        "total": sum(total for _, total, _, _ in rows),
+        "count": sum(count for _, _, count, _ in rows),
+        "by_task_type": {task_type: total for task_type, total, _, _ in sorted(rows)},
+        "last_reward_at": max((last for _, _, _, last in rows), default=None),
+    }
+
+
+def rebuild(user_ids=None, batch_size=5000):
+    """Recompute the rollups of `user_ids` (all users by default). Returns the number of rollup rows."""
+    rewards = Reward.objects.all()
+    rollups = RewardRollup.objects.all()
+    if user_ids is not None:
+        rewards = rewards.filter(user_id__in=user_ids)
+        rollups = rollups.filter(user_id__in=user_ids)
+
+    rows = (
+        rewards.values("user_id", type=Coalesce("task__task_type", Value("")))
+        .annotate(total=Sum("amount"), count=Count("id"), last_reward_at=Max("created_at"))
+        .order_by()
+        .iterator(chunk_size=batch_size)
+    )
+    created = 0
+    with transaction.atomic():
+        rollups.delete()
+        while batch := list(islice(rows, batch_size)):
+            RewardRollup.objects.bulk_create(
+                RewardRollup(
+                    user_id=row["user_id"], task_type=row["type"], total=row["total"],
+                    count=row["count"], last_reward_at=row["last_reward_at"],
+                )
+                for row in batch
+            )
+            created += len(batch)
+    return created
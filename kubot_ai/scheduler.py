@@ -0,0 +1,141 @@
+"""
+Durable scheduler for mining session payouts.
+
+``/mine`` writes a ``MiningPayout`` row with the time the session ends instead
+of keeping a sleeping task per miner. Each worker runs one
+:class:`MiningScheduler` task that polls the ``due_at`` index for payouts that
+are due and fires them in batches, so memory per worker stays constant however
+many users are mining, and payouts left behind by a restart are picked up by
+the first poll after it.
+
+Several workers can poll the same table. A batch is *leased* by moving its
+``due_at`` forward by ``lease`` seconds (rows locked by another worker are
+skipped where the database supports it). A payout is then paid by deleting
+its row and crediting the reward in one transaction, guarded on the leased
+``due_at``. A payout whose lease expired and was taken over elsewhere is
+therefore never paid twice, and one left behind by a crashed worker becomes
+due again once its lease runs out.
+
+The "session ended" message is sent after the payout commits, so it is sent
+at most once; the reward itself is never lost.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import MiningPayout
+
+logger = logging.getLogger(__name__)
+
+
+def schedule_payout(user_id, chat_id, first_name, amount, delay):
+    """Pay `amount` to `user_id` in `delay` seconds. Returns the MiningPayout."""
+    return MiningPayout.objects.create(
+        user_id=user_id,
+        chat_id=chat_id,
+        first_name=first_name or "",
+        amount=amount,
+        due_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+class MiningScheduler:
+    """Polls for due payouts and pays them in batches."""
+
+    def __init__(self, store, notify, poll_interval=None, batch_size=None, lease=None):
+        self.store = store
+        self.notify = notify  # async callable(payout, total)
+        self.poll_interval = poll_interval if poll_interval is not None else settings.KUBOT_SCHEDULER_POLL_INTERVAL
+        self.batch_size = batch_size if batch_size is not None else settings.KUBOT_SCHEDULER_BATCH_SIZE
+        self.lease = timedelta(seconds=lease if lease is not None else settings.KUBOT_SCHEDULER_LEASE)
+        self._task = None
+
+        self.fired = 0
+        self.failed = 0
+        self.lag_max = 0.0
+
+    def claim_due(self):
+        """Lease up to `batch_size` due payouts and return them."""
+        now = timezone.now()
+        with transaction.atomic():
+            due = MiningPayout.objects.filter(due_at__lte=now).order_by("due_at")
+            if connection.features.has_select_for_update_skip_locked:
+                due = due.select_for_update(skip_locked=True)
+            payouts = list(due[: self.batch_size])
+            if payouts:
+                MiningPayout.objects.filter(id__in=[payout.id for payout in payouts]).update(due_at=now + self.lease)
+        for payout in payouts:
+            self.lag_max = max(self.lag_max, (now - payout.due_at).total_seconds())
+            payout.due_at = now + self.lease
+        return payouts
+
+    def pay(self, payout):
+        """Pay one leased payout. Returns the user's new total, or None if it was paid elsewhere."""
+        with transaction.atomic():
+            deleted, _ = MiningPayout.objects.filter(id=payout.id, due_at=payout.due_at).delete()
+            if not deleted:
+                return None
+            total = self.store.add_reward(payout.user_id, payout.amount)
+            self.store.end_session(payout.user_id)
+        return total
+
+    def fire_due(self):
+        """Pay one batch of due payouts. Returns ``[(payout, total)]`` for the ones paid here."""
+        paid = []
+        for payout in self.claim_due():
+            try:
+                total = self.pay(payout)
+            except Exception as e:
+                # The row survives and becomes due again when the lease runs out.
+                self.failed += 1
+                logger.error(f"❌ Error paying out mining session of {payout.user_id}: {e}")
+                continue
+            if total is not None:
+                self.fired += 1
+                paid.append((payout, total))
+        return paid
+
+    async def run(self):
+        """Fire due payouts until cancelled."""
+        logger.info("⏰ Mining scheduler started")
+        while True:
+            try:
+                paid = await sync_to_async(self.fire_due, thread_sensitive=True)()
+            except Exception as e:
+                logger.error(f"❌ Mining scheduler poll failed: {e}")
+                paid = []
+            for payout, total in paid:
+                try:
+                    await self.notify(payout, total)
+                except Exception as e:
+                    logger.error(f"❌ Error notifying {payout.user_id} of their mining payout: {e}")
+            # A full batch means more may be due already.
+            if len(paid) < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        """Start polling on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        """Stop polling. Unpaid payouts stay in the table for the next start."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self):
+        """Return a snapshot of the scheduler's counters."""
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "fired": self.fired,
+            "failed": self.failed,
+            "lag_max": self.lag_max,
+        }
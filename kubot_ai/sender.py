@@ -0,0 +1,230 @@
+"""
+Outbound Telegram message pipeline.
+
+Every message the bot sends goes through :class:`MessageSender`, which
+
+- waits for a token from a global bucket (Telegram allows about 30 messages
+  per second per bot) and from a per-chat bucket (about one per second per
+  chat, with a small burst), instead of running into 429s;
+- drops a message when its chat would have to wait longer than
+  ``chat_max_wait`` for a token. Sends run inside the webhook update workers,
+  so one chat flooding the bot must not hold them while other chats' updates
+  wait in the queue;
+- retries network errors with capped exponential backoff and honours the
+  ``retry_after`` of a 429, up to ``max_retries`` per message and within a
+  process-wide retry budget, so an outage cannot turn into a retry storm;
+- coalesces identical text messages to the same chat while one is in
+  flight, so a user hammering /balance gets one answer, not ten.
+
+Errors that a retry cannot fix (bad request, blocked bot) are raised at
+once. When retries run out the last error is raised too; callers log it.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations.
+
+    `reserve()` takes a token and returns how long the caller must wait for
+    it, so concurrent callers are served in order instead of polling.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now=None, max_wait=None):
+        """
+        Take a token and return the seconds until it is available.
+
+        If that would be longer than `max_wait`, no token is taken and None is
+        returned.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        if max_wait is not None and wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    def try_take(self, now=None):
+        """Take a token if one is available now. Returns False otherwise."""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class MessageSender:
+    """Rate-limited, retrying, coalescing sender shared by all bot handlers."""
+
+    # Per-chat buckets kept in memory; idle (full) buckets are dropped first.
+    max_chats = 10000
+
+    def __init__(
+        self, global_rate=None, chat_rate=None, chat_burst=None, chat_max_wait=None, max_retries=None,
+        retry_rate=None, base_delay=0.5, max_delay=10.0,
+    ):
+        global_rate = global_rate if global_rate is not None else settings.KUBOT_SEND_GLOBAL_RATE
+        self.chat_rate = chat_rate if chat_rate is not None else settings.KUBOT_SEND_CHAT_RATE
+        self.chat_burst = chat_burst if chat_burst is not None else settings.KUBOT_SEND_CHAT_BURST
+        self.chat_max_wait = chat_max_wait if chat_max_wait is not None else settings.KUBOT_SEND_CHAT_MAX_WAIT
+        self.max_retries = max_retries if max_retries is not None else settings.KUBOT_SEND_MAX_RETRIES
+        retry_rate = retry_rate if retry_rate is not None else settings.KUBOT_SEND_RETRY_RATE
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._retry_budget = TokenBucket(retry_rate, retry_rate * 10)
+        self._chats = OrderedDict()  # chat_id -> TokenBucket
+        self._inflight = {}  # (chat_id, key) -> Task
+
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.budget_exhausted = 0
+        self.coalesced = 0
+        self.throttle_total = 0.0
+        self.throttle_max = 0.0
+
+    async def reply_text(self, message, text, **kwargs):
+        """Send `text` as a reply to `message` (``Message.reply_text``)."""
+        key = ("text", text) if not kwargs else None
+        return await self.send(message.chat_id, lambda: message.reply_text(text, **kwargs), key=key)
+
+    async def send_message(self, bot, chat_id, text, **kwargs):
+        """Send `text` to `chat_id` (``Bot.send_message``)."""
+        key = ("text", text) if not kwargs else None
+        return await self.send(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs), key=key)
+
+    async def send(self, chat_id, call, key=None):
+        """
+        Run `call()` (a coroutine factory doing one Bot API send) for `chat_id`.
+
+        Sends sharing a non-None `key` for the same chat while one is in flight
+        are coalesced and get its result. Returns None if the send was dropped
+        because the chat is over its rate limit.
+        """
+        if key is not None:
+            inflight = self._inflight.get((chat_id, key))
+            if inflight is not None and not inflight.done():
+                self.coalesced += 1
+                return await asyncio.shield(inflight)
+            task = asyncio.ensure_future(self._send(chat_id, call))
+            self._inflight[(chat_id, key)] = task
+            task.add_done_callback(lambda _: self._inflight.pop((chat_id, key), None))
+            return await asyncio.shield(task)
+        return await self._send(chat_id, call)
+
+    def stats(self):
+        """Return a snapshot of the sender's counters."""
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "budget_exhausted": self.budget_exhausted,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+            "chats": len(self._chats),
+            "throttle_total": self.throttle_total,
+            "throttle_max": self.throttle_max,
+        }
+
+    async def _send(self, chat_id, call):
+        attempt = 0
+        while True:
+            if not await self._throttle(chat_id):
+                self.dropped += 1
+                logger.warning(f"⚠️ Chat {chat_id} is over its rate limit, dropped a message")
+                return None
+            try:
+                result = await call()
+            except RetryAfter as e:
+                self.rate_limited += 1
+                error, delay = e, _seconds(e.retry_after)
+            except BadRequest:
+                # Subclass of NetworkError, but retrying cannot fix it.
+                self.failed += 1
+                raise
+            except (NetworkError, asyncio.TimeoutError) as e:
+                error = e
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            except Exception:
+                self.failed += 1
+                raise
+            else:
+                self.sent += 1
+                return result
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self.failed += 1
+                logger.error(f"❌ Giving up sending to chat {chat_id} after {attempt} attempts: {error}")
+                raise error
+            if not self._retry_budget.try_take():
+                self.budget_exhausted += 1
+                self.failed += 1
+                logger.error(f"❌ Retry budget exhausted, not retrying send to chat {chat_id}: {error}")
+                raise error
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def _throttle(self, chat_id):
+        """Wait for the chat's turn and a global slot. Returns False if the chat would wait too long."""
+        now = time.monotonic()
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            self._evict(now)
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        else:
+            self._chats.move_to_end(chat_id)
+
+        # The chat's turn first, then a global slot at the moment of sending.
+        waited = bucket.reserve(max_wait=self.chat_max_wait)
+        if waited is None:
+            return False
+        if waited > 0:
+            await asyncio.sleep(waited)
+        wait = self._global.reserve()
+        if wait > 0:
+            waited += wait
+            await asyncio.sleep(wait)
+        self.throttle_total += waited
+        self.throttle_max = max(self.throttle_max, waited)
+        return True
+
+    def _evict(self, now):
+        """Make room for one more chat, dropping idle (full) buckets first."""
+        while len(self._chats) >= self.max_chats:
+            # If every chat is still throttling, the least recently used one loses its limit.
+            victim = next((chat_id for chat_id, bucket in self._chats.items() if bucket.is_full(now)), None)
+            del self._chats[victim if victim is not None else next(iter(self._chats))]
+
+
+def _seconds(value):
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
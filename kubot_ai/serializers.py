@@ -15,6 +15,10 @@ class UserTaskSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class BatchCompleteTaskSerializer(serializers.Serializer):
+    task_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=100)
+
+
 class RewardSerializer(serializers.ModelSerializer):
     task = TaskSerializer(read_only=True)
     
@@ -41,4 +45,6 @@ class WalletCreateSerializer(serializers.ModelSerializer):
             "user",
             "eth_address",
             "balance",
-        ]
\ No newline at end of file
+        ]
+        # Balances only change through kubot_ai.ledger
+        read_only_fields = ["balance"]
\ No newline at end of file
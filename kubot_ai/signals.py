@@ -0,0 +1,21 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import catalog, metrics
+from .models import Task
+
+
+# ✅ Any task change (API, admin or shell) starts a new catalog version
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+def invalidate_task_catalog(sender, **kwargs):
+    # Bump after commit so no request can cache the pre-change rows under the new version.
+    transaction.on_commit(catalog.bump_version)
+
+
+# ✅ Every database connection reports its queries to the metrics registry
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    metrics.instrument(connection)
@@ -0,0 +1,87 @@
+"""
+Streaming HTTP responses.
+
+:func:`stream_json` sends a list endpoint's whole result as JSON while it is
+read: the envelope goes out first, then the rows, serialized a chunk at a time
+from a server-side cursor, so neither the rows nor the body are ever all in
+memory. List views use it when called with ``?stream=1``.
+
+Django serves a synchronous iterator under ASGI by first reading all of it
+into a list, which defeats streaming a large export. :func:`streaming_response`
+hands Django an async iterator instead when the request came in over ASGI. It
+pulls one chunk at a time from the synchronous iterator on the thread-sensitive
+executor, so a server-side cursor stays on the thread and connection that
+opened it.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+from .projections import Projection
+
+_done = object()
+
+
+def streaming_response(request, chunks, content_type, **kwargs):
+    """Return a StreamingHttpResponse that sends `chunks` (an iterable of str/bytes) as they are produced."""
+    if isinstance(getattr(request, "_request", request), ASGIRequest):
+        chunks = _iterate_async(chunks)
+    return StreamingHttpResponse(chunks, content_type=content_type, **kwargs)
+
+
+async def _iterate_async(chunks):
+    chunks = iter(chunks)
+    while (chunk := await sync_to_async(next, thread_sensitive=True)(chunks, _done)) is not _done:
+        yield chunk
+
+
+def wants_stream(request):
+    """Whether the client asked for a streamed response with ``?stream=1``."""
+    return request.query_params.get("stream", "").lower() in ("1", "true")
+
+
+def stream_json(request, envelope, rows, serializer, chunk_size=500, status=200):
+    """
+    Stream `envelope` as JSON with its ``"data"`` key holding every row of `rows`.
+
+    `rows` is an ordered queryset; it is read with ``.iterator(chunk_size)`` and
+    each chunk is serialized with `serializer`, a serializer class or a
+    :class:`~kubot_ai.projections.Projection` (which reads ``.values()`` rows).
+    """
+    if isinstance(serializer, Projection):
+        rows = serializer.values(rows)
+    keys = list(envelope)
+    position = keys.index("data")
+    head = _dumps({key: envelope[key] for key in keys[:position]})[:-1]
+    tail = _dumps({key: envelope[key] for key in keys[position + 1:]})[1:]
+
+    def chunks():
+        yield head + ("," if position else "") + '"data":['
+        separator = ""
+        batch = []
+        for row in rows.iterator(chunk_size=chunk_size):
+            batch.append(row)
+            if len(batch) == chunk_size:
+                yield separator + _dump_rows(batch, serializer)
+                separator, batch = ",", []
+        if batch:
+            yield separator + _dump_rows(batch, serializer)
+        yield "]" + ("," if tail != "}" else "") + tail
+
+    return streaming_response(request, chunks(), "application/json", status=status)
+
+
+def _dump_rows(rows, serializer):
+    if isinstance(serializer, Projection):
+        data = serializer.project(rows)
+    else:
+        data = serializer(rows, many=True).data
+    return ",".join(_dumps(item) for item in data)
+
+
+def _dumps(value):
+    # Same output as DRF's JSONRenderer with the default settings.
+    return json.dumps(value, cls=JSONEncoder, ensure_ascii=False, separators=(",", ":"))
@@ -1,3 +1,1624 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.core.management import call_command, CommandError
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from . import (
+    catalog, checks, completion, export, leaderboard, ledger, media, metrics, projections, referral_ids, referrals,
+    rollups, views,
+)
+from .crediting import RewardCreditor
+from .management.commands._telegram import FakeBotApi, current_kind, generate_updates
+from .management.commands.bench_api import compare, summarize
+from .dedup import UpdateDeduplicator
+from .mining import DatabaseMiningStore, InMemoryMiningStore
+from .models import LedgerEntry, MediaCache, MiningPayout, MiningReward, ReferralPath, MiningSession, Referral, Reward, RewardRollup, Task, UserTask, Wallet
+from .scheduler import MiningScheduler, schedule_payout
+from .streaming import stream_json, streaming_response
+from .sender import MessageSender, TokenBucket
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+from .serializers import WalletCreateSerializer
+from .webhook_queue import UpdateQueue
+from .writebehind import MinedTokenBuffer, get_balance
+
+
+# Query-count tests need a cache that does not itself issue queries.
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(KUBOT_MAX_PAGE_SIZE=1000, CACHES=LOCMEM_CACHES)
+class QueryCountTests(TestCase):
+    """
+    Every read endpoint must cost a constant number of queries, however many
+    rows it returns. A regression here usually means a nested serializer is
+    missing its select_related/prefetch_related.
+    """
+
+    sizes = (1, 100, 1000)
+
+    def seed(self, rows):
+        owner = Wallet.objects.create(id=1, user="owner", eth_address="0xowner", referral_id="OWN001")
+        tasks = Task.objects.bulk_create(
+            Task(title=f"Task {i}", description="Do it", task_type="social", reward_amount=10)
+            for i in range(rows)
+        )
+        UserTask.objects.bulk_create(UserTask(user=owner, task=task, reward_claimed=True) for task in tasks)
+        Reward.objects.bulk_create(Reward(user=owner, task=task, amount=task.reward_amount) for task in tasks)
+        referred = Wallet.objects.bulk_create(
+            Wallet(id=100 + i, user=f"user{i}", eth_address=f"0x{i}", referral_id=f"R{i:05d}")
+            for i in range(rows - 1)
+        )
+        Referral.objects.bulk_create(
+            Referral(referrer=owner, referred_user=wallet, referral_id=owner.referral_id) for wallet in referred
+        )
+        return owner
+
+    def assertQueriesPerSize(self, url, queries, rows_returned):
+        for rows in self.sizes:
+            with self.subTest(rows=rows), transaction.atomic():
+                cache.clear()
+                self.seed(rows)
+                with self.assertNumQueries(queries):
+                    response = self.client.get(url, {"limit": rows})
+                self.assertEqual(len(items(response)), rows_returned(rows))
+                transaction.set_rollback(True)
+
+    def test_task_list(self):
+        self.assertQueriesPerSize("/api/tasks/", 1, lambda rows: rows)
+
+    def test_completed_tasks(self):
+        self.assertQueriesPerSize("/api/tasks/completed/1/", 1, lambda rows: rows)
+
+    def test_rewards(self):
+        self.assertQueriesPerSize("/api/rewards/owner/", 1, lambda rows: rows)
+
+    def test_referrals(self):
+        self.assertQueriesPerSize("/api/referral/OWN001/", 1, lambda rows: rows - 1)
+
+    def test_wallets(self):
+        self.assertQueriesPerSize("/api/wallet/create/", 1, lambda rows: rows)
+
+
+def items(response):
+    """The rows of a list response: a bare array, or the `data` of an envelope."""
+    body = response.json()
+    return body if isinstance(body, list) else body["data"]
+
+
+def next_link(response):
+    """The next-page URL from the `Link` header or the `next` envelope key."""
+    body = response.json()
+    if isinstance(body, list):
+        link = response.get("Link")
+        return link[1:link.index(">")] if link else None
+    return body["next"]
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = Wallet.objects.create(id=1, user="owner", eth_address="0xowner", referral_id="OWN001")
+
+    def walk(self, url, limit):
+        pages = []
+        while url:
+            response = self.client.get(url, {"limit": limit} if not pages else None)
+            self.assertEqual(response.status_code, 200)
+            pages.append([row["id"] for row in items(response)])
+            url = next_link(response)
+        return pages
+
+    def test_task_list_is_a_bare_array(self):
+        Task.objects.bulk_create(
+            Task(title=f"Task {i}", description="Do it", task_type="social", reward_amount=5) for i in range(3)
+        )
+        response = self.client.get("/api/tasks/", {"limit": 2})
+        self.assertIsInstance(response.json(), list)
+        self.assertIn('rel="next"', response["Link"])
+
+        response = self.client.get(next_link(response))
+        self.assertEqual(len(response.json()), 1)
+        self.assertNotIn("Link", response)
+
+    def test_cursor_round_trip(self):
+        tasks = Task.objects.bulk_create(
+            Task(title=f"Task {i}", description="Do it", task_type="social", reward_amount=5) for i in range(7)
+        )
+        pages = self.walk("/api/tasks/", 3)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), [task.id for task in tasks])
+
+    def test_timestamp_ties_are_broken_by_id(self):
+        # Batch completion stamps every row of a request with the same time.
+        tasks = Task.objects.bulk_create(
+            Task(title=f"Task {i}", description="Do it", task_type="social", reward_amount=5) for i in range(5)
+        )
+        now = timezone.now()
+        user_tasks = UserTask.objects.bulk_create(
+            UserTask(user=self.owner, task=task, reward_claimed=True) for task in tasks
+        )
+        UserTask.objects.update(completed_at=now)
+        rewards = Reward.objects.bulk_create(Reward(user=self.owner, task=task, amount=5) for task in tasks)
+        Reward.objects.update(created_at=now)
+
+        pages = self.walk("/api/tasks/completed/1/", 2)
+        self.assertEqual(sum(pages, []), sorted(user_task.id for user_task in user_tasks))
+        pages = self.walk("/api/rewards/owner/", 2)
+        self.assertEqual(sum(pages, []), sorted(reward.id for reward in rewards))
+
+    def test_invalid_cursor(self):
+        for cursor in ("not-base64!", "bm90IGpzb24", "WzEsMl0", "WyJ4Il0"):
+            with self.subTest(cursor=cursor):
+                response = self.client.get("/api/tasks/", {"cursor": cursor})
+                self.assertEqual(response.status_code, 404)
+                response = self.client.get("/api/tasks/completed/1/", {"cursor": cursor})
+                self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, KUBOT_CATALOG_CACHE_TTL=60)
+class TaskCatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Task.objects.create(title="Follow us", description="Follow", task_type="social", reward_amount=5)
+
+    def test_cached_until_a_task_changes(self):
+        self.client.get("/api/tasks/")
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/tasks/")
+        self.assertEqual(len(response.json()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.create(title="Retweet", description="Retweet", task_type="social", reward_amount=5)
+        self.assertEqual(len(self.client.get("/api/tasks/").json()), 2)
+
+    def test_unrelated_query_parameters_share_the_page(self):
+        self.client.get("/api/tasks/")
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/tasks/", {"utm_source": "telegram", "limit": "abc"})
+        self.assertEqual(len(response.json()), 1)
+
+    def test_entries_expire(self):
+        with mock.patch.object(LocMemCache, "set", autospec=True, side_effect=LocMemCache.set) as cache_set:
+            self.client.get("/api/tasks/")
+        timeouts = {call.kwargs.get("timeout") for call in cache_set.call_args_list}
+        self.assertEqual(timeouts, {60})
+
+    def test_version_outlives_the_pages(self):
+        response = self.client.get("/api/tasks/")
+        later = time.time() + 3600
+        with mock.patch("django.core.cache.backends.locmem.time.time", return_value=later):
+            response = self.client.get("/api/tasks/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_conditional_get(self):
+        response = self.client.get("/api/tasks/")
+        self.assertIn("Last-Modified", response)
+
+        response = self.client.get("/api/tasks/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.get().delete()
+        response = self.client.get("/api/tasks/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get("/api/tasks/")["Last-Modified"]
+        response = self.client.get("/api/tasks/", HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        earlier = http_date(catalog.get_version()["updated_at"].timestamp() - 3600)
+        response = self.client.get("/api/tasks/", HTTP_IF_MODIFIED_SINCE=earlier)
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_unmodified_since(self):
+        last_modified = self.client.get("/api/tasks/")["Last-Modified"]
+        response = self.client.get("/api/tasks/", HTTP_IF_UNMODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+        earlier = http_date(catalog.get_version()["updated_at"].timestamp() - 3600)
+        response = self.client.get("/api/tasks/", HTTP_IF_UNMODIFIED_SINCE=earlier)
+        self.assertEqual(response.status_code, 412)
+
+    @override_settings(TELEGRAM_BOT_TOKEN="123:abc", TELEGRAM_WEBHOOK_SECRET="")
+    def test_missing_webhook_secret_warning(self):
+        self.assertEqual([warning.id for warning in checks.check_webhook_secret(None)], ["kubot_ai.W002"])
+        with override_settings(TELEGRAM_WEBHOOK_SECRET="s3cret"):
+            self.assertEqual(checks.check_webhook_secret(None), [])
+
+    def test_process_local_cache_warning(self):
+        self.assertEqual([warning.id for warning in checks.check_shared_cache(None)], ["kubot_ai.W001"])
+        with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                                                   "LOCATION": "kubot_cache"}}):
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.wallet = Wallet.objects.create(id=1, user="alice", eth_address="0xalice", referral_id="ALI001")
+
+    def test_credit_and_debit(self):
+        ledger.credit(self.wallet.pk, 10, LedgerEntry.FUND)
+        ledger.debit(self.wallet.pk, 4, LedgerEntry.WITHDRAW)
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, 6)
+        self.assertEqual(
+            list(LedgerEntry.objects.order_by("id").values_list("kind", "amount")),
+            [(LedgerEntry.FUND, 10), (LedgerEntry.WITHDRAW, -4)],
+        )
+
+    def test_overdraft_is_rejected(self):
+        ledger.credit(self.wallet.pk, 5, LedgerEntry.FUND)
+        with self.assertRaises(ledger.InsufficientBalance):
+            ledger.debit(self.wallet.pk, 6, LedgerEntry.WITHDRAW)
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, 5)
+        self.assertEqual(LedgerEntry.objects.count(), 1)
+
+    def test_missing_wallet(self):
+        with self.assertRaises(Wallet.DoesNotExist):
+            ledger.credit(999, 5, LedgerEntry.FUND)
+        with self.assertRaises(Wallet.DoesNotExist):
+            ledger.debit(999, 5, LedgerEntry.WITHDRAW)
+        self.assertFalse(LedgerEntry.objects.exists())
+
+    def test_invalid_amounts(self):
+        for amount in (0, -1, float("inf"), float("nan")):
+            with self.subTest(amount=amount), self.assertRaises(ValueError):
+                ledger.credit(self.wallet.pk, amount, LedgerEntry.FUND)
+
+    def test_entries_are_immutable(self):
+        entry = ledger.credit(self.wallet.pk, 5, LedgerEntry.FUND)
+        with self.assertRaises(ValueError):
+            entry.save()
+        with self.assertRaises(ValueError):
+            entry.delete()
+
+    def test_fund_and_withdraw_endpoints(self):
+        self.assertEqual(self.client.post("/api/wallet/fund/alice/", {"amount": "10"}).status_code, 200)
+        self.assertEqual(self.client.post("/api/wallet/withdraw/alice/", {"amount": "15"}).status_code, 400)
+        self.assertEqual(self.client.post("/api/wallet/withdraw/alice/", {"amount": "4"}).status_code, 200)
+        self.assertEqual(self.client.post("/api/wallet/fund/nobody/", {"amount": "1"}).status_code, 404)
+        for amount in ("abc", "-3", "inf", "nan"):
+            with self.subTest(amount=amount):
+                self.assertEqual(self.client.post("/api/wallet/fund/alice/", {"amount": amount}).status_code, 400)
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, 6)
+
+    def test_registration_cannot_set_balance(self):
+        serializer = WalletCreateSerializer(data={"user": "bob", "eth_address": "0xbob", "balance": 1000})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertNotIn("balance", serializer.validated_data)
+
+
+class MiningStoreTests(TestCase):
+    stores = (InMemoryMiningStore, DatabaseMiningStore)
+
+    def test_one_session_per_user(self):
+        for store_class in self.stores:
+            with self.subTest(store=store_class.__name__):
+                store = store_class(ttl=60)
+                self.assertTrue(store.start_session(7))
+                self.assertFalse(store.start_session(7))
+                self.assertTrue(store.has_session(7))
+                self.assertTrue(store.start_session(8))
+
+                store.end_session(7)
+                self.assertFalse(store.has_session(7))
+                self.assertTrue(store.start_session(7))
+
+    def test_expired_session_can_be_replaced(self):
+        for store_class in self.stores:
+            with self.subTest(store=store_class.__name__):
+                store = store_class(ttl=60)
+                self.assertTrue(store.start_session(7))
+                with mock.patch("kubot_ai.mining.timezone.now", return_value=timezone.now() + timedelta(seconds=61)):
+                    self.assertFalse(store.has_session(7))
+                    self.assertTrue(store.start_session(7))
+
+    def test_purge_expired(self):
+        store = DatabaseMiningStore(ttl=60)
+        store.start_session(7)
+        MiningSession.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        store.purge_expired()
+        self.assertFalse(MiningSession.objects.exists())
+
+    def test_rewards_accumulate(self):
+        for store_class in self.stores:
+            with self.subTest(store=store_class.__name__):
+                store = store_class()
+                self.assertIsNone(store.get_reward(7))
+                self.assertEqual(store.add_reward(7, 50), 50)
+                self.assertEqual(store.add_reward(7, 50), 100)
+                self.assertEqual(store.get_reward(7), 100)
+
+    def test_concurrent_first_reward_in_database(self):
+        """Another worker creating the row between our UPDATE and INSERT must not lose either reward."""
+        store = DatabaseMiningStore()
+        MiningReward.objects.create(user_id=7, total=50)
+        real_update = QuerySet.update
+        calls = []
+
+        def update_before_other_worker(queryset, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                return 0  # the row did not exist yet when we looked
+            return real_update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, "update", update_before_other_worker):
+            self.assertEqual(store.add_reward(7, 50), 100)
+        self.assertEqual(len(calls), 2)
+
+    def test_concurrent_rewards_in_memory(self):
+        store = InMemoryMiningStore()
+        threads = [threading.Thread(target=store.add_reward, args=(7, 1)) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(store.get_reward(7), 50)
+
+
+def without_returning():
+    """Run the completion service down the path used by backends without INSERT ... RETURNING."""
+    return mock.patch.object(connection.features, "can_return_columns_from_insert", False)
+
+
+class CompletionTests(TestCase):
+    def setUp(self):
+        self.wallet = Wallet.objects.create(id=1, user="alice", eth_address="0xalice", referral_id="ALI001")
+        self.task = Task.objects.create(title="Follow us", description="Follow", task_type="social", reward_amount=5)
+        self.other = Task.objects.create(title="Retweet", description="Retweet", task_type="social", reward_amount=3)
+
+    def for_each_path(self, check):
+        for name, context in (("returning", mock.MagicMock()), ("fallback", without_returning())):
+            with self.subTest(path=name), context, transaction.atomic():
+                check()
+                transaction.set_rollback(True)
+
+    def test_complete_once(self):
+        def check():
+            user_task, reward = completion.complete_task(1, self.task.id)
+            self.assertIsNotNone(user_task.id)
+            self.assertEqual(reward.amount, 5)
+
+            with self.assertRaises(completion.TaskAlreadyCompleted):
+                completion.complete_task(1, self.task.id)
+            self.assertEqual(UserTask.objects.count(), 1)
+            self.assertEqual(Reward.objects.count(), 1)
+
+        self.for_each_path(check)
+
+    def test_missing_task(self):
+        def check():
+            with self.assertRaises(completion.TaskNotFound):
+                completion.complete_task(1, 999)
+            self.assertFalse(UserTask.objects.exists())
+
+        self.for_each_path(check)
+
+    def test_batch(self):
+        def check():
+            completion.complete_task(1, self.task.id)
+            results = completion.complete_tasks(1, [self.task.id, self.other.id, 999, self.other.id])
+            self.assertEqual(
+                [(task_id, task_status) for task_id, task_status, _, _ in results],
+                [(self.task.id, completion.ALREADY_COMPLETED), (self.other.id, completion.COMPLETED),
+                 (999, completion.NOT_FOUND)],
+            )
+            self.assertEqual(Reward.objects.filter(task=self.other).count(), 1)
+
+        self.for_each_path(check)
+
+    def test_endpoint(self):
+        url = f"/api/tasks/complete/1/{self.task.id}/"
+        self.assertEqual(self.client.post(url).status_code, 201)
+        self.assertEqual(self.client.post(url).status_code, 400)
+        self.assertEqual(self.client.post("/api/tasks/complete/1/999/").status_code, 404)
+
+
+class CompletionIntegrityTests(TransactionTestCase):
+    """Foreign keys are only checked at commit, so these need real transactions."""
+
+    def setUp(self):
+        self.task = Task.objects.create(title="Follow us", description="Follow", task_type="social", reward_amount=5)
+
+    def test_missing_wallet(self):
+        for context in (mock.MagicMock(), without_returning()):
+            with self.subTest(context=context), context:
+                with self.assertRaises(completion.WalletNotFound):
+                    completion.complete_task(1, self.task.id)
+                with self.assertRaises(completion.WalletNotFound):
+                    completion.complete_tasks(1, [self.task.id])
+                self.assertFalse(UserTask.objects.exists())
+                self.assertFalse(Reward.objects.exists())
+
+    def test_missing_wallet_endpoint(self):
+        response = self.client.post(f"/api/tasks/complete/1/{self.task.id}/")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"error": "Wallet not found."})
+
+
+class UpdateQueueTests(TestCase):
+    async def test_enqueue_and_drain(self):
+        processed = []
+
+        async def process(update):
+            await asyncio.sleep(0)
+            processed.append(update)
+
+        queue = UpdateQueue(process, workers=2, maxsize=10)
+        for update in range(5):
+            self.assertTrue(queue.enqueue(update))
+        await queue.drain(timeout=5)
+
+        self.assertEqual(sorted(processed), [0, 1, 2, 3, 4])
+        stats = queue.stats()
+        self.assertEqual((stats["enqueued"], stats["processed"], stats["depth"], stats["workers"]), (5, 5, 0, 0))
+
+    async def test_drop_when_full(self):
+        release = asyncio.Event()
+
+        async def process(update):
+            await release.wait()
+
+        queue = UpdateQueue(process, workers=1, maxsize=1)
+        self.assertTrue(queue.enqueue(1))
+        self.assertFalse(queue.enqueue(2))
+        self.assertEqual(queue.stats()["dropped"], 1)
+        release.set()
+        await queue.drain(timeout=5)
+
+    async def test_failures_are_counted(self):
+        async def process(update):
+            raise RuntimeError("boom")
+
+        queue = UpdateQueue(process, workers=1, maxsize=10)
+        queue.enqueue(1)
+        await queue.drain(timeout=5)
+        self.assertEqual((queue.stats()["processed"], queue.stats()["failed"]), (0, 1))
+
+    async def test_drain_gives_up_after_timeout(self):
+        async def process(update):
+            await asyncio.sleep(60)
+
+        queue = UpdateQueue(process, workers=1, maxsize=10)
+        queue.enqueue(1)
+        queue.enqueue(2)
+        await queue.drain(timeout=0.05)
+        self.assertEqual(queue.stats()["workers"], 0)
+
+
+SECRET_HEADER = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TELEGRAM_WEBHOOK_SECRET="s3cret")
+class TelegramWebhookTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.bot = mock.MagicMock(running=True, bot=None)
+        self.processed = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+        async def process(update):
+            await self.release.wait()
+            self.processed.append(update.update_id)
+
+        patches = [
+            mock.patch.object(views, "ensure_bot_initialized", mock.AsyncMock(return_value=self.bot)),
+            mock.patch.object(views, "update_queue", UpdateQueue(process, workers=1, maxsize=1)),
+            mock.patch.object(views, "update_dedup", UpdateDeduplicator(window=60, max_local=100)),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def post_update(self, update_id, headers=SECRET_HEADER):
+        body = json.dumps({"update_id": update_id, "message": None})
+        return await self.async_client.post("/telegram-webhook/", body, content_type="application/json", headers=headers)
+
+    async def test_update_is_queued(self):
+        response = await self.post_update(1)
+        self.assertEqual(response.status_code, 200)
+        await views.update_queue.drain(timeout=5)
+        self.assertEqual(self.processed, [1])
+
+    async def test_wrong_secret_is_rejected_before_dedup(self):
+        for headers in ({}, {"X-Telegram-Bot-Api-Secret-Token": "guess"}):
+            self.assertEqual((await self.post_update(1, headers)).status_code, 403)
+        # The forged calls did not claim the id.
+        self.assertEqual((await self.post_update(1)).status_code, 200)
+        await views.update_queue.drain(timeout=5)
+        self.assertEqual(self.processed, [1])
+
+    async def test_redelivery_is_not_processed_twice(self):
+        for _ in range(3):
+            self.assertEqual((await self.post_update(1)).status_code, 200)
+        await views.update_queue.drain(timeout=5)
+        self.assertEqual(self.processed, [1])
+        self.assertEqual(views.update_dedup.duplicates, 2)
+
+    async def test_ids_are_claimed_from_parsed_body(self):
+        # A body that does not start with update_id takes the json.loads path.
+        body = json.dumps({"message": None, "update_id": 5})
+        for _ in range(2):
+            response = await self.async_client.post(
+                "/telegram-webhook/", body, content_type="application/json", headers=SECRET_HEADER
+            )
+            self.assertEqual(response.status_code, 200)
+        await views.update_queue.drain(timeout=5)
+        self.assertEqual(self.processed, [5])
+
+    async def test_claim_is_released_when_not_queued(self):
+        self.bot.running = False
+        self.assertEqual((await self.post_update(1)).status_code, 500)
+        self.bot.running = True
+        self.assertEqual((await self.post_update(1)).status_code, 200)
+        await views.update_queue.drain(timeout=5)
+        self.assertEqual(self.processed, [1])
+
+    @override_settings(TELEGRAM_WEBHOOK_SECRET="")
+    async def test_dedup_without_secret(self):
+        for _ in range(2):
+            self.assertEqual((await self.post_update(1, {})).status_code, 200)
+        await views.update_queue.drain(timeout=5)
+        self.assertEqual(self.processed, [1])
+
+    async def test_losing_worker_does_not_remember_the_id(self):
+        owner, other = UpdateDeduplicator(window=60, max_local=100), UpdateDeduplicator(window=60, max_local=100)
+        self.assertFalse(await owner.seen(7))
+        self.assertTrue(await other.seen(7))
+        # The owner failed to queue the update and released it; Telegram's redelivery reaches the other worker.
+        await owner.forget(7)
+        self.assertFalse(await other.seen(7))
+
+    async def test_full_queue_answers_503(self):
+        # The worker holds update 1 and update 2 fills the queue.
+        self.release.clear()
+        self.assertEqual((await self.post_update(1)).status_code, 200)
+        self.assertEqual((await self.post_update(2)).status_code, 200)
+        self.assertEqual((await self.post_update(3)).status_code, 503)
+        self.assertEqual(views.update_queue.stats()["dropped"], 1)
+
+        self.release.set()
+        await views.update_queue.drain(timeout=5)
+        self.assertEqual(self.processed, [1, 2])
+
+        # The dropped update was released, so Telegram's redelivery gets through.
+        self.assertEqual((await self.post_update(3)).status_code, 200)
+        await views.update_queue.drain(timeout=5)
+        self.assertEqual(self.processed, [1, 2, 3])
+
+    def test_stats_require_admin(self):
+        self.assertEqual(self.client.get("/api/telegram-webhook/stats/").status_code, 403)
+
+        self.client.force_login(User.objects.create_user("ops", is_staff=True))
+        response = self.client.get("/api/telegram-webhook/stats/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {"pid", "queue", "dedup", "scheduler", "sender", "crediting", "mined_tokens"})
+        self.assertIn("dropped", response.json()["queue"])
+        self.assertIn("duplicates", response.json()["dedup"])
+
+
+class MediaCacheTests(TestCase):
+    def setUp(self):
+        media._hashes.clear()
+        media._file_ids.clear()
+        handle, self.path = tempfile.mkstemp(suffix=".png")
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.write(b"v1")
+
+        self.uploads = 0
+        self.sent = []
+
+        async def reply_photo(photo, **kwargs):
+            if not isinstance(photo, str):
+                self.uploads += 1
+                photo = f"id-{self.uploads}"
+            self.sent.append(photo)
+            return SimpleNamespace(photo=[SimpleNamespace(file_id="thumb"), SimpleNamespace(file_id=photo)])
+
+        self.message = SimpleNamespace(reply_photo=mock.AsyncMock(side_effect=reply_photo))
+
+    def write(self, content):
+        with open(self.path, "wb") as f:
+            f.write(content)
+
+    async def test_upload_once_then_send_file_id(self):
+        for _ in range(3):
+            await media.reply_photo(self.message, self.path, caption="hi")
+        self.assertEqual(self.uploads, 1)
+        self.assertEqual(self.sent, ["id-1", "id-1", "id-1"])
+        self.assertEqual(self.message.reply_photo.call_args.kwargs["caption"], "hi")
+
+    async def test_changed_image_is_uploaded_again(self):
+        await media.reply_photo(self.message, self.path)
+        self.write(b"version 2")
+        await media.reply_photo(self.message, self.path)
+        await media.reply_photo(self.message, self.path)
+
+        self.assertEqual(self.sent, ["id-1", "id-2", "id-2"])
+        rows = [row async for row in MediaCache.objects.values_list("content_hash", "file_id")]
+        self.assertEqual(rows, [(media.content_hash(self.path), "id-2")])
+
+    async def test_file_id_shared_through_database(self):
+        await media.reply_photo(self.message, self.path)
+        media._file_ids.clear()  # as seen by another worker
+        await media.reply_photo(self.message, self.path)
+        self.assertEqual(self.uploads, 1)
+        self.assertEqual(list(media._file_ids.values()), ["id-1"])
+
+    async def test_rejected_file_id_is_replaced(self):
+        await media.reply_photo(self.message, self.path)
+        upload = self.message.reply_photo.side_effect
+
+        async def reject_cached_id(photo, **kwargs):
+            if isinstance(photo, str):
+                raise BadRequest("Wrong file identifier")
+            return await upload(photo, **kwargs)
+
+        self.message.reply_photo.side_effect = reject_cached_id
+        await media.reply_photo(self.message, self.path)
+        self.assertEqual(self.uploads, 2)
+        self.assertEqual(await sync_to_async(media.get_file_id)(self.path, media.content_hash(self.path)), "id-2")
+
+
+class MiningSchedulerTests(TestCase):
+    def setUp(self):
+        self.store = DatabaseMiningStore()
+        self.notified = []
+
+        async def notify(payout, total):
+            self.notified.append((payout.user_id, payout.amount, total))
+
+        self.scheduler = MiningScheduler(self.store, notify, poll_interval=0.01, batch_size=2, lease=30)
+
+    def test_pays_only_when_due(self):
+        self.store.start_session(7)
+        schedule_payout(7, 70, "Ann", 50, delay=60)
+        self.assertEqual(self.scheduler.fire_due(), [])
+
+        MiningPayout.objects.update(due_at=timezone.now())
+        [(payout, total)] = self.scheduler.fire_due()
+        self.assertEqual((payout.chat_id, total), (70, 50))
+        self.assertEqual(self.store.get_reward(7), 50)
+        self.assertFalse(self.store.has_session(7))
+        self.assertFalse(MiningPayout.objects.exists())
+        self.assertEqual(self.scheduler.fire_due(), [])
+
+    def test_batches(self):
+        for user_id in range(5):
+            schedule_payout(user_id, user_id, "", 10, delay=0)
+        self.assertEqual([len(self.scheduler.fire_due()) for _ in range(4)], [2, 2, 1, 0])
+
+    def test_recovers_payouts_after_restart(self):
+        # Left behind by a worker that died, lease included.
+        schedule_payout(7, 70, "Ann", 50, delay=-120)
+        restarted = MiningScheduler(self.store, None, batch_size=10, lease=30)
+        self.assertEqual(len(restarted.fire_due()), 1)
+        self.assertEqual(self.store.get_reward(7), 50)
+
+    def test_expired_lease_is_paid_once(self):
+        schedule_payout(7, 70, "Ann", 50, delay=0)
+        [stale] = self.scheduler.claim_due()
+        # The lease ran out and another worker took the payout over.
+        MiningPayout.objects.update(due_at=timezone.now())
+        self.assertEqual(len(MiningScheduler(self.store, None).fire_due()), 1)
+
+        self.assertIsNone(self.scheduler.pay(stale))
+        self.assertEqual(self.store.get_reward(7), 50)
+
+    def test_failed_payout_is_retried_after_lease(self):
+        schedule_payout(7, 70, "Ann", 50, delay=0)
+        with mock.patch.object(self.store, "add_reward", side_effect=RuntimeError("db down")):
+            self.assertEqual(self.scheduler.fire_due(), [])
+        self.assertEqual(self.scheduler.stats()["failed"], 1)
+        self.assertTrue(MiningPayout.objects.filter(due_at__gt=timezone.now()).exists())
+
+    async def test_run_notifies(self):
+        await sync_to_async(schedule_payout)(7, 70, "Ann", 50, delay=0)
+        self.scheduler.start()
+        try:
+            for _ in range(200):
+                if self.notified:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await self.scheduler.stop()
+        self.assertEqual(self.notified, [(7, 50, 50)])
+        self.assertFalse(self.scheduler.stats()["running"])
+
+    def test_mine_schedules_instead_of_sleeping(self):
+        with mock.patch.object(views, "mining_store", self.store):
+            self.assertTrue(views.start_mining(7, 70, "Ann"))
+            self.assertFalse(views.start_mining(7, 70, "Ann"))
+        payout = MiningPayout.objects.get()
+        self.assertEqual((payout.user_id, payout.chat_id, payout.amount), (7, 70, 50))
+
+
+class MessageSenderTests(TestCase):
+    def setUp(self):
+        self.sleeps = []
+
+        async def sleep(delay):
+            self.sleeps.append(delay)
+
+        patcher = mock.patch("kubot_ai.sender.asyncio.sleep", side_effect=sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sender(self, **kwargs):
+        options = {
+            "global_rate": 1000, "chat_rate": 1000, "chat_burst": 1000, "chat_max_wait": 10,
+            "max_retries": 3, "retry_rate": 1000,
+        }
+        options.update(kwargs)
+        return MessageSender(base_delay=0.5, max_delay=10, **options)
+
+    def message(self, *outcomes):
+        """A message whose reply_text raises or returns `outcomes` in turn."""
+        return SimpleNamespace(chat_id=1, reply_text=mock.AsyncMock(side_effect=list(outcomes)))
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        self.assertEqual([bucket.reserve(now=bucket.updated) for _ in range(4)], [0.0, 0.0, 0.5, 1.0])
+        self.assertIsNone(bucket.reserve(now=bucket.updated, max_wait=1.0))
+        self.assertEqual(bucket.reserve(now=bucket.updated + 0.5, max_wait=1.0), 1.0)
+        self.assertTrue(TokenBucket(rate=1, capacity=1).try_take())
+
+    async def test_per_chat_limit(self):
+        sender = self.sender(chat_rate=1, chat_burst=1)
+        message = SimpleNamespace(chat_id=1, reply_text=mock.AsyncMock())
+        other = SimpleNamespace(chat_id=2, reply_text=mock.AsyncMock())
+        for text in ("a", "b", "c"):
+            await sender.reply_text(message, text)
+        await sender.reply_text(other, "a")
+        self.assertEqual(len(self.sleeps), 2)  # the second and third message to chat 1 waited
+        self.assertGreater(sender.stats()["throttle_max"], 0)
+
+    async def test_messages_over_the_chat_wait_are_dropped(self):
+        sender = self.sender(chat_rate=1, chat_burst=2, chat_max_wait=1)
+        message = SimpleNamespace(chat_id=1, reply_text=mock.AsyncMock(return_value="sent"))
+        results = [await sender.reply_text(message, str(i)) for i in range(5)]
+        # Two from the burst, one a second later; the rest would have waited longer.
+        self.assertEqual(results, ["sent"] * 3 + [None] * 2)
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertLessEqual(max(self.sleeps), 1)
+        self.assertEqual((sender.stats()["sent"], sender.stats()["dropped"]), (3, 2))
+
+    async def test_chat_buckets_are_capped(self):
+        sender = self.sender(chat_rate=0.001, chat_burst=1)
+        sender.max_chats = 3
+        for chat_id in range(10):
+            await sender.reply_text(SimpleNamespace(chat_id=chat_id, reply_text=mock.AsyncMock()), "hi")
+        self.assertEqual(sender.stats()["chats"], 3)
+
+    async def test_retry_after_is_honoured(self):
+        sender = self.sender()
+        message = self.message(RetryAfter(7), "sent")
+        self.assertEqual(await sender.reply_text(message, "hi"), "sent")
+        self.assertEqual(self.sleeps, [7.0])
+        self.assertEqual((sender.stats()["rate_limited"], sender.stats()["retries"]), (1, 1))
+
+    async def test_network_errors_back_off_then_give_up(self):
+        sender = self.sender(max_retries=2)
+        message = self.message(*[NetworkError("down")] * 5)
+        with self.assertRaises(NetworkError):
+            await sender.reply_text(message, "hi")
+        self.assertEqual(message.reply_text.await_count, 3)
+        self.assertTrue(0.25 <= self.sleeps[0] <= 0.5 and 0.5 <= self.sleeps[1] <= 1.0)
+        self.assertEqual(sender.stats()["failed"], 1)
+
+    async def test_bad_request_is_not_retried(self):
+        sender = self.sender()
+        message = self.message(BadRequest("chat not found"))
+        with self.assertRaises(BadRequest):
+            await sender.reply_text(message, "hi")
+        self.assertEqual(message.reply_text.await_count, 1)
+
+    async def test_retry_budget(self):
+        sender = self.sender(retry_rate=0.1)  # one retry in the budget
+        message = self.message(*[NetworkError("down")] * 10)
+        with self.assertRaises(NetworkError):
+            await sender.reply_text(message, "hi")
+        with self.assertRaises(NetworkError):
+            await sender.reply_text(message, "hi")
+        self.assertEqual(sender.stats()["budget_exhausted"], 2)
+        self.assertEqual(message.reply_text.await_count, 3)
+
+    async def test_identical_messages_are_coalesced(self):
+        sender = self.sender()
+        release = asyncio.Event()
+
+        async def reply_text(text):
+            await release.wait()
+            return text
+
+        message = SimpleNamespace(chat_id=1, reply_text=mock.AsyncMock(side_effect=reply_text))
+        sends = [asyncio.ensure_future(sender.reply_text(message, "balance")) for _ in range(3)]
+        sends.append(asyncio.ensure_future(sender.reply_text(message, "other")))
+        asyncio.get_running_loop().call_soon(release.set)
+        self.assertEqual(await asyncio.gather(*sends), ["balance"] * 3 + ["other"])
+        self.assertEqual(message.reply_text.await_count, 2)
+        self.assertEqual(sender.stats()["coalesced"], 2)
+        self.assertEqual(sender.stats()["inflight"], 0)
+
+    async def test_mine_does_not_recurse_on_network_errors(self):
+        message = SimpleNamespace(
+            chat_id=1, from_user=SimpleNamespace(id=7, first_name="Ann"),
+            reply_text=mock.AsyncMock(side_effect=NetworkError("down")),
+        )
+        with mock.patch.object(views, "message_sender", self.sender(max_retries=2)), \
+                mock.patch.object(views, "start_mining", return_value=False):
+            await views.mine(SimpleNamespace(message=message), None)
+        self.assertEqual(message.reply_text.await_count, 3)
+
+
+class ReferralTreeTests(TestCase):
+    def setUp(self):
+        # a referred b, b referred c, c referred d
+        self.a, self.b, self.c, self.d = (
+            Wallet.objects.create(id=i, user=name, eth_address=f"0x{name}", referral_id=f"{name.upper()}00001"[:6])
+            for i, name in enumerate("abcd", start=1)
+        )
+        for referrer, wallet in ((self.a, self.b), (self.b, self.c), (self.c, self.d)):
+            referrals.register_referral(referrer, wallet, referrer.referral_id)
+
+    def balance(self, wallet):
+        wallet.refresh_from_db()
+        return wallet.balance
+
+    def test_paths(self):
+        self.assertEqual(
+            set(ReferralPath.objects.filter(descendant=self.d).values_list("ancestor_id", "depth")),
+            {(self.c.id, 1), (self.b.id, 2), (self.a.id, 3)},
+        )
+
+    def test_tiered_bonuses(self):
+        # a: 5 for b, 2 for c, 1 for d; b: 5 for c, 2 for d; c: 5 for d
+        self.assertEqual([self.balance(w) for w in (self.a, self.b, self.c, self.d)], [8, 7, 5, 0])
+        self.assertEqual(LedgerEntry.objects.filter(wallet=self.a).count(), 3)
+
+    def test_bonuses_stop_after_the_last_tier(self):
+        e = Wallet.objects.create(id=5, user="e", eth_address="0xe", referral_id="E00001")
+        referrals.register_referral(self.d, e, self.d.referral_id)
+        self.assertEqual(self.balance(self.a), 8)  # e is four levels below a
+        self.assertEqual(ReferralPath.objects.get(ancestor=self.a, descendant=e).depth, 4)
+
+    def test_single_query_reads(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(referrals.get_upline(self.d.id), [(self.c.id, 1), (self.b.id, 2), (self.a.id, 3)])
+        with self.assertNumQueries(1):
+            self.assertEqual(referrals.get_team_size(self.a.id), {1: 1, 2: 1, 3: 1})
+
+    @override_settings(KUBOT_REFERRAL_MAX_DEPTH=2)
+    def test_max_depth(self):
+        e = Wallet.objects.create(id=5, user="e", eth_address="0xe", referral_id="E00001")
+        referrals.register_referral(self.d, e, self.d.referral_id)
+        self.assertEqual(ReferralPath.objects.filter(descendant=e).count(), 2)
+
+    def test_team_endpoint(self):
+        response = self.client.get("/api/referral/team/a/")
+        self.assertEqual(response.json()["data"], {"total": 3, "levels": {"1": 1, "2": 1, "3": 1}})
+        self.assertEqual(self.client.get("/api/referral/team/nobody/").status_code, 404)
+
+    def test_bot_signup_joins_the_tree(self):
+        views.create_wallet("e", 5, self.d, self.d.referral_id)
+        self.assertEqual(referrals.get_team_size(self.a.id), {1: 1, 2: 1, 3: 1, 4: 1})
+
+    def test_backfill(self):
+        migration = importlib.import_module("kubot_ai.migrations.0022_referralpath")
+        expected = set(ReferralPath.objects.values_list("ancestor_id", "descendant_id", "depth"))
+        ReferralPath.objects.all().delete()
+        migration.backfill_referral_paths(apps, None)
+        self.assertEqual(set(ReferralPath.objects.values_list("ancestor_id", "descendant_id", "depth")), expected)
+
+
+class RankIndexTests(TestCase):
+    def test_matches_a_sorted_list(self):
+        rng = random.Random(7)
+        index, expected = leaderboard.RankIndex(), []
+        for step in range(5000):
+            if expected and rng.random() < 0.4:
+                key = expected.pop(rng.randrange(len(expected)))
+                index.remove(key)
+            else:
+                key = (rng.randint(0, 300), step)
+                expected.append(key)
+                index.add(key)
+            expected.sort()
+            probe = (rng.randint(0, 300), 0)
+            self.assertEqual(index.index(probe), sum(1 for key in expected if key < probe))
+        self.assertEqual(len(index), len(expected))
+        self.assertEqual(index.head(50), expected[:50])
+        self.assertEqual(leaderboard.RankIndex(expected).head(len(expected)), expected)
+
+    def test_remove_missing_key(self):
+        with self.assertRaises(KeyError):
+            leaderboard.RankIndex([(1, 1)]).remove((1, 2))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        boards = {
+            name: leaderboard.Leaderboard(
+                name, board._load_scores, board._load_score, board._load_top, board._count_above
+            )
+            for name, board in leaderboard.boards.items()
+        }
+
+        def rebuild_now(board):
+            # The test's transaction is only visible on this thread, and its connection must stay open.
+            with mock.patch.object(leaderboard, "connection"):
+                board._rebuild_and_release()
+
+        self.start_rebuild = mock.patch.object(
+            leaderboard.Leaderboard, "_start_rebuild", autospec=True, side_effect=rebuild_now
+        )
+        for patcher in (mock.patch.dict(leaderboard.boards, boards), self.start_rebuild):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.wallets = [
+            Wallet.objects.create(id=i, user=name, eth_address=f"0x{name}", referral_id=f"L0000{i}", balance=balance)
+            for i, (name, balance) in enumerate((("ann", 30), ("bob", 10), ("cat", 30), ("dan", 0)), start=1)
+        ]
+
+    def top(self, board, **params):
+        return self.client.get(f"/api/leaderboard/{board}/", params).json()["data"]
+
+    def test_top_and_my_rank(self):
+        data = self.top("balance", username="bob")
+        self.assertEqual(
+            data["top"],
+            [{"rank": 1, "user": "ann", "score": 30}, {"rank": 1, "user": "cat", "score": 30},
+             {"rank": 3, "user": "bob", "score": 10}],
+        )
+        self.assertEqual(data["me"], {"rank": 3, "user": "bob", "score": 10})
+        self.assertEqual(self.top("balance", username="dan")["me"]["rank"], 4)
+
+    def test_ledger_updates_are_applied_incrementally(self):
+        board = leaderboard.boards["balance"]
+        board.rebuild()
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.credit(4, 50, LedgerEntry.FUND)
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.debit(1, 25, LedgerEntry.WITHDRAW)
+        self.assertEqual(board.stats()["updates"], 2)
+        self.assertEqual(board.stats()["rebuilds"], 1)
+        self.assertEqual([entry["user"] for entry in board.top(4)], ["dan", "cat", "bob", "ann"])
+
+    def test_my_rank_uses_my_current_balance(self):
+        leaderboard.boards["balance"].rebuild()
+        Wallet.objects.filter(id=2).update(balance=100)  # Bypasses the ledger
+        self.assertEqual(self.top("balance", username="bob")["me"]["rank"], 1)
+
+    def test_top_pages_are_cached(self):
+        self.top("balance", limit=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.top("balance", limit=2)["top"]), 2)
+
+    @override_settings(KUBOT_LEADERBOARD_REBUILD_INTERVAL=0)
+    def test_periodic_rebuild(self):
+        board = leaderboard.boards["balance"]
+        board.top(1)
+        Wallet.objects.filter(id=2).update(balance=100)
+        cache.clear()
+        self.assertEqual(board.top(1)[0]["user"], "bob")
+        self.assertEqual(board.stats()["rebuilds"], 2)
+
+    def test_requests_do_not_wait_for_the_first_rebuild(self):
+        self.start_rebuild.stop()
+        with mock.patch.object(leaderboard.Leaderboard, "_start_rebuild") as start_rebuild:
+            for board in ("balance", "referrals"):
+                data = self.top(board, username="bob")
+            self.assertEqual(self.top("balance", username="bob")["me"], {"rank": 3, "user": "bob", "score": 10})
+        self.start_rebuild.start()
+        self.assertEqual(start_rebuild.call_count, 2)  # once per board, still running
+        self.assertEqual(data["top"], [])
+        self.assertEqual(data["me"]["rank"], 1)
+        self.assertEqual([entry["user"] for entry in leaderboard.boards["balance"].top(3)], ["ann", "cat", "bob"])
+
+    def test_changes_during_a_rebuild_are_replayed(self):
+        board = leaderboard.boards["balance"]
+        board.rebuild()
+
+        def load_scores():
+            board.adjust(2, 100)  # Commits after the rebuild's snapshot
+            yield from leaderboard._balances()
+
+        with mock.patch.object(board, "_load_scores", load_scores):
+            board.rebuild()
+        self.assertEqual([entry["user"] for entry in board.top(2)], ["bob", "ann"])
+
+    def test_referrals(self):
+        ann, bob, cat, dan = self.wallets
+        leaderboard.boards["referrals"].rebuild()
+        with self.captureOnCommitCallbacks(execute=True):
+            referrals.register_referral(bob, cat, bob.referral_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            referrals.register_referral(bob, dan, bob.referral_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            referrals.register_referral(ann, bob, ann.referral_id)
+        data = self.top("referrals", username="ann")
+        self.assertEqual(data["top"], [{"rank": 1, "user": "bob", "score": 2}, {"rank": 2, "user": "ann", "score": 1}])
+        self.assertEqual(data["me"], {"rank": 2, "user": "ann", "score": 1})
+
+    def test_errors(self):
+        self.assertEqual(self.client.get("/api/leaderboard/nope/").status_code, 404)
+        self.assertEqual(self.client.get("/api/leaderboard/balance/", {"username": "nobody"}).status_code, 404)
+        self.assertEqual(self.client.get("/api/leaderboard/balance/", {"limit": "x"}).status_code, 400)
+
+
+class ReferralIdTests(TestCase):
+    def test_codes_are_unique_and_never_legacy(self):
+        codes = [referral_ids.encode(n) for n in range(0, 200000, 7)]
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertTrue(all(len(code) == 6 and set(code) <= set(referral_ids.ALPHABET) for code in codes))
+        allocator = referral_ids.ReferralIdAllocator()
+        self.assertFalse(any(referral_ids.is_legacy(allocator.allocate()) for _ in range(2000)))
+
+    def test_allocators_never_share_codes(self):
+        first, second = referral_ids.ReferralIdAllocator(), referral_ids.ReferralIdAllocator()
+        codes = [allocator.allocate() for _ in range(1500) for allocator in (first, second)]
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertEqual(first.blocks + second.blocks, 4)
+
+    def test_each_wallet_gets_its_own_code(self):
+        wallets = [Wallet.objects.create(id=i, user=f"u{i}", eth_address=f"0x{i}") for i in range(1, 4)]
+        self.assertEqual(len({wallet.referral_id for wallet in wallets}), 3)
+
+    def test_one_query_per_block(self):
+        allocator = referral_ids.ReferralIdAllocator()
+        with self.assertNumQueries(1):
+            for _ in range(900):
+                allocator.allocate()
+
+
+class RewardRollupTests(TestCase):
+    def setUp(self):
+        self.wallet = Wallet.objects.create(id=1, user="alice", eth_address="0xalice", referral_id="ALI001")
+        self.tasks = [
+            Task.objects.create(title=f"Task {i}", description="Do it", task_type=task_type, reward_amount=amount)
+            for i, (task_type, amount) in enumerate((("social", 5), ("social", 3), ("partner", 10)))
+        ]
+
+    def summary(self, username="alice"):
+        return self.client.get(f"/api/rewards/{username}/summary/")
+
+    def test_completions_update_the_rollup(self):
+        completion.complete_task(1, self.tasks[0].id)
+        completion.complete_tasks(1, [self.tasks[0].id, self.tasks[1].id, self.tasks[2].id])
+        data = self.summary().json()["data"]
+        self.assertEqual(data["total"], 18)
+        self.assertEqual(data["count"], 3)
+        self.assertEqual(data["by_task_type"], {"partner": 10, "social": 8})
+        last = Reward.objects.latest("created_at").created_at
+        self.assertEqual(RewardRollup.objects.get(task_type="partner").last_reward_at, last)
+
+    def test_summary_cost_does_not_grow_with_history(self):
+        Reward.objects.bulk_create(Reward(user=self.wallet, task=self.tasks[0], amount=1) for _ in range(500))
+        rollups.rebuild()
+        with self.assertNumQueries(1):
+            self.assertEqual(rollups.get_summary("alice")["count"], 500)
+
+    def test_empty_and_missing(self):
+        self.assertEqual(
+            self.summary().json()["data"],
+            {"total": 0, "count": 0, "by_task_type": {}, "last_reward_at": None},
+        )
+        self.assertEqual(self.summary("nobody").status_code, 404)
+
+    def test_rebuild_command(self):
+        completion.complete_tasks(1, [task.id for task in self.tasks])
+        expected = rollups.get_summary("alice")
+        RewardRollup.objects.update(total=0, count=0)
+        call_command("rebuild_reward_rollups", "alice", stdout=open(os.devnull, "w"))
+        self.assertEqual(rollups.get_summary("alice"), expected)
+
+        self.tasks[2].delete()
+        call_command("rebuild_reward_rollups", stdout=open(os.devnull, "w"))
+        self.assertEqual(rollups.get_summary("alice")["by_task_type"], {"": 10, "social": 8})
+
+
+class RewardCreditorTests(TestCase):
+    def setUp(self):
+        self.wallets = [
+            Wallet.objects.create(id=i, user=f"user{i}", eth_address=f"0x{i}", referral_id=f"CRD00{i}")
+            for i in (1, 2)
+        ]
+        self.tasks = [
+            Task.objects.create(title=f"Task {i}", description="Do it", task_type="social", reward_amount=amount)
+            for i, amount in enumerate((5, 3, 0))
+        ]
+
+    def balances(self):
+        return list(Wallet.objects.order_by("id").values_list("balance", flat=True))
+
+    def test_completion_leaves_the_balance_to_the_creditor(self):
+        completion.complete_tasks(1, [task.id for task in self.tasks])
+        completion.complete_task(2, self.tasks[0].id)
+        self.assertEqual(self.balances(), [0, 0])
+
+        creditor = RewardCreditor(batch_size=10)
+        self.assertEqual(creditor.credit_batch(), 4)
+        self.assertEqual(self.balances(), [8, 5])
+        # One ledger entry per wallet per batch; zero rewards are only marked.
+        self.assertEqual(LedgerEntry.objects.filter(kind=LedgerEntry.TASK_REWARD).count(), 2)
+        self.assertFalse(Reward.objects.filter(credited_at__isnull=True).exists())
+
+        self.assertEqual(creditor.credit_batch(), 0)
+        self.assertEqual(self.balances(), [8, 5])
+        self.assertEqual(creditor.stats()["credited"], 4)
+
+    def test_batches(self):
+        completion.complete_tasks(1, [task.id for task in self.tasks])
+        creditor = RewardCreditor(batch_size=2)
+        self.assertEqual(creditor.credit_pending(), 3)
+        self.assertEqual(creditor.stats()["batches"], 2)
+        self.assertEqual(self.balances(), [8, 0])
+
+    def test_batch_claimed_by_another_consumer_is_rolled_back(self):
+        completion.complete_tasks(1, [task.id for task in self.tasks])
+        first = Reward.objects.order_by("id").first()
+
+        stolen = []
+
+        def steal(execute, sql, params, many, context):
+            # Another consumer credits one of the rows just before the batch marks them.
+            if sql.startswith("UPDATE") and "credited_at" in sql and not stolen:
+                stolen.append(first.id)
+                Reward.objects.filter(id=first.id).update(credited_at=timezone.now())
+            return execute(sql, params, many, context)
+
+        creditor = RewardCreditor()
+        with connection.execute_wrapper(steal):
+            self.assertEqual(creditor.credit_batch(), 0)
+        self.assertEqual(creditor.stats()["conflicts"], 1)
+        self.assertEqual(self.balances(), [0, 0])
+        self.assertFalse(LedgerEntry.objects.exists())
+
+    def test_command(self):
+        completion.complete_task(2, self.tasks[0].id)
+        call_command("credit_rewards", stdout=open(os.devnull, "w"))
+        self.assertEqual(self.balances(), [0, 5])
+
+
+class MinedTokenBufferTests(TestCase):
+    stores = (InMemoryMiningStore, DatabaseMiningStore)
+
+    def setUp(self):
+        Wallet.objects.create(id=7, user="miner", eth_address="0xminer", referral_id="MIN007")
+
+    def for_each_store(self, check):
+        for store_class in self.stores:
+            with self.subTest(store=store_class.__name__), transaction.atomic():
+                check(store_class())
+                transaction.set_rollback(True)
+
+    def balance(self):
+        return Wallet.objects.get(id=7).balance
+
+    def test_flush_credits_the_wallet_once(self):
+        def check(store):
+            buffer = MinedTokenBuffer(store)
+            store.add_reward(7, 50)
+            store.add_reward(7, 50)
+            buffer.record(7)
+            self.assertEqual(self.balance(), 0)
+            self.assertEqual(get_balance(store, 7), 100)
+
+            self.assertEqual(buffer.flush_dirty(), 100)
+            self.assertEqual(self.balance(), 100)
+            self.assertEqual(get_balance(store, 7), 100)
+            self.assertEqual(LedgerEntry.objects.get(kind=LedgerEntry.MINING).amount, 100)
+
+            self.assertEqual(buffer.flush(), 0)
+            self.assertEqual(buffer.stats()["flushed_tokens"], 100)
+
+        self.for_each_store(check)
+
+    def test_sweep_recovers_tokens_another_worker_left_behind(self):
+        def check(store):
+            store.add_reward(7, 50)  # Paid by a worker that died before flushing
+            self.assertEqual(MinedTokenBuffer(store).flush(), 50)
+            self.assertEqual(self.balance(), 50)
+
+        self.for_each_store(check)
+
+    def test_tokens_wait_for_a_wallet(self):
+        def check(store):
+            store.add_reward(8, 50)
+            buffer = MinedTokenBuffer(store)
+            buffer.record(8)
+            self.assertEqual(buffer.flush_dirty(), 0)
+            Wallet.objects.create(id=8, user="late", eth_address="0xlate", referral_id="LAT008")
+            self.assertEqual(buffer.flush(), 50)
+
+        self.for_each_store(check)
+
+    def test_sweep_locks_batches_of_users_with_wallets(self):
+        def check(store):
+            for user_id in (9, 10, 11):
+                Wallet.objects.create(id=user_id, user=f"m{user_id}", eth_address=f"0xm{user_id}",
+                                      referral_id=f"SWP{user_id:03d}")
+            for user_id in (7, 8, 9, 10, 11):  # 8 has no wallet
+                store.add_reward(user_id, 10)
+            buffer = MinedTokenBuffer(store, batch_size=2)
+            with mock.patch.object(store, "get_unflushed", wraps=store.get_unflushed) as get_unflushed:
+                self.assertEqual(buffer.flush(), 40)
+            self.assertEqual([call.args[0] for call in get_unflushed.call_args_list], [[7, 9], [10, 11]])
+            self.assertEqual(store.get_unflushed([8]), {8: 10})
+
+        self.for_each_store(check)
+
+    def test_balance_is_read_in_one_query(self):
+        store = DatabaseMiningStore()
+        store.add_reward(7, 50)
+        store.add_reward(8, 20)  # No wallet yet
+        with self.assertNumQueries(1):
+            self.assertEqual(get_balance(store, 7), 50)
+        self.assertEqual(get_balance(store, 8), 20)
+        MinedTokenBuffer(store).flush()
+        self.assertEqual(get_balance(store, 7), 50)
+
+    def test_failed_flush_keeps_the_tokens_pending(self):
+        def check(store):
+            store.add_reward(7, 50)
+            buffer = MinedTokenBuffer(store)
+            buffer.record(7)
+            with mock.patch("kubot_ai.writebehind.ledger.credit_many", side_effect=RuntimeError("db down")):
+                with self.assertRaises(RuntimeError):
+                    buffer.flush_dirty()
+            self.assertEqual(buffer.stats()["pending_users"], 1)
+            self.assertEqual(store.get_unflushed([7]), {7: 50})
+            self.assertEqual(buffer.flush_dirty(), 50)
+
+        self.for_each_store(check)
+
+    async def test_stop_flushes(self):
+        store = InMemoryMiningStore()
+        buffer = MinedTokenBuffer(store, flush_interval=3600, sweep_interval=3600)
+        buffer.start()
+        await asyncio.sleep(0.05)  # Let the startup sweep run
+        store.add_reward(7, 50)
+        buffer.record(7)
+        await buffer.stop()
+        self.assertEqual(await sync_to_async(self.balance)(), 50)
+
+    def test_credit_many(self):
+        Wallet.objects.create(id=8, user="other", eth_address="0xother", referral_id="OTH008")
+        ledger.credit_many({7: 10, 8: 2.5}, LedgerEntry.MINING)
+        self.assertEqual(list(Wallet.objects.order_by("id").values_list("balance", flat=True)), [10, 2.5])
+        with self.assertRaises(Wallet.DoesNotExist):
+            ledger.credit_many({7: 1, 9: 1}, LedgerEntry.MINING)
+        self.assertEqual(self.balance(), 10)
+        self.assertEqual(LedgerEntry.objects.count(), 2)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        wallets = [
+            Wallet.objects.create(id=i, user=f"user{i}", eth_address=f"0x{i}", referral_id=f"EXP00{i}")
+            for i in (1, 2, 3)
+        ]
+        task = Task.objects.create(title="Task", description="Do it", task_type="social", reward_amount=5)
+        for i, wallet in enumerate(wallets):
+            Reward.objects.create(user=wallet, task=task, amount=5)
+        Reward.objects.filter(user_id=1).update(created_at=timezone.now() - timedelta(days=10))
+        self.admin = User.objects.create_user("ops", is_staff=True)
+
+    def run_command(self, *args):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "export")
+            call_command("export_data", *args, "--output", path, "--chunk-size", "2")
+            with open(path) as f:
+                return f.read()
+
+    def test_csv(self):
+        lines = self.run_command("wallets").splitlines()
+        self.assertEqual(lines[0], "id,user,eth_address,balance,referral_id")
+        self.assertEqual(lines[1:], [f"{i},user{i},0x{i},0.0,EXP00{i}" for i in (1, 2, 3)])
+
+    def test_jsonl_with_time_range(self):
+        since = (timezone.now() - timedelta(days=1)).date().isoformat()
+        rows = [json.loads(line) for line in self.run_command("rewards", "--format", "jsonl", "--since", since).splitlines()]
+        self.assertEqual([row["user_id"] for row in rows], [2, 3])
+        self.assertEqual(set(rows[0]), {"id", "user_id", "task_id", "amount", "created_at", "credited_at"})
+
+    def test_command_errors(self):
+        with self.assertRaises(CommandError):
+            self.run_command("wallets", "--since", "2025-01-01")
+        with self.assertRaises(CommandError):
+            self.run_command("rewards", "--until", "yesterday")
+
+    def test_chunks_are_bounded(self):
+        chunks = list(export.iter_export("rewards", "jsonl", chunk_size=2))
+        self.assertEqual([chunk.count("\n") for chunk in chunks], [2, 1])
+
+    def test_endpoint(self):
+        self.assertEqual(self.client.get("/api/export/rewards/").status_code, 403)
+        self.client.force_login(self.admin)
+        response = self.client.get("/api/export/rewards/", {"until": timezone.now().isoformat()})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn('filename="rewards.csv"', response["Content-Disposition"])
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 4)
+
+        self.assertEqual(self.client.get("/api/export/secrets/").status_code, 404)
+        self.assertEqual(self.client.get("/api/export/rewards/", {"since": "soon"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/export/rewards/", {"output": "xml"}).status_code, 400)
+
+    async def test_asgi_responses_stream_asynchronously(self):
+        produced = []
+
+        def chunks():
+            for i in range(3):
+                produced.append(i)
+                yield f"{i}\n"
+
+        response = streaming_response(mock.Mock(spec=ASGIRequest), chunks(), "text/plain")
+        self.assertTrue(response.is_async)
+        received = []
+        async for chunk in response.streaming_content:
+            received.append(chunk)
+            self.assertEqual(len(produced), len(received))  # Nothing is read ahead
+        self.assertEqual(received, [b"0\n", b"1\n", b"2\n"])
+
+
+class StreamingJsonTests(TestCase):
+    def setUp(self):
+        self.referrer = Wallet.objects.create(id=1, user="ref", eth_address="0xref", referral_id="STR001")
+        task = Task.objects.create(title="Task", description="Do it", task_type="social", reward_amount=5)
+        for i in range(2, 7):
+            wallet = Wallet.objects.create(id=i, user=f"user{i}", eth_address=f"0x{i}", referral_id=f"STR00{i}")
+            Referral.objects.create(referrer=self.referrer, referred_user=wallet, referral_id="STR001")
+            Reward.objects.create(user=self.referrer, task=task, amount=i)
+
+    def test_streamed_body_matches_the_paginated_one(self):
+        for url in ("/api/rewards/ref/", "/api/referral/STR001/", "/api/wallet/create/"):
+            with self.subTest(url=url):
+                paged = self.client.get(url, {"limit": 100})
+                streamed = self.client.get(url, {"stream": "1"})
+                self.assertTrue(streamed.streaming)
+                self.assertEqual(streamed.status_code, paged.status_code)
+                self.assertEqual(json.loads(b"".join(streamed.streaming_content)), paged.json())
+
+    def test_rows_are_serialized_in_chunks(self):
+        response = stream_json(
+            None, {"message": "m", "data": None}, Wallet.objects.order_by("id"), WalletCreateSerializer, chunk_size=2,
+        )
+        chunks = [chunk.decode() for chunk in response.streaming_content]
+        self.assertEqual(chunks[0], '{"message":"m","data":[')
+        self.assertEqual(len(chunks), 2 + 3)  # head, 6 wallets in chunks of 2, tail
+        self.assertEqual(len(json.loads("".join(chunks))["data"]), 6)
+
+    def test_empty(self):
+        response = stream_json(None, {"data": None}, Wallet.objects.none(), WalletCreateSerializer)
+        self.assertEqual(b"".join(response.streaming_content), b'{"data":[]}')
+
+
+class ProjectionTests(TestCase):
+    """Every projection must render byte-for-byte what its serializer renders."""
+
+    def setUp(self):
+        self.wallet = Wallet.objects.create(id=10**12, user="prøjection", eth_address="0xproj", balance=1.5)
+        Wallet.objects.create(id=2, user="other", eth_address="0xother", referral_id="PRJ002")
+        linked = Task.objects.create(
+            title="Follow 🚀", description="Multi\nline", url="https://example.com/t", task_type="social",
+            reward_amount=7, partner_project="Partner",
+        )
+        bare = Task.objects.create(title="Bare", description="", task_type="daily")
+        Reward.objects.create(user=self.wallet, task=linked, amount=7)
+        Reward.objects.create(user=self.wallet, task=None, amount=3, credited_at=timezone.now())
+        UserTask.objects.create(user=self.wallet, task=linked, reward_claimed=True)
+        UserTask.objects.create(user=self.wallet, task=bare)
+        Referral.objects.create(referrer=self.wallet, referred_user_id=2, referral_id=None)
+
+    def assertConforms(self, projection, queryset):
+        expected = JSONRenderer().render(projection.serializer_class(queryset, many=True).data)
+        actual = JSONRenderer().render(projection.project(projection.values(queryset)))
+        self.assertEqual(actual, expected)
+
+    def test_projections_match_their_serializers(self):
+        cases = [
+            (projections.wallets, Wallet.objects.order_by("id")),
+            (projections.new_wallets, Wallet.objects.order_by("id")),
+            (projections.rewards, Reward.objects.order_by("id")),
+            (projections.user_tasks, UserTask.objects.order_by("id")),
+            (projections.referrals, Referral.objects.order_by("id")),
+        ]
+        for zone in ("UTC", "Asia/Kolkata"):
+            with timezone.override(zone):
+                for projection, queryset in cases:
+                    with self.subTest(serializer=projection.serializer_class.__name__, zone=zone):
+                        self.assertConforms(projection, queryset)
+
+    def test_unsupported_fields_are_rejected(self):
+        class MethodSerializer(serializers.ModelSerializer):
+            extra = serializers.SerializerMethodField()
+
+            class Meta:
+                model = Wallet
+                fields = ["id", "extra"]
+
+        with self.assertRaises(TypeError):
+            projections.Projection(MethodSerializer).paths
+
+    def test_reads_one_query_without_instances(self):
+        with self.assertNumQueries(1):
+            rows = projections.rewards.project(projections.rewards.values(Reward.objects.all()))
+        self.assertEqual({row["task"] is None for row in rows}, {True, False})
+
+
+class BenchApiTests(TestCase):
+    def test_summarize(self):
+        samples = [(i / 1000, 2) for i in range(1, 101)]
+        result = summarize(samples, {200: 99, 500: 1}, elapsed=2.0)
+        self.assertEqual((result["requests"], result["errors"], result["throughput"]), (100, 1, 50.0))
+        self.assertAlmostEqual(result["p50_ms"], 50.5)
+        self.assertAlmostEqual(result["p99_ms"], 99.01)
+        self.assertEqual((result["queries_mean"], result["queries_max"]), (2, 2))
+
+    def test_compare_flags_regressions_beyond_the_tolerance(self):
+        before = {"p95_ms": 10.0, "throughput": 100.0, "queries_max": 2, "errors": 0}
+        baseline = {"endpoints": {"tasks": before, "wallet": before}}
+        current = {"endpoints": {
+            "tasks": {**before, "p95_ms": 11.5, "throughput": 85.0},
+            "wallet": {**before, "p95_ms": 13.0, "queries_max": 3},
+            "fund": {**before, "errors": 5},  # not in the baseline
+        }}
+        regressions = compare(baseline, current, tolerance=0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(regression.startswith("wallet:") for regression in regressions))
+
+
+class ReplayWebhookTests(TestCase):
+    def test_generated_updates(self):
+        updates = list(generate_updates(500, users=50, referral_codes=["R00001"], seed=1))
+        self.assertEqual([payload["update_id"] for _, payload in updates], list(range(1, 501)))
+
+        first = {}
+        for kind, payload in updates:
+            first.setdefault(payload["message"]["from"]["id"], kind)
+            text = payload["message"]["text"]
+            self.assertEqual("entities" in payload["message"], text.startswith("/"))
+            if kind == "start_referral":
+                self.assertEqual(text, "/start R00001")
+        self.assertEqual(len(first), 50)
+        self.assertEqual(set(first.values()), {"start", "start_referral"})
+        self.assertEqual({kind for kind, _ in updates}, {"start", "start_referral", "mine", "balance", "text"})
+
+    async def test_fake_bot_api_answers_and_counts_calls(self):
+        api = FakeBotApi()
+        bot = Bot("1:replay", request=api)
+        async with bot:
+            token = current_kind.set("text")
+            try:
+                message = await bot.send_message(chat_id=42, text="hi")
+            finally:
+                current_kind.reset(token)
+        self.assertEqual((message.chat_id, message.text), (42, "hi"))
+        self.assertEqual(api.calls[("text", "sendMessage")], 1)
+        self.assertEqual(api.calls[(None, "getMe")], 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, KUBOT_METRICS_TOKEN="scrape-me")
+class MetricsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        override = override_settings(KUBOT_METRICS_DIR=self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        metrics.instrument(connection)
+
+    def _series(self, text, name):
+        prefix = name + "{"
+        return {line.rsplit(" ", 1)[0][len(name):]: float(line.rsplit(" ", 1)[1])
+                for line in text.splitlines() if line.startswith(prefix)}
+
+    def test_middleware_records_view_latency_and_queries(self):
+        Task.objects.create(title="Follow", description="x", task_type="social", reward_amount=5)
+        labels = '{view="task-list-create",method="GET",status="200"}'
+        text = metrics.registry.render()
+        before = self._series(text, "kubot_http_requests_total").get(labels, 0)
+        queries = self._series(text, "kubot_http_request_queries_sum").get('{view="task-list-create"}', 0)
+
+        with mock.patch.object(metrics.registry, "_flusher", None), \
+                mock.patch.object(metrics.registry, "start_flusher") as start_flusher:
+            self.assertEqual(self.client.get("/api/tasks/").status_code, 200)
+        start_flusher.assert_called_once_with()
+        self.assertEqual(os.listdir(self.directory), [])  # Snapshots are written off the request path
+
+        text = metrics.registry.render()
+        self.assertEqual(self._series(text, "kubot_http_requests_total")[labels], before + 1)
+        self.assertIn("# TYPE kubot_http_request_duration_seconds histogram", text)
+        buckets = self._series(text, "kubot_http_request_queries_bucket")
+        self.assertGreaterEqual(buckets['{view="task-list-create",le="+Inf"}'], 1)
+        self.assertGreater(self._series(text, "kubot_http_request_queries_sum")['{view="task-list-create"}'], queries)
+
+        metrics.registry.flush()
+        self.assertEqual(os.listdir(self.directory), [f"{metrics.registry.instance}.json"])
+
+    def test_render_sums_workers_and_drops_gauges_of_dead_ones(self):
+        def snapshot(pid, requests):
+            return {
+                "pid": pid,
+                "counters": [
+                    ["kubot_http_requests_total", [["view", "x"], ["method", "GET"], ["status", "200"]], requests],
+                ],
+                "histograms": [["kubot_http_request_queries", [["view", "x"]], [0, 2, 0, 0, 1, 0, 0, 0, 0, 0, 0, 7.0]]],
+                "gauges": [["kubot_http_requests_in_flight", [], 3]],
+                "stats": {"queue": {"depth": 4, "state": "running"}},
+            }
+
+        dead = 2 ** 22 + 1  # above the kernel's pid_max
+        text = metrics.render([snapshot(os.getpid(), 2), snapshot(dead, 5)])
+
+        self.assertIn('kubot_http_requests_total{view="x",method="GET",status="200"} 7', text)
+        self.assertIn('kubot_http_request_queries_bucket{view="x",le="1"} 4', text)
+        self.assertIn('kubot_http_request_queries_bucket{view="x",le="5"} 6', text)
+        self.assertIn('kubot_http_request_queries_bucket{view="x",le="+Inf"} 6', text)
+        self.assertIn('kubot_http_request_queries_sum{view="x"} 14', text)
+        self.assertIn("kubot_http_requests_in_flight 3", text)
+        self.assertIn(f'kubot_queue_depth{{pid="{os.getpid()}"}} 4', text)
+        self.assertNotIn(f'pid="{dead}"', text)
+        self.assertNotIn("kubot_queue_state", text)
+
+    def test_collect_reads_other_workers_snapshots(self):
+        metrics.registry.flush()
+        # An earlier worker that had our pid wrote its own file.
+        for instance, pid in (("1-a", 1), (f"{os.getpid()}-b", os.getpid())):
+            with open(os.path.join(self.directory, f"{instance}.json"), "w") as out:
+                json.dump({"pid": pid, "instance": instance, "histograms": [], "gauges": [], "stats": {},
+                           "counters": [["kubot_db_queries_total", [["source", "background"]], 1000]]}, out)
+        with open(os.path.join(self.directory, "2-c.json"), "w") as out:
+            out.write("{")  # half-written
+        instances = [snapshot["instance"] for snapshot in metrics.registry.collect()]
+        self.assertEqual(sorted(instances), sorted([metrics.registry.instance, "1-a", f"{os.getpid()}-b"]))
+
+    def test_endpoint_requires_token_or_admin(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        self.assertIn("# TYPE kubot_http_requests_total counter", response.content.decode())
+
+        self.client.force_login(User.objects.create_user("ops", is_staff=True))
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
@@ -1,21 +1,28 @@
 from django.urls import path
-from .views import TelegramWebhookView
+from .views import TelegramWebhookView, TelegramWebhookStatsView
 from .api_views import (
     TaskListCreateView, CompleteTaskView, RewardListView, ReferralRegisterView,
-    WalletDetailView, WithdrawTokensView, FundTokensView, RegisterView, GetCompleteTaskView
+    WalletDetailView, WithdrawTokensView, FundTokensView, RegisterView, GetCompleteTaskView, BatchCompleteTaskView,
+    ReferralTeamView, LeaderboardView, RewardSummaryView, ExportView,
 )
 
 
 urlpatterns = [
     path("telegram-webhook/", TelegramWebhookView.as_view(), name="telegram-webhook"),
+    path('/telegram-webhook/stats/', TelegramWebhookStatsView.as_view(), name="telegram-webhook-stats"),
     
     # API VIEWS
     path('/tasks/', TaskListCreateView.as_view(), name="task-list-create"),
     path('/tasks/complete/<int:user_id>/<int:task_id>/', CompleteTaskView.as_view(), name="complete-task"),
+    path('/tasks/complete/<int:user_id>/', BatchCompleteTaskView.as_view(), name="complete-tasks"),
     path('/tasks/completed/<int:user_id>/', GetCompleteTaskView.as_view(), name="completed-task"),
     path('/rewards/<str:username>/', RewardListView.as_view(), name="reward-list"),
+    path('/rewards/<str:username>/summary/', RewardSummaryView.as_view(), name="reward-summary"),
     path('/referral/<str:referral_id>/', ReferralRegisterView.as_view(), name="referral"),
-    path('/wallet/create/', RegisterView.as_view(), name="referral"),
+    path('/referral/team/<str:username>/', ReferralTeamView.as_view(), name="referral-team"),
+    path('/leaderboard/<str:board>/', LeaderboardView.as_view(), name="leaderboard"),
+    path('/export/<str:name>/', ExportView.as_view(), name="export"),
+    path('/wallet/create/', RegisterView.as_view(), name="wallet-create"),
     path('/wallet/<str:username>/', WalletDetailView.as_view(), name="wallet-detail"),
     path('/wallet/withdraw/<str:username>/', WithdrawTokensView.as_view(), name="withdraw-tokens"),
     path('/wallet/fund/<str:username>/', FundTokensView.as_view(), name="fund")
@@ -1,9 +1,11 @@
+import hmac
 import json
 import logging
 import os
 import asyncio
-from datetime import datetime
-from django.http import JsonResponse
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse
 from django.views import View
 from django.shortcuts import render
 from django.utils.decorators import method_decorator
@@ -11,43 +13,127 @@ from django.views.decorators.csrf import csrf_exempt
 from telegram.error import NetworkError
 from asyncio import TimeoutError
 from telegram import Update, Bot, ReplyKeyboardMarkup, KeyboardButton, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, InputFile
+from . import media, metrics, referrals
+from .crediting import RewardCreditor
+from .dedup import UpdateDeduplicator, peek_update_id
+from .mining import get_mining_store
+from .scheduler import MiningScheduler, schedule_payout
+from .sender import MessageSender
+from .webhook_queue import UpdateQueue
+from .writebehind import MinedTokenBuffer, get_balance
 from .models import Wallet, Referral
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, Updater
 from asgiref.sync import sync_to_async
-
-# Load bot token from environment variable
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-if not TOKEN:
-    raise ValueError("Missing TELEGRAM_BOT_TOKEN in environment variables.")
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-# ✅ Initialize Telegram bot application
-app = Application.builder().token(TOKEN).build()
+# ✅ Telegram bot application, built on first use (see get_application)
+_application = None
+_init_lock = asyncio.Lock()
+
+# ✅ Mining sessions and rewards are shared by every worker through the store
+mining_store = get_mining_store()
+
+# ✅ Mined tokens reach Wallet.balance in periodic bulk flushes
+mined_tokens = MinedTokenBuffer(mining_store)
+
+# ✅ Every outgoing message is rate limited, retried and coalesced here
+message_sender = MessageSender()
+
+# ✅ Task rewards reach Wallet.balance through this outbox consumer
+reward_creditor = RewardCreditor()
+
+# ✅ Webhook updates are acknowledged immediately and processed by a worker pool
+async def _process_update(update):
+    await get_application().process_update(update)
+
+
+update_queue = UpdateQueue(
+    _process_update,
+    workers=settings.KUBOT_WEBHOOK_WORKERS,
+    maxsize=settings.KUBOT_WEBHOOK_QUEUE_SIZE,
+)
+
+# ✅ Telegram redeliveries are answered without re-running the handlers
+update_dedup = UpdateDeduplicator(
+    window=settings.KUBOT_UPDATE_DEDUP_WINDOW,
+    max_local=settings.KUBOT_UPDATE_DEDUP_LOCAL_SIZE,
+)
 
-# Dictionary to track mining sessions
-mining_sessions = {}
 
-# Dictionary to store user rewards
-user_rewards = {}
+def build_application(builder):
+    """Build the bot Application from an ApplicationBuilder and register the handlers."""
+    application = builder.build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("stop", stop))
+    application.add_handler(CommandHandler("mine", mine))
+    application.add_handler(CommandHandler("balance", check_balance))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
+    return application
+
+
+def get_application():
+    """
+    Return this process's bot Application, building it on first use.
+
+    Returns None when TELEGRAM_BOT_TOKEN is not configured, so the web API can
+    run (and manage.py commands can import the URLconf) without a bot.
+    """
+    global _application
+    if _application is None and settings.TELEGRAM_BOT_TOKEN:
+        _application = build_application(Application.builder().token(settings.TELEGRAM_BOT_TOKEN))
+    return _application
 
 
 async def ensure_bot_initialized():
     """Ensure the bot is properly initialized before processing updates."""
-    try:
-        if not app.running:
-            logger.info("🚀 Initializing bot...")
-            await app.initialize()
-            await app.start()
-            logger.info("✅ Bot initialized and started.")
-        else:
-            logger.info("✅ Bot is already initialized.")
-    except NetworkError as e:
-        logger.error(f"🌐 Network error while initializing bot: {e}")
-    except Exception as e:
-        logger.error(f"❌ Unexpected error during bot initialization: {e}")
+    application = get_application()
+    if application is None or application.running:
+        return application
+
+    async with _init_lock:
+        try:
+            if not application.running:
+                logger.info("🚀 Initializing bot...")
+                await application.initialize()
+                await application.start()
+                logger.info("✅ Bot initialized and started.")
+        except NetworkError as e:
+            logger.error(f"🌐 Network error while initializing bot: {e}")
+        except Exception as e:
+            logger.error(f"❌ Unexpected error during bot initialization: {e}")
+    return application
+
+
+async def startup_bot():
+    """Start the bot, the reward creditor and the mined token flusher once per process. Called on ASGI startup."""
+    reward_creditor.start()
+    mined_tokens.start()
+    if get_application() is None:
+        logger.info("ℹ️ TELEGRAM_BOT_TOKEN is not set, Telegram bot disabled.")
+        return
+    await ensure_bot_initialized()
+    mining_scheduler.start()
+
+
+def create_wallet(username, user_id, referrer=None, referral_id=None):
+    """
+    Create the wallet for a new bot user.
+
+    With a `referrer`, the referral, its place in the referral tree and the
+    upline bonuses are written in the same transaction, so a referral never
+    exists without its bonuses.
+    """
+    with transaction.atomic():
+        new_wallet = Wallet.objects.create(user=username, id=user_id)
+        if referrer:
+            referrals.register_referral(referrer, new_wallet, referral_id)
+    return new_wallet
 
 
 async def start(update: Update, context: CallbackContext):
@@ -76,7 +162,7 @@ async def start(update: Update, context: CallbackContext):
         # Check if the user already has a wallet
         try:
             existing_wallet = await sync_to_async(Wallet.objects.get, thread_sensitive=True)(user=username)
-            await update.message.reply_text("You already have a wallet!")
+            await message_sender.reply_text(update.message, "You already have a wallet!")
             return  
 
         except Wallet.DoesNotExist:
@@ -91,32 +177,21 @@ async def start(update: Update, context: CallbackContext):
                 # Check if a referral already exists
                 referral_exists = await sync_to_async(Referral.objects.filter(referred_user__user=username).exists)()
                 if referral_exists:
-                    await update.message.reply_text("You have already been referred!")
+                    await message_sender.reply_text(update.message, "You have already been referred!")
                     return  # Stop execution if referral already exists
 
             except Wallet.DoesNotExist:
-                await update.message.reply_text("Referral ID is invalid!")
+                await message_sender.reply_text(update.message, "Referral ID is invalid!")
                 return  # Stop execution if referral ID is invalid
 
-        # ✅ Create new wallet for user
-        new_wallet = await sync_to_async(Wallet.objects.create, thread_sensitive=True)(user=username,id=user_id)
+        # ✅ Create new wallet for user, plus the referral and its bonus if referred
+        await sync_to_async(create_wallet, thread_sensitive=True)(username, user_id, referred_user, referral_id)
 
-        # ✅ Create referral only if there is a valid referred user
         if referred_user:
-            await sync_to_async(Referral.objects.create, thread_sensitive=True)(
-                referrer=referred_user,
-                referral_id=referral_id,
-                referred_user=new_wallet
-            )
-
-            # ✅ Update balance of the referring user
-            referred_user.balance += 5
-            await sync_to_async(referred_user.save, thread_sensitive=True)()
-
-            await update.message.reply_text("Referral successful! 🎉")
+            await message_sender.reply_text(update.message, "Referral successful! 🎉")
 
         else:
-            await update.message.reply_text("Welcome! No referral ID detected.")
+            await message_sender.reply_text(update.message, "Welcome! No referral ID detected.")
     else:
         try:
             new_wallet = await sync_to_async(Wallet.objects.create, thread_sensitive=True)(user=username, id=user_id)
@@ -129,21 +204,21 @@ async def start(update: Update, context: CallbackContext):
     keyboard = [[InlineKeyboardButton("🚀 Open Mini App", web_app=WebAppInfo(url=WEB_BOT_URL))]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    # ✅ Send welcome image with button
+    # ✅ Send welcome image with button (uploaded once, then sent by file_id)
     try:
         if os.path.exists(IMAGE_PATH):  
-            with open(IMAGE_PATH, "rb") as photo:
-                await update.message.reply_photo(
-                    photo=photo,
-                    caption="🌟 Welcome to Kubot AI! 🌟\nKubotAI combines cryptocurrency gamification with task-based rewards.",
-                    reply_markup=reply_markup
-                )
+            await message_sender.send(update.message.chat_id, lambda: media.reply_photo(
+                update.message,
+                IMAGE_PATH,
+                caption="🌟 Welcome to Kubot AI! 🌟\nKubotAI combines cryptocurrency gamification with task-based rewards.",
+                reply_markup=reply_markup
+            ))
         else:
-            await update.message.reply_text("⚠️ An error occurred. Please try again later.")
+            await message_sender.reply_text(update.message, "⚠️ An error occurred. Please try again later.")
 
     except Exception as e:
         logger.error(f"❌ Error sending image: {e}")
-        await update.message.reply_text("⚠️ An error occurred while sending the welcome image.")
+        await message_sender.reply_text(update.message, "⚠️ An error occurred while sending the welcome image.")
           
           
 
@@ -153,12 +228,12 @@ async def stop(update: Update, context: CallbackContext):
     if update.message:
         user_id = update.message.from_user.id
         try:
-            mining_sessions.pop(user_id, None)
-            await update.message.reply_text("Always remember that Kubot AI is here to assist you. Have a great day!")
+            await sync_to_async(mining_store.end_session, thread_sensitive=True)(user_id)
+            await message_sender.reply_text(
+                update.message, "Always remember that Kubot AI is here to assist you. Have a great day!"
+            )
         except (NetworkError, TimeoutError) as e:
             logger.error(f"🌐 Network error while sending stop message: {e}")
-            mining_sessions.pop(user_id, None)
-            await update.message.reply_text("Always remember that Kubot AI is here to assist you. Have a great day!")
         except Exception as e:
             logger.error(f"❌ Unexpected error: {e}")
     else:
@@ -171,58 +246,57 @@ async def mine(update: Update, context: CallbackContext):
         user_id = update.message.from_user.id
         first_name = update.message.from_user.first_name
 
-        if user_id in mining_sessions:
+        started = await sync_to_async(start_mining, thread_sensitive=True)(user_id, update.message.chat_id, first_name)
+        if not started:
             try:
-                await update.message.reply_text(
+                await message_sender.reply_text(
+                    update.message,
                     f"{first_name}, you are already mining! Please wait until your current session ends."
                 )
             except (NetworkError, TimeoutError) as e:
                 logger.error(f"🌐 Network error while sending mining warning: {e}")
-                await mine(update, context)
             except Exception as e:
                 logger.error(f"❌ Unexpected error: {e}")
             return
 
-        mining_sessions[user_id] = datetime.now()
+        message = f"⛏️ {first_name}, your mining session has begun! You'll be mining for {settings.KUBOT_MINING_DURATION} seconds. ⏳"
         try:
-            await update.message.reply_text(
-                f"⛏️ {first_name}, your mining session has begun! You'll be mining for 60 seconds. ⏳"
-            )
-            # Start mining process
-            asyncio.create_task(finish_mining(user_id, first_name, update))
+            await message_sender.reply_text(update.message, message)
         except (NetworkError, TimeoutError) as e:
-            await update.message.reply_text(
-                f"⛏️ {first_name}, your mining session has begun! You'll be mining for 60 seconds. ⏳"
-            )
-            # logger.error(f"🌐 Network error while sending mining start message: {e}")
-            await finish_mining(user_id, first_name, update)
+            # The payout is already scheduled; only the message was lost.
+            logger.error(f"🌐 Network error while sending mining start message: {e}")
         except Exception as e:
             logger.error(f"❌ Unexpected error: {e}")
 
-        
 
+def start_mining(user_id, chat_id, first_name):
+    """
+    Start a mining session and schedule its payout.
 
-async def finish_mining(user_id, first_name, update: Update):
-    """Handles mining completion after 60 seconds"""
-    print("let's get started")
-    await asyncio.sleep(10)
-    new_reward = 50
-    total_reward = user_rewards.get(user_id, 0) + new_reward
-    user_rewards[user_id] = total_reward
+    Returns False if the user is already mining. The payout is a database row,
+    so it is paid by the scheduler even if this worker restarts meanwhile.
+    """
+    with transaction.atomic():
+        if not mining_store.start_session(user_id):
+            return False
+        schedule_payout(user_id, chat_id, first_name, settings.KUBOT_MINING_REWARD, settings.KUBOT_MINING_DURATION)
+    return True
 
-    try:
-        await update.message.reply_text(
-            f"{first_name}, your mining session has ended! You have earned {new_reward} tokens.\n"
-            f"💰 Your total balance is now {total_reward} tokens.\n"
-            f"Click on the /mine button continue mining ⛏️"
-        )
-    except (NetworkError, TimeoutError) as e:
-        logger.error(f"🌐 Network error while sending mining result: {e}")
-        await finish_mining(user_id, first_name, update)
-    except Exception as e:
-        logger.error(f"❌ Unexpected error sending mining result: {e}")
 
-    mining_sessions.pop(user_id, None)
+async def notify_mining_payout(payout, total):
+    """Tell the user their session ended. Called by the scheduler once the payout is committed."""
+    mined_tokens.record(payout.user_id)
+    balance = await sync_to_async(get_balance, thread_sensitive=True)(mining_store, payout.user_id)
+    message = (
+        f"{payout.first_name}, your mining session has ended! You have earned {payout.amount} tokens.\n"
+        f"💰 Your total balance is now {balance:g} tokens.\n"
+        f"Click on the /mine button continue mining ⛏️"
+    )
+    await message_sender.send_message(get_application().bot, payout.chat_id, message)
+
+
+# ✅ One scheduler task per worker pays out every due mining session
+mining_scheduler = MiningScheduler(mining_store, notify_mining_payout)
     
     
 async def check_balance(update: Update, context: CallbackContext):
@@ -231,28 +305,24 @@ async def check_balance(update: Update, context: CallbackContext):
         user_id = update.message.from_user.id
         first_name = update.message.from_user.first_name
         
-        try:
-            reward = user_rewards[user_id]
-        except KeyError:
-            await update.message.reply_text(
+        balance = await sync_to_async(get_balance, thread_sensitive=True)(mining_store, user_id)
+        if not balance:
+            message = (
                 f"{first_name},\n\n"
                 f"💰 Your have 0 Kubot tokens currently.\n"
                 f"Click on the /mine button start mining ⛏️"
             )
-
-        try:
-            await update.message.reply_text(
+        else:
+            message = (
                 f"{first_name},\n\n"
-                f"💰 Your total balance is now {reward} tokens.\n"
+                f"💰 Your total balance is now {balance:g} tokens.\n"
                 f"Click on the /mine button continue mining ⛏️"
             )
+
+        try:
+            await message_sender.reply_text(update.message, message)
         except (NetworkError, TimeoutError) as e:
             logger.error(f"🌐 Network error while sending mining result: {e}")
-            await update.message.reply_text(
-                f"{first_name},\n\n"
-                f"💰 Your total balance is now {reward} tokens.\n"
-                f"Click on the /mine button continue mining ⛏️"
-            )
         except Exception as e:
             logger.error(f"❌ Unexpected error checking balance: {e}")
 
@@ -263,7 +333,7 @@ async def echo(update: Update, context: CallbackContext):
     logger.info(f"✅ Received message: {update.message.text}")
     if update.message:
         try:
-            await update.message.reply_text(update.message.text)
+            await message_sender.reply_text(update.message, update.message.text)
         except (NetworkError, TimeoutError) as e:
             logger.error(f"🌐 Network error while echoing message: {e}")
         except Exception as e:
@@ -272,35 +342,61 @@ async def echo(update: Update, context: CallbackContext):
         logger.error("⚠️ No message object in update!")
 
 
-# Register handlers
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CommandHandler("stop", stop))
-app.add_handler(CommandHandler("mine", mine))
-app.add_handler(CommandHandler("balance", check_balance))
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
-
-
 @method_decorator(csrf_exempt, name='dispatch')  # ✅ Prevent 403 Forbidden
 class TelegramWebhookView(View):
-    """Handles incoming updates from Telegram via webhook."""
+    """
+    Handles incoming updates from Telegram via webhook.
+
+    With TELEGRAM_WEBHOOK_SECRET set, requests without the matching
+    X-Telegram-Bot-Api-Secret-Token header are rejected with 403 before their
+    update_id is looked at. Redeliveries are deduplicated by update_id.
+    """
 
     async def post(self, request, *args, **kwargs):
+        # ✅ Only Telegram knows the secret registered with setWebhook
+        secret = settings.TELEGRAM_WEBHOOK_SECRET
+        if secret:
+            received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(received.encode(), secret.encode()):
+                logger.warning("⚠️ Rejected webhook call with a missing or wrong secret token")
+                return JsonResponse({"error": "Forbidden"}, status=403)
+
+        # Update id claimed in the dedup layer; released again unless the update is queued.
+        claimed = None
         try:
+            # ✅ Short-circuit redeliveries before parsing the body
+            update_id = peek_update_id(request.body)
+            if update_id is not None:
+                if await update_dedup.seen(update_id):
+                    return JsonResponse({"status": "ok"}, status=200)
+                claimed = update_id
+
             data = json.loads(request.body)
-            logger.info(f"📩 Received Telegram update: {json.dumps(data, indent=2)}")
+            if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+                return JsonResponse({"error": "Invalid update"}, status=400)
+            if claimed is None:
+                if await update_dedup.seen(data["update_id"]):
+                    return JsonResponse({"status": "ok"}, status=200)
+                claimed = data["update_id"]
+            logger.debug(f"📩 Received Telegram update: {claimed}")
+
+            # ✅ Normally already started on ASGI startup; retried here if that failed
+            application = await ensure_bot_initialized()
 
-            # ✅ Ensure the bot is initialized before processing updates
-            await ensure_bot_initialized()
+            if application is None:
+                return JsonResponse({"error": "Bot is not configured"}, status=503)
 
-            if not app.running:
+            if not application.running:
                 logger.error("❌ Bot is still not initialized!")
                 return JsonResponse({"error": "Bot initialization failed"}, status=500)
 
-            update = Update.de_json(data, app.bot)
+            update = Update.de_json(data, application.bot)
 
-            # ✅ Process update inside an async function
-            await app.process_update(update)
+            # ✅ Hand the update to the worker pool and acknowledge right away
+            if not update_queue.enqueue(update):
+                return JsonResponse({"error": "Busy, please retry"}, status=503)
 
+            claimed = None
             return JsonResponse({"status": "ok"}, status=200)
 
         except (NetworkError, TimeoutError) as e:
@@ -315,6 +411,80 @@ class TelegramWebhookView(View):
             logger.error(f"❌ Unexpected error: {e}")
             return JsonResponse({"error": "Internal Server Error"}, status=500)
 
+        finally:
+            # Let Telegram's redelivery through if this attempt was not queued
+            if claimed is not None:
+                await update_dedup.forget(claimed)
+
+
+# ✅ Webhook backpressure and dedup counters for operators
+class TelegramWebhookStatsView(APIView):
+    """
+    API endpoint exposing this worker's webhook ingestion counters.
+
+    GET: Return the update queue stats (depth, drops, wait times, ...), the
+    dedup stats (redeliveries answered without processing), the mining
+    scheduler stats, the outbound sender stats and the reward creditor stats
+    (credited, throughput in rewards per second, lag behind the oldest
+    reward of the last batch, ...) and the mined token write-behind stats.
+    Counters are per process; each worker reports its own.
+
+    Permissions:
+    - Admin users only.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({"pid": os.getpid(), **worker_stats()})
+
+
+def worker_stats():
+    """Return the stats of this worker's webhook, mining, sending and crediting components."""
+    return {
+        "queue": update_queue.stats(),
+        "dedup": update_dedup.stats(),
+        "scheduler": mining_scheduler.stats(),
+        "sender": message_sender.stats(),
+        "crediting": reward_creditor.stats(),
+        "mined_tokens": mined_tokens.stats(),
+    }
+
+
+metrics.registry.register_stats(worker_stats)
+
+
+class MetricsView(APIView):
+    """
+    API endpoint for Prometheus scrapers.
+
+    GET: Return request latency, query count and DB time histograms per view,
+    request and query counters and the in-flight gauge in the Prometheus text
+    format, summed over every worker that shares KUBOT_METRICS_DIR, followed
+    by each live worker's component stats (queue, sender, crediting, ...).
+
+    Permissions:
+    - Scrapers sending ``Authorization: Bearer <KUBOT_METRICS_TOKEN>``.
+    - Admin users.
+    """
+
+    permission_classes = [metrics.HasMetricsToken | IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+async def shutdown_bot():
+    """Process the queued updates, then stop the bot. Called on ASGI shutdown."""
+    await update_queue.drain()
+    await mining_scheduler.stop()
+    await mined_tokens.stop()
+    await reward_creditor.stop()
+    if _application is not None and _application.running:
+        await _application.stop()
+        await _application.shutdown()
+        logger.info("✅ Bot stopped.")
+
 
 def index_view(request):
     return render(request, "index.html")
\ No newline at end of file
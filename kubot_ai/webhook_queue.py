@@ -0,0 +1,107 @@
+"""
+Bounded ingestion queue for Telegram webhook updates.
+
+``TelegramWebhookView`` only validates an update and puts it on the queue, so
+Telegram gets its 200 right away. A fixed pool of worker tasks drains the
+queue through ``Application.process_update``. When the queue is full the
+update is dropped and the webhook answers 503, which makes Telegram redeliver
+it later instead of piling up work in this process.
+
+The workers run on the event loop of the ASGI server, so the queue needs an
+ASGI deployment (``core.asgi.application``). ``drain()`` is called on ASGI
+lifespan shutdown to finish pending updates before the process exits.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue:
+    """Bounded queue of updates drained by a fixed number of worker tasks."""
+
+    def __init__(self, process, workers, maxsize):
+        self._process = process
+        self._worker_count = workers
+        self._maxsize = maxsize
+        self._queue = None
+        self._loop = None
+        self._workers = []
+
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def enqueue(self, update):
+        """Queue `update` for processing. Returns False if it was dropped."""
+
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait((update, time.monotonic()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"⚠️ Update queue full ({self._maxsize}), dropping update")
+            return False
+        self.enqueued += 1
+        return True
+
+    async def drain(self, timeout=30):
+        """Wait up to `timeout` seconds for queued updates, then stop the workers."""
+
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"❌ Shutting down with {self._queue.qsize()} unprocessed updates")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        self._loop = None
+
+    def stats(self):
+        """Return a snapshot of the queue's backpressure metrics."""
+        processed = self.processed + self.failed
+        return {
+            "depth": self._queue.qsize() if self._queue is not None else 0,
+            "maxsize": self._maxsize,
+            "workers": len(self._workers),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "wait_avg": self.wait_total / processed if processed else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        if self._loop is not None:
+            # Only happens outside ASGI, where each request may get its own loop.
+            logger.warning("⚠️ Event loop changed, restarting update workers")
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self._maxsize)
+        self._workers = [loop.create_task(self._work()) for _ in range(self._worker_count)]
+
+    async def _work(self):
+        while True:
+            update, enqueued_at = await self._queue.get()
+            wait = time.monotonic() - enqueued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            try:
+                await self._process(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Error processing queued update: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,165 @@
+"""
+Write-behind of mined tokens to wallet balances.
+
+A mining payout only adds to the user's mined total in the mining store
+(one small write the scheduler already makes). :class:`MinedTokenBuffer`
+remembers which users mined since its last flush and, every
+``KUBOT_MINING_FLUSH_INTERVAL`` seconds, credits what they mined to
+``Wallet.balance`` with one bulk ledger credit per batch of users, instead of
+an UPDATE of a hot wallet row per session.
+
+The store is the journal: a user's unflushed tokens are their mined total
+minus what was already flushed, and a flush credits the wallets and marks the
+tokens flushed in one transaction, with the journal rows locked. Nothing is
+lost or credited twice if a worker dies between flushes; the next sweep, which
+every worker runs at startup and every ``KUBOT_MINING_SWEEP_INTERVAL``
+seconds, flushes whatever it left behind, one batch of users at a time.
+Workers flush their own users once more on shutdown.
+
+Tokens mined before the user has a wallet stay unflushed until they get one;
+sweeps skip them. :func:`get_balance` is the persisted balance plus the
+unflushed tokens, so it is never behind.
+"""
+import asyncio
+import logging
+import threading
+import time
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from . import ledger
+from .models import LedgerEntry, Wallet
+
+logger = logging.getLogger(__name__)
+
+
+class MinedTokenBuffer:
+    """Flushes mined tokens from the mining store to wallet balances."""
+
+    def __init__(self, store, flush_interval=None, sweep_interval=None, batch_size=500):
+        self.store = store
+        self.flush_interval = flush_interval if flush_interval is not None else settings.KUBOT_MINING_FLUSH_INTERVAL
+        self.sweep_interval = sweep_interval if sweep_interval is not None else settings.KUBOT_MINING_SWEEP_INTERVAL
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._dirty = {}  # user_id -> monotonic time of their oldest unflushed payout
+        self._task = None
+
+        self.flushes = 0
+        self.flushed_tokens = 0
+        self.failed = 0
+        self.staleness_max = 0.0
+
+    def record(self, user_id):
+        """Note that `user_id` was paid mined tokens (already in the store)."""
+        with self._lock:
+            self._dirty.setdefault(user_id, time.monotonic())
+
+    def flush(self, user_ids=None):
+        """
+        Credit the unflushed tokens of `user_ids` (every user when None).
+
+        Returns the number of tokens credited.
+        """
+        if user_ids is None:
+            return self._sweep()
+
+        flushed = 0
+        user_ids = iter(list(user_ids))
+        while batch := list(islice(user_ids, self.batch_size)):
+            flushed += self._flush(batch)
+        return flushed
+
+    def flush_dirty(self):
+        """Flush the users that mined since the last flush."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        try:
+            flushed = self.flush(dirty)
+        except Exception:
+            with self._lock:
+                for user_id, since in dirty.items():
+                    self._dirty[user_id] = min(since, self._dirty.get(user_id, since))
+            raise
+        self.staleness_max = max(self.staleness_max, time.monotonic() - min(dirty.values()))
+        return flushed
+
+    async def run(self):
+        """Flush every `flush_interval` seconds and sweep every `sweep_interval` seconds until cancelled."""
+        logger.info("💾 Mined token write-behind started")
+        swept = None
+        while True:
+            try:
+                if swept is None or time.monotonic() - swept >= self.sweep_interval:
+                    swept = time.monotonic()
+                    await sync_to_async(self.flush, thread_sensitive=True)()
+                else:
+                    await sync_to_async(self.flush_dirty, thread_sensitive=True)()
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Flushing mined tokens failed: {e}")
+            await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        """Start flushing on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        """Stop flushing, then flush this worker's users one last time."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await sync_to_async(self.flush_dirty, thread_sensitive=True)()
+        except Exception as e:
+            logger.error(f"❌ Flushing mined tokens on shutdown failed, the next sweep will: {e}")
+
+    def stats(self):
+        """Return a snapshot of the buffer's counters."""
+        with self._lock:
+            pending = len(self._dirty)
+            oldest = min(self._dirty.values(), default=None)
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "pending_users": pending,
+            "staleness": time.monotonic() - oldest if oldest is not None else 0.0,
+            "staleness_max": self.staleness_max,
+            "flushes": self.flushes,
+            "flushed_tokens": self.flushed_tokens,
+            "failed": self.failed,
+        }
+
+    def _sweep(self):
+        """Flush every user with a wallet and unflushed tokens, `batch_size` users per transaction."""
+        flushed, after = 0, None
+        while user_ids := self.store.unflushed_user_ids(after=after, limit=self.batch_size):
+            flushed += self._flush(user_ids)
+            after = user_ids[-1]
+        return flushed
+
+    def _flush(self, user_ids):
+        with transaction.atomic():
+            pending = self.store.get_unflushed(user_ids, lock=True)
+            if not pending:
+                return 0
+            wallets = set(Wallet.objects.filter(id__in=pending).values_list("id", flat=True))
+            amounts = {user_id: tokens for user_id, tokens in pending.items() if user_id in wallets}
+            items = iter(amounts.items())
+            while batch := dict(islice(items, self.batch_size)):
+                ledger.credit_many(batch, LedgerEntry.MINING, reference="mining")
+            self.store.mark_flushed(amounts)
+        self.flushes += 1
+        self.flushed_tokens += sum(amounts.values())
+        return sum(amounts.values())
+
+
+def get_balance(store, user_id):
+    """Return the wallet balance of `user_id` plus their unflushed mined tokens."""
+    return store.get_balance(user_id)